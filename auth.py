@@ -0,0 +1,141 @@
+"""
+Authentication with mysql_native_password.
+
+The client proves it knows the password by sending
+    SHA1(password) XOR SHA1(salt + SHA1(SHA1(password)))
+so all the server needs to keep is SHA1(SHA1(password)), the same
+hash MySQL keeps in mysql.user (as "*" and 40 hex digits). Checking a
+login then takes one SHA-1 of the salt and one of the recovered
+SHA1(password), with no trip to the backend.
+"""
+
+import os
+import hmac
+import hashlib
+import threading
+
+
+# Error code and SQL state for failed logins
+ER_ACCESS_DENIED_ERROR = 1045
+ACCESS_DENIED_STATE = "28000"
+
+
+
+def password_hash (password):
+    """ Gets the stored form of a password: SHA1(SHA1(password)). """
+
+    if not password:
+        return ""
+    return hashlib.sha1(hashlib.sha1(password).digest()).digest()
+
+
+def parse_hash (text):
+    """ Reads a MySQL-style "*<40 hex digits>" password hash. """
+
+    text = text.strip()
+    if not text:
+        return ""
+    if not text.startswith("*") or len(text) != 41:
+        raise ValueError("Not a mysql_native_password hash: %r" % text)
+    return text[1:].decode("hex")
+
+
+def xor (a, b):
+    return "".join(chr(ord(x) ^ ord(y)) for x, y in zip(a, b))
+
+
+def constant_time_equal (a, b):
+    """
+    Compares two digests in constant time, so how long a failed login
+    takes doesn't give away how much of the hash it got right.
+    """
+
+    if len(a) != len(b):
+        return False
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+# (Python 2.7.7 and up have one built in)
+compare_digest = getattr(hmac, "compare_digest", constant_time_equal)
+
+# Unknown users are checked against this (a hash no password can be
+# expected to match), so they take as long to turn away as known ones
+# and timing doesn't give away which users exist
+DUMMY_HASH = password_hash(os.urandom(20))
+
+
+
+class CredentialStore (object):
+    """
+    The users allowed to log in, with their password hashes.
+
+    Kept in memory (and precomputed), since it's checked
+    on every connection.
+    """
+
+    def __init__ (self, users=None):
+        self.lock = threading.Lock()
+        # user -> SHA1(SHA1(password)) ("" for no password)
+        self.users = {}
+        for user, password in (users or {}).items():
+            self.add(user, password)
+
+
+    @classmethod
+    def load (cls, path):
+        """
+        Reads users from a file, one per line: the user name,
+        then whitespace, then the "*..." hash (as in mysql.user).
+        Blank lines and lines starting with # are skipped.
+        """
+
+        store = cls()
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split(None, 1)
+                store.add_hash(parts[0], parse_hash(parts[1])
+                                         if len(parts) > 1 else "")
+        return store
+
+
+    def add (self, user, password):
+        self.add_hash(user, password_hash(password))
+
+
+    def add_hash (self, user, stage2):
+        with self.lock:
+            self.users[user] = stage2
+
+
+    def remove (self, user):
+        with self.lock:
+            self.users.pop(user, None)
+
+
+    def verify (self, user, salt, response):
+        """ Checks a client's auth response against the salt it was sent. """
+
+        stage2 = self.users.get(user)
+        if stage2 is None:
+            self.check(DUMMY_HASH, salt, response)
+            return False
+        return self.check(stage2, salt, response)
+
+
+    def check (self, stage2, salt, response):
+        """ Checks an auth response against a password hash. """
+
+        if not stage2:
+            # No password
+            return not response
+        if len(response) != 20:
+            return False
+        # Undo the XOR to get the client's SHA1(password),
+        # and check that it hashes to what we have
+        stage1 = xor(response, hashlib.sha1(salt + stage2).digest())
+        return compare_digest(hashlib.sha1(stage1).digest(), stage2)
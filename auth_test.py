@@ -0,0 +1,79 @@
+import threading
+import unittest
+import auth
+from auth import CredentialStore, parse_hash, compare_digest, \
+     constant_time_equal
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError, scramble
+from pysql import MySQLServer
+
+class AuthTests(unittest.TestCase):
+    def setUp(self):
+        self.store = CredentialStore({"jon": "secret", "guest": ""})
+
+    def test_verify(self):
+        """ Only the right password, scrambled with the right salt, works. """
+        salt = "abcdefghijklmnopqrst"
+        self.assertTrue(self.store.verify("jon", salt,
+                                          scramble("secret", salt)))
+        self.assertFalse(self.store.verify("jon", salt,
+                                           scramble("wrong", salt)))
+        self.assertFalse(self.store.verify("jon", "x" * 20,
+                                           scramble("secret", salt)))
+        self.assertTrue(self.store.verify("guest", salt, ""))
+        self.assertFalse(self.store.verify("nobody", salt, ""))
+        # The hash MySQL would have for the password
+        self.assertEqual(
+            parse_hash("*14E65567ABDB5135D0CFD9A70B3032C179A49EE7"),
+            self.store.users["jon"])
+
+    def test_unknown_user(self):
+        """ Unknown users should be hashed like known ones, then refused. """
+        checked = []
+        check = self.store.check
+        def record(stage2, salt, response):
+            checked.append(stage2)
+            return check(stage2, salt, response)
+        self.store.check = record
+        salt = "abcdefghijklmnopqrst"
+        self.assertFalse(self.store.verify("nobody", salt,
+                                           scramble("secret", salt)))
+        self.assertFalse(self.store.verify("jon", salt,
+                                           scramble("wrong", salt)))
+        self.assertEqual([auth.DUMMY_HASH, self.store.users["jon"]], checked)
+
+    def test_compare_digest(self):
+        """ Digests should only be equal if all of their bytes are. """
+        for equal in (compare_digest, constant_time_equal):
+            self.assertTrue(equal("abc\xff", "abc\xff"))
+            self.assertTrue(equal("", ""))
+            self.assertFalse(equal("abc\xff", "abc\xfe"))
+            self.assertFalse(equal("abc\xff", "xbc\xff"))
+            self.assertFalse(equal("abc", "abc\xff"))
+
+    def test_login(self):
+        """ Logins and user changes should be checked by the server. """
+        backend = MemoryBackend()
+        backend.use("other").insert("t", [{"a": 1}])
+        server = MySQLServer(("127.0.0.1", 0), backend, self.store)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = server.server_address[1]
+        try:
+            self.assertRaises(MySQLError, MySQLClient, port=port,
+                              user="jon", password="wrong")
+            client = MySQLClient(port=port, user="jon", password="secret")
+            client.change_user("guest", database="other")
+            self.assertEqual((["a"], [["1"]]), client.query("select a from t"))
+            client.reset_connection()
+            self.assertEqual((["a"], [["1"]]), client.query("select a from t"))
+            self.assertRaises(MySQLError, client.change_user, "jon", "wrong")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,386 @@
+"""
+The storage backend interface.
+
+A backend serves tables of documents (dicts). Queries come in as
+MongoDB-style query documents (see sql_parsers.WHERE), and each backend
+says which parts of a query it can handle itself through its
+capabilities. Backend.find does the rest in the proxy, so every backend
+answers every query the same way.
+"""
+
+import itertools
+
+from conditions import matches, get_path, MISSING
+from parallel_scan import ParallelScan
+
+
+# Capabilities a backend can have
+FILTER = "filter"           # Evaluates the conditions
+PROJECTION = "projection"   # Returns only the requested columns
+SORT = "sort"               # Sorts by the order given
+LIMIT = "limit"             # Applies the limit and offset (needs SORT)
+UNWIND = "unwind"           # Unwinds an array field into a row per element
+
+# $in lists longer than this get split into batches, which are queried
+# at the same time (None to never split them)
+IN_BATCH_SIZE = 500
+
+# The most batches to split an $in list into (bigger lists get
+# bigger batches)
+MAX_IN_BATCHES = 8
+
+# MySQL's errors for missing and read-only tables
+ER_OPEN_AS_READONLY = 1036
+ER_NO_SUCH_TABLE = 1146
+
+
+
+class QueryTimeout (Exception):
+    """ The backend gave up on a query that ran out of time. """
+
+
+
+class NothingWritten (Exception):
+    """
+    An insert was turned down before any of its documents were written
+    (so they can safely be tried again).
+    """
+
+
+
+class ReadOnlyTable (NothingWritten):
+    """ A write to a backend that can't be written to. """
+
+    code = ER_OPEN_AS_READONLY
+    sql_state = "HY000"
+
+    def __init__ (self, table):
+        Exception.__init__(self, "Table '%s' is read only" % table)
+
+
+
+class NoSuchTable (Exception):
+    """ A query on a table that isn't there. """
+
+    code = ER_NO_SUCH_TABLE
+    sql_state = "42S02"
+
+    def __init__ (self, database, table):
+        Exception.__init__(self, "Table '%s.%s' doesn't exist"
+                                 % (database, table))
+
+
+
+class WriteErrors (Exception):
+    """
+    Some of the documents in an insert weren't written (while the
+    rest were). errors has (code, message) for each of them, by their
+    index in the documents.
+    """
+
+    # MongoDB's duplicate key errors, which MySQL calls ER_DUP_ENTRY
+    DUPLICATE_KEY = frozenset([11000, 11001])
+
+    def __init__ (self, errors):
+        self.errors = errors
+        code, message = errors[min(errors)]
+        Exception.__init__(self, message)
+        if all(c in self.DUPLICATE_KEY for c, m in errors.values()):
+            self.code, self.sql_state = 1062, "23000"
+        else:
+            self.code, self.sql_state = 1105, "HY000"
+
+
+
+class Backend (object):
+    """ Base class for storage backends. """
+
+    # The parts of a query the backend can push down
+    capabilities = frozenset()
+
+    # The database (namespace) the backend is using
+    database = None
+
+
+    def use (self, database):
+        """
+        Gets a backend for another database, sharing this one's
+        connections (or storage).
+        """
+
+        raise NotImplementedError
+
+
+    def databases (self):
+        """ Gets the names of the databases. """
+
+        return [self.database]
+
+
+    def tables (self):
+        """ Gets the names of the tables in the database. """
+
+        raise NotImplementedError
+
+
+    def scan (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, **options):
+        """
+        Reads documents from a table, returning an iterator.
+
+        Only the parts of the query in the backend's capabilities
+        need to be applied; find() takes care of the rest.
+        """
+
+        raise NotImplementedError
+
+
+    def insert (self, table, documents):
+        """
+        Inserts a list of documents, returning how many went in.
+        (Backends that can't write leave this, and update() and
+        delete(), raising ReadOnlyTable.)
+        """
+
+        raise ReadOnlyTable(table)
+
+
+    def update (self, table, conditions, changes):
+        """
+        Sets fields on the documents matching the conditions,
+        returning how many were changed.
+        """
+
+        raise ReadOnlyTable(table)
+
+
+    def delete (self, table, conditions):
+        """ Deletes the matching documents, returning how many went. """
+
+        raise ReadOnlyTable(table)
+
+
+    def commit (self, writes):
+        """
+        Applies a transaction's writes, a list of (database, table,
+        documents) to insert. Backends with transactions of their own
+        make it all or nothing; by default they're just done in order.
+        """
+
+        for database, table, documents in writes:
+            self.use(database).insert(table, documents)
+
+
+    def stats (self, table):
+        """
+        Gets statistics about a table, as a dict with (at least)
+        "rows" and "size" (in bytes, or None if unknown).
+        """
+
+        raise NotImplementedError
+
+
+    def indexes (self, table):
+        """
+        Gets the indexes on a table, as a dict of
+        index name -> list of (field, direction).
+        """
+
+        return {}
+
+
+    def create_index (self, table, fields):
+        """ Creates an index on a list of (field, direction). """
+
+        raise NotImplementedError
+
+
+    def find (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, unwind=None, **options):
+        """
+        Runs a query against a table, returning an iterator of documents.
+
+        Whatever the backend can't do itself is done here.
+        Extra options (eg. parallel, max_time_ms) are passed on to scan(),
+        and backends ignore any they don't know about.
+
+        With unwind (an array field's path), each document turns into
+        one per element of the array, like MongoDB's $unwind, before
+        the rest of the query applies.
+        """
+
+        conditions = conditions or {}
+        batches = split_in(conditions)
+        if batches:
+            return self.find_batches(table, batches, columns, order, limit,
+                                     offset, unwind, **options)
+
+        capabilities = self.capabilities
+        if unwind:
+            if UNWIND in capabilities:
+                options["unwind"] = unwind
+            else:
+                # Everything else has to come after the unwinding,
+                # so it all gets done here
+                capabilities = frozenset()
+                options.pop("raw", None)
+        filtered = FILTER in capabilities or not conditions
+        sorted_ = SORT in capabilities or not order
+        # The limit can only be pushed down if nothing's left to be done
+        # before it (filtering or sorting).
+        push_limit = LIMIT in capabilities and filtered and sorted_
+
+        # Projections can't be pushed down if we still need
+        # other fields to filter or sort on
+        push_columns = PROJECTION in capabilities and filtered and sorted_
+
+        # Raw (undecoded) documents are only any good if
+        # there's nothing left to do with them here
+        if not (filtered and sorted_ and (push_columns or not columns) and
+                (push_limit or not (offset or limit is not None))):
+            options.pop("raw", None)
+
+        results = self.scan(
+            table,
+            conditions if FILTER in capabilities else None,
+            columns if push_columns else None,
+            order if SORT in capabilities else None,
+            limit if push_limit else None,
+            offset if push_limit else 0,
+            **options
+        )
+
+        if unwind and "unwind" not in options:
+            results = unwind_documents(results, unwind)
+        if not filtered:
+            results = (doc for doc in results if matches(doc, conditions))
+        if not sorted_:
+            results = iter(sort_documents(list(results), order))
+        if not push_limit and (offset or limit is not None):
+            stop = None if limit is None else offset + limit
+            results = itertools.islice(results, offset, stop)
+        if columns and not push_columns:
+            results = (project(doc, columns) for doc in results)
+        return results
+
+
+    def find_batches (self, table, batches, columns=None, order=None,
+                      limit=None, offset=0, unwind=None, **options):
+        """
+        Runs a query for each batch of conditions at once (see split_in),
+        merging their results back together (in order, if there is one).
+        """
+
+        # Each batch might have all the rows (up to the limit),
+        # and the merge needs the fields it sorts by
+        per_batch = None if limit is None else offset + limit
+        fields = columns
+        if columns and order:
+            fields = list(columns) + [field for field, direction in order
+                                      if field not in columns]
+        options.pop("raw", None)
+        streams = [self.find(table, conditions, fields, order, per_batch,
+                             unwind=unwind, **options)
+                   for conditions in batches]
+        results = iter(ParallelScan(streams, order))
+        if offset or limit is not None:
+            stop = None if limit is None else offset + limit
+            results = itertools.islice(results, offset, stop)
+        if fields != columns:
+            results = (project(doc, columns) for doc in results)
+        return results
+
+
+
+
+class Documents (Backend):
+    """
+    Wraps already-read documents as a backend that can't do anything,
+    so find() filters, sorts and projects them all in the proxy.
+    """
+
+    def __init__ (self, documents):
+        self.documents = documents
+
+    def scan (self, table, *args, **options):
+        return self.documents
+
+
+
+def split_in (conditions):
+    """
+    Splits a query with a long $in list (on a top level field) into
+    queries for batches of its values. Returns None if it doesn't
+    have one.
+
+    (The values don't overlap, so each document only turns up in one
+    batch, unless the field is an array matching values in several.)
+    """
+
+    if not IN_BATCH_SIZE:
+        return None
+    for field, condition in conditions.items():
+        if field.startswith("$") or not isinstance(condition, dict):
+            continue
+        values = condition.get("$in")
+        if values is None or len(values) <= IN_BATCH_SIZE:
+            continue
+        size = max(IN_BATCH_SIZE, -(-len(values) // MAX_IN_BATCHES))
+        batches = []
+        for start in range(0, len(values), size):
+            batch = dict(conditions)
+            batch[field] = dict(condition)
+            batch[field]["$in"] = values[start:start + size]
+            batches.append(batch)
+        return batches
+    return None
+
+
+def sort_documents (documents, order):
+    """ Sorts a list of documents (in place) by a list of (field, direction). """
+
+    # Sort by each key in turn, starting with the least significant
+    for field, direction in reversed(order):
+        documents.sort(key=lambda doc: get_path(doc, field),
+                       reverse=direction < 0)
+    return documents
+
+
+def unwind_documents (documents, path):
+    """
+    Turns each document into one per element of an array field.
+    As with MongoDB's $unwind, documents without the field (or with
+    an empty array, or NULL) are left out, and ones where it isn't
+    an array are left as they are.
+    """
+
+    parts = path.split(".")
+    for doc in documents:
+        value = get_path(doc, path)
+        if isinstance(value, list):
+            for element in value:
+                yield replace_path(doc, parts, element)
+        elif value is not MISSING and value is not None:
+            yield doc
+
+
+def replace_path (doc, parts, value):
+    """ Copies a document, with the field at a path replaced. """
+
+    doc = dict(doc)
+    if len(parts) == 1:
+        doc[parts[0]] = value
+    else:
+        doc[parts[0]] = replace_path(doc[parts[0]], parts[1:], value)
+    return doc
+
+
+def project (doc, columns):
+    """ Picks out just the given columns from a document. """
+
+    projected = {}
+    for column in columns:
+        value = get_path(doc, column)
+        if value is not MISSING:
+            projected[column] = value
+    return projected
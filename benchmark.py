@@ -0,0 +1,444 @@
+"""
+End-to-end benchmark for pysql.
+
+Starts a pysql server (in its own process) against either a local mongod
+or the in-memory backend, then drives it over the MySQL protocol
+with a mix of queries from several client threads.
+
+Reports throughput, p50/p99 latency and the server's memory use, and
+writes the results out as JSON so runs from different commits can be
+compared, eg.
+    python benchmark.py --output before.json
+    (make changes)
+    python benchmark.py --output after.json --compare before.json
+
+With --workers N the server runs in pre-fork mode, and the clients
+are spread over N processes too, so neither side is held to one core,
+eg. to check how throughput scales:
+    python benchmark.py --workers 1 --concurrency 16 --output one.json
+    python benchmark.py --workers 4 --concurrency 16 --compare one.json
+(With the memory backend each worker has its own copy of the table.)
+
+With --startup N it instead starts a fresh server process N times, and
+measures how long each takes to accept its first connection (imports,
+making the backend, and the handshake), which is what short-lived
+workers and test runs pay, eg.
+    python benchmark.py --startup 20 --output startup.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from mysql_client import MySQLClient, MySQLError
+
+
+# The kinds of queries we run, and how often (by default)
+DEFAULT_MIX = "point=40,range=30,scan=10,insert=20"
+
+# The table the benchmark queries run against
+TABLE = "bench"
+
+
+
+def make_queries (rows):
+    """ Gets the functions making each kind of query. """
+
+    def point ():
+        return "SELECT * FROM %s WHERE id = %d" % (TABLE, random.randrange(rows))
+
+    def range_scan ():
+        start = random.randrange(rows)
+        return "SELECT * FROM %s WHERE id >= %d AND id < %d" \
+               % (TABLE, start, start + 100)
+
+    def scan ():
+        return "SELECT * FROM %s" % TABLE
+
+    def insert ():
+        n = random.randrange(1 << 30)
+        return "INSERT INTO %s (id, name, value) VALUES (%d, 'name%d', %d)" \
+               % (TABLE, rows + n, n, n)
+
+    return {"point": point, "range": range_scan, "scan": scan,
+            "insert": insert}
+
+
+def parse_mix (mix):
+    """ Parses a query mix like "point=40,scan=10" into a weight list. """
+
+    weights = []
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights.append((name.strip(), int(weight)))
+    return weights
+
+
+def seed (backend, rows):
+    """ Fills the benchmark table in (and indexes it). """
+
+    backend.delete(TABLE, {})
+    batch = []
+    for i in range(rows):
+        batch.append({"id": i, "name": "name%d" % i, "value": i * 7 % 1000})
+        if len(batch) == 1000:
+            backend.insert(TABLE, batch)
+            batch = []
+    if batch:
+        backend.insert(TABLE, batch)
+    backend.create_index(TABLE, [("id", 1)])
+
+
+def make_backend (name):
+    """ Makes the backend the server runs against. """
+
+    if name == "memory":
+        from memory_backend import MemoryBackend
+        return MemoryBackend()
+    else:
+        from mongo_backend import MongoBackend
+        return MongoBackend()
+
+
+def run_server (port, backend, rows, ready, workers=1):
+    """
+    Runs the pysql server (in a child process), releasing
+    ready once for each worker that's listening.
+    """
+
+    import pysql
+    import prefork
+    seeded = make_backend(backend)
+    seed(seeded, rows)
+
+    def make_server ():
+        # Each worker gets its own MongoDB connections, while the
+        # in-memory table gets copied into each one by the fork
+        server = pysql.MySQLServer(
+            ("127.0.0.1", port),
+            seeded if backend == "memory" else make_backend(backend),
+            reuse_port=workers > 1)
+        ready.release()
+        return server
+
+    if workers > 1:
+        prefork.Supervisor(make_server, workers).run()
+    else:
+        make_server().serve_forever()
+
+
+def rss (pid):
+    """
+    Gets the resident set size of a process (and its children,
+    eg. pre-fork workers), in KB.
+    """
+
+    total = None
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    total = int(line.split()[1])
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as children:
+            for child in children.read().split():
+                total += rss(int(child)) or 0
+    except IOError:
+        pass
+    return total
+
+
+def percentile (values, p):
+    """ Gets the p-th percentile of some (sorted) values. """
+
+    if not values:
+        return None
+    index = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def worker (port, queries, weights, deadline, results, errors,
+            compress=False):
+    """ Runs queries until the deadline, recording the latencies. """
+
+    client = MySQLClient("127.0.0.1", port, compress=compress)
+    names = [name for name, weight in weights]
+    cumulative = []
+    total = 0
+    for name, weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    latencies = dict((name, []) for name in names)
+    while time.time() < deadline:
+        pick = random.random() * total
+        name = names[[pick < c for c in cumulative].index(True)]
+        sql = queries[name]()
+        start = time.time()
+        try:
+            client.query(sql)
+        except MySQLError:
+            errors.append(name)
+            continue
+        latencies[name].append(time.time() - start)
+    client.close()
+    results.append(latencies)
+
+
+def run_clients (port, rows, weights, deadline, threads, compress, output):
+    """ Runs some client threads (in a child process). """
+
+    queries = make_queries(rows)
+    results = []
+    errors = []
+    threads = [
+        threading.Thread(target=worker, args=(
+            port, queries, weights, deadline, results, errors, compress))
+        for i in range(threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    output.put((results, errors))
+
+
+def summarize (latencies, elapsed):
+    """ Sums up the latencies of some queries. """
+
+    latencies = sorted(latencies)
+    return {
+        "queries": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+    }
+
+
+def git_commit ():
+    """ Gets the current commit (if we're in a git checkout). """
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup (runs=10, backend="memory", port=13306):
+    """
+    Times server processes from starting to accepting (and logging in)
+    their first connection, returning the results as a dict.
+    """
+
+    pysql = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "pysql.py")
+    devnull = open(os.devnull, "w")
+    times = []
+    # The interpreter's own startup, for comparison
+    interpreter = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", "pass"])
+        interpreter.append((time.time() - start) * 1000)
+
+        start = time.time()
+        server = subprocess.Popen(
+            [sys.executable, pysql, "--backend", backend,
+             "--port", str(port), "--metrics-port", "0"],
+            stdout=devnull, stderr=devnull)
+        try:
+            while True:
+                try:
+                    MySQLClient(port=port).close()
+                    break
+                except socket.error:
+                    if server.poll() is not None:
+                        raise RuntimeError("The server didn't start")
+                    time.sleep(0.001)
+            times.append((time.time() - start) * 1000)
+        finally:
+            server.terminate()
+            server.wait()
+
+    times.sort()
+    interpreter.sort()
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "backend": backend,
+        "startup": {
+            "runs": runs,
+            "min_ms": times[0],
+            "p50_ms": percentile(times, 50),
+            "max_ms": times[-1],
+            "python_ms": percentile(interpreter, 50),
+        },
+    }
+
+
+def report_startup (results, baseline=None):
+    """ Prints the startup times (and the changes from a baseline). """
+
+    r = results["startup"]
+    old = (baseline or {}).get("startup")
+    for name in ("min_ms", "p50_ms", "max_ms", "python_ms"):
+        change = ""
+        if old and old.get(name):
+            change = " (%+.1f%%)" % ((r[name] - old[name]) * 100.0 / old[name])
+        print "%-10s %10.1f%s" % (name, r[name], change)
+
+
+def benchmark (backend="memory", concurrency=8, duration=10.0, rows=10000,
+               mix=DEFAULT_MIX, port=13306, compress=False, workers=1):
+    """ Runs the benchmark, returning the results as a dict. """
+
+    ready = multiprocessing.Semaphore(0)
+    server = multiprocessing.Process(
+        target=run_server, args=(port, backend, rows, ready, workers))
+    server.daemon = True
+    server.start()
+    try:
+        for i in range(workers):
+            if not ready.acquire(timeout=60):
+                raise RuntimeError("The server didn't start")
+        rss_before = rss(server.pid)
+
+        weights = parse_mix(mix)
+        results = []
+        errors = []
+        start = time.time()
+        deadline = start + duration
+        if workers > 1:
+            # Split the clients over as many processes as the server has
+            output = multiprocessing.Queue()
+            clients = [
+                multiprocessing.Process(target=run_clients, args=(
+                    port, rows, weights, deadline,
+                    concurrency // workers + (i < concurrency % workers),
+                    compress, output))
+                for i in range(workers)
+            ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                more_results, more_errors = output.get()
+                results += more_results
+                errors += more_errors
+            for client in clients:
+                client.join()
+        else:
+            queries = make_queries(rows)
+            threads = [
+                threading.Thread(target=worker, args=(
+                    port, queries, weights, deadline, results, errors,
+                    compress))
+                for i in range(concurrency)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.time() - start
+        rss_after = rss(server.pid)
+    finally:
+        server.terminate()
+        server.join()
+
+    by_kind = {}
+    everything = []
+    for name, weight in weights:
+        kind = sum([r[name] for r in results], [])
+        everything += kind
+        by_kind[name] = summarize(kind, elapsed)
+    overall = summarize(everything, elapsed)
+    overall["errors"] = len(errors)
+
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "backend": backend,
+        "concurrency": concurrency,
+        "duration": elapsed,
+        "rows": rows,
+        "mix": mix,
+        "compress": compress,
+        "workers": workers,
+        "overall": overall,
+        "queries": by_kind,
+        "rss_kb": {"start": rss_before, "end": rss_after},
+    }
+
+
+def report (results, baseline=None):
+    """ Prints the results (and the changes from a baseline). """
+
+    def change (new, old):
+        if not old:
+            return ""
+        return " (%+.1f%%)" % ((new - old) * 100.0 / old)
+
+    rows = [("overall", results["overall"])] + \
+           sorted(results["queries"].items())
+    print "%-10s %10s %12s %10s %10s" \
+          % ("query", "count", "queries/s", "p50 ms", "p99 ms")
+    for name, r in rows:
+        old = baseline and (baseline["overall"] if name == "overall"
+                            else baseline["queries"].get(name))
+        print "%-10s %10d %12.1f%s %10.3f%s %10.3f%s" % (
+            name, r["queries"],
+            r["throughput"], change(r["throughput"],
+                                    old and old["throughput"]),
+            r["p50_ms"], change(r["p50_ms"], old and old["p50_ms"]),
+            r["p99_ms"], change(r["p99_ms"], old and old["p99_ms"]),
+        )
+    print "errors: %d" % results["overall"]["errors"]
+    print "server RSS: %s KB -> %s KB" % (results["rss_kb"]["start"],
+                                         results["rss_kb"]["end"])
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backend", choices=["memory", "mongo"],
+                        default="memory")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Query weights (default: %s)" % DEFAULT_MIX)
+    parser.add_argument("--port", type=int, default=13306)
+    parser.add_argument("--compress", action="store_true",
+                        help="Use the compressed protocol")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Server (and client) processes")
+    parser.add_argument("--startup", type=int, metavar="N",
+                        help="Time N server startups instead")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with a previous run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    if args.startup:
+        results = startup(args.startup, args.backend, args.port)
+        report_startup(results, baseline)
+    else:
+        results = benchmark(args.backend, args.concurrency, args.duration,
+                            args.rows, args.mix, args.port, args.compress,
+                            args.workers)
+        report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
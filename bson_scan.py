@@ -0,0 +1,237 @@
+"""
+Reads fields straight out of raw BSON, without decoding whole documents.
+
+A BSON document is an int32 length, then elements, then a 0 byte.
+Each element is a type byte, a NUL-terminated name, and a value
+whose size follows from its type. Looking up a (dotted) path walks
+the element headers, skipping over the values it doesn't need, and
+only decodes the one it was asked for.
+
+Documents are found by their offset into a buffer, so a whole batch
+of them (as MongoDB sends them) can be read without copying each
+one out, and text_value can turn a value straight into the bytes of
+a MySQL text row.
+"""
+
+import json
+import struct
+import datetime
+
+from conditions import MISSING
+
+
+INT32 = struct.Struct("< i")
+INT64 = struct.Struct("< q")
+UINT64 = struct.Struct("< Q")
+DOUBLE = struct.Struct("< d")
+
+# Element types
+DOUBLE_TYPE = "\x01"
+STRING = "\x02"
+DOCUMENT = "\x03"
+ARRAY = "\x04"
+BINARY = "\x05"
+OBJECT_ID = "\x07"
+BOOLEAN = "\x08"
+DATETIME = "\x09"
+NULL = "\x0a"
+REGEX = "\x0b"
+INT32_TYPE = "\x10"
+TIMESTAMP = "\x11"
+INT64_TYPE = "\x12"
+
+# Sizes of the fixed-size values (by type)
+FIXED_SIZES = {
+    "\x01": 8, "\x06": 0, "\x07": 12, "\x08": 1, "\x09": 8, "\x0a": 0,
+    "\x10": 4, "\x11": 8, "\x12": 8, "\x13": 16, "\xff": 0, "\x7f": 0,
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# A NULL in a text row
+NULL_TEXT = "\xFB"
+
+
+
+class BSONError (Exception):
+    """ The BSON couldn't be read. """
+
+
+
+def value_end (data, kind, pos):
+    """ Finds where a value (of a type, starting at pos) ends. """
+
+    if kind in FIXED_SIZES:
+        return pos + FIXED_SIZES[kind]
+    if kind in (STRING, "\x0d", "\x0e"):
+        return pos + 4 + INT32.unpack_from(data, pos)[0]
+    if kind in (DOCUMENT, ARRAY, "\x0f"):
+        return pos + INT32.unpack_from(data, pos)[0]
+    if kind == BINARY:
+        return pos + 5 + INT32.unpack_from(data, pos)[0]
+    if kind == REGEX:
+        return data.index("\0", data.index("\0", pos) + 1) + 1
+    if kind == "\x0c":
+        return pos + 4 + INT32.unpack_from(data, pos)[0] + 12
+    raise BSONError("Unknown BSON type 0x%02x" % ord(kind))
+
+
+def elements (data, start=0):
+    """
+    Walks a document's elements (the document starting at start),
+    yielding (name, type, value position) without decoding anything.
+    """
+
+    pos = start + 4
+    end = start + INT32.unpack_from(data, start)[0] - 1
+    while pos < end:
+        kind = data[pos]
+        name_end = data.index("\0", pos + 1)
+        name = data[pos + 1:name_end]
+        yield name, kind, name_end + 1
+        pos = value_end(data, kind, name_end + 1)
+
+
+def find (data, name, start=0):
+    """ Finds an element by name, returning (type, position) or None. """
+
+    for element, kind, pos in elements(data, start):
+        if element == name:
+            return kind, pos
+    return None
+
+
+def decode (data, kind, pos):
+    """ Decodes a single value. """
+
+    if kind == STRING:
+        length = INT32.unpack_from(data, pos)[0]
+        return data[pos + 4:pos + 3 + length]
+    if kind == INT32_TYPE:
+        return INT32.unpack_from(data, pos)[0]
+    if kind == INT64_TYPE:
+        return INT64.unpack_from(data, pos)[0]
+    if kind == DOUBLE_TYPE:
+        return DOUBLE.unpack_from(data, pos)[0]
+    if kind == BOOLEAN:
+        return data[pos] != "\0"
+    if kind == NULL:
+        return None
+    if kind == OBJECT_ID:
+        return data[pos:pos + 12].encode("hex")
+    if kind == DATETIME:
+        milliseconds = INT64.unpack_from(data, pos)[0]
+        return EPOCH + datetime.timedelta(milliseconds=milliseconds)
+    if kind == TIMESTAMP:
+        return UINT64.unpack_from(data, pos)[0]
+    if kind == DOCUMENT:
+        return dict((name, decode(data, k, p))
+                    for name, k, p in elements(data, pos))
+    if kind == ARRAY:
+        return [decode(data, k, p) for name, k, p in elements(data, pos)]
+    if kind == BINARY:
+        length = INT32.unpack_from(data, pos)[0]
+        return data[pos + 5:pos + 5 + length]
+    # (Code, regexes, decimals, etc. don't have a value for SQL)
+    return None
+
+
+def find_path (data, path, start=0):
+    """
+    Finds a (possibly dotted) field, returning (type, position),
+    or None if it isn't there.
+    """
+
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        found = find(data, part, start)
+        if found is None or i == len(parts) - 1:
+            return found
+        kind, start = found
+        # Arrays are documents too (keyed "0", "1", ...)
+        if kind not in (DOCUMENT, ARRAY):
+            return None
+    return None
+
+
+def get_path (data, path, start=0):
+    """
+    Gets a (possibly dotted) field from a raw BSON document,
+    or MISSING if it isn't there.
+    """
+
+    found = find_path(data, path, start)
+    if found is None:
+        return MISSING
+    return decode(data, found[0], found[1])
+
+
+def keys (data, start=0):
+    """ Gets the top level field names of a raw BSON document. """
+
+    return [name for name, kind, pos in elements(data, start)]
+
+
+def length_coded (n):
+    """ Encodes a length for a text row (as pysql.length_coded does). """
+
+    if n < 251:
+        return chr(n)
+    elif n < 0x10000:
+        return "\xFC" + struct.pack("< H", n)
+    elif n < 0x1000000:
+        return "\xFD" + struct.pack("< I", n)[:3]
+    return "\xFE" + struct.pack("< Q", n)
+
+
+def text_value (data, kind, pos):
+    """
+    Encodes a value as it goes in a MySQL text row (a length coded
+    string). Strings are copied straight out of the BSON, since
+    they're UTF-8 already.
+    """
+
+    if kind == STRING:
+        length = INT32.unpack_from(data, pos)[0] - 1
+        return length_coded(length) + data[pos + 4:pos + 4 + length]
+    if kind == NULL:
+        return NULL_TEXT
+    if kind == BOOLEAN:
+        return "\x011" if data[pos] != "\0" else "\x010"
+    value = decode(data, kind, pos)
+    if value is None:
+        return NULL_TEXT
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, default=str)
+    else:
+        value = str(value)
+    return length_coded(len(value)) + value
+
+
+def documents (batch):
+    """ Gets the offsets of the documents in a batch (of raw BSON). """
+
+    pos = 0
+    end = len(batch)
+    while pos < end:
+        yield pos
+        pos += INT32.unpack_from(batch, pos)[0]
+
+
+
+class RawDocument (object):
+    """ A document in a raw batch (which it's read from in place). """
+
+    __slots__ = ("data", "start")
+
+    def __init__ (self, data, start=0):
+        self.data = data
+        self.start = start
+
+
+    @property
+    def raw (self):
+        """ The document's own BSON (copied out of the batch). """
+
+        end = self.start + INT32.unpack_from(self.data, self.start)[0]
+        return self.data[self.start:end]
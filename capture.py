@@ -0,0 +1,175 @@
+"""
+Captures the commands going through the proxy, for replay.py.
+
+Each session's commands are written to a binary log as they're
+answered, along with when they came in and how long they took, so a
+real workload can be replayed later against another pysql (or MySQL)
+server, and the latencies compared.
+
+The sessions only ever put records on a bounded queue, which a thread
+of its own writes out, so capturing never makes a query wait on the
+disk. If the writer falls behind and the queue fills up, records are
+dropped (and counted in pysql_capture_dropped_total) instead.
+
+The log is a header (MAGIC and the format's version), then records of
+    command (1 byte), session (4), time (8), duration (4), length (4)
+followed by the command's payload (length bytes). Besides the MySQL
+commands, a session's CONNECT (with "user\\0database" as its payload)
+and DISCONNECT are recorded too.
+"""
+
+import time
+import Queue
+import atexit
+import struct
+import logging
+import threading
+
+import metrics
+
+
+log = logging.getLogger("pysql.capture")
+
+MAGIC = "PYSQLCAP"
+VERSION = 1
+
+# Session events (the MySQL commands only go up to 0x1f)
+CONNECT = 0xF0
+DISCONNECT = 0xF1
+
+# A record's header
+RECORD = struct.Struct("< B I d f I")
+
+# How many records can be waiting to be written
+BUFFER_SIZE = 10000
+
+# The most records to write out at once
+WRITE_BATCH = 500
+
+# Marks the end of the records, for the writer thread
+STOP = object()
+
+
+
+class Record (object):
+    """ A captured command (or session event). """
+
+    __slots__ = ("command", "session", "time", "duration", "payload")
+
+    def __init__ (self, command, session, time, duration=0.0, payload=""):
+        self.command = command
+        self.session = session
+        self.time = time
+        self.duration = duration
+        self.payload = payload
+
+
+    def pack (self):
+        return RECORD.pack(self.command, self.session, self.time,
+                           self.duration, len(self.payload)) + self.payload
+
+
+
+class CaptureWriter (object):
+    """ Writes the sessions' commands to a capture log, on its own thread. """
+
+    def __init__ (self, path, buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + chr(VERSION))
+        self.queue = Queue.Queue(buffer_size)
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.write_forever,
+                                       name="capture")
+        self.thread.daemon = True
+        self.thread.start()
+        # (So what's still queued gets written on the way out)
+        atexit.register(self.close)
+
+
+    def add (self, record):
+        """ Queues a record to be written (or drops it, if the queue's full). """
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            metrics.capture_dropped.inc()
+
+
+    def connect (self, session, user, database):
+        self.add(Record(CONNECT, session, time.time(), 0.0,
+                        "%s\0%s" % (user or "", database or "")))
+
+
+    def command (self, session, command, profile):
+        """ Records a command, once it's been answered. """
+
+        self.add(Record(command.command, session, profile.started,
+                        profile.duration, command.statement))
+
+
+    def disconnect (self, session):
+        self.add(Record(DISCONNECT, session, time.time()))
+
+
+    def write_forever (self):
+        """ Writes out queued records, in batches (runs on its own thread). """
+
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not STOP and len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = batch[-1] is STOP
+            if stop:
+                batch.pop()
+            try:
+                self.file.write("".join(record.pack() for record in batch))
+                # Flush whenever we've caught up, so the log stays current
+                # (even if the process gets killed)
+                if stop or self.queue.empty():
+                    self.file.flush()
+            except (IOError, OSError), e:
+                log.error("Couldn't write to %s: %s", self.path, e)
+            if stop:
+                return
+
+
+    def close (self):
+        """ Writes out whatever's queued, and closes the log. """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(STOP)
+        self.thread.join()
+        self.file.close()
+        if self.dropped:
+            log.warning("Dropped %d records from %s", self.dropped, self.path)
+
+
+
+def read_log (path):
+    """ Reads the records from a capture log, in order. """
+
+    with open(path, "rb") as log_file:
+        header = log_file.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't a pysql capture log" % path)
+        if ord(header[-1]) != VERSION:
+            raise ValueError("%s is a version %d capture log"
+                             % (path, ord(header[-1])))
+        while True:
+            data = log_file.read(RECORD.size)
+            if len(data) < RECORD.size:
+                # The end (or a record cut off by the process exiting)
+                return
+            command, session, started, duration, length = RECORD.unpack(data)
+            payload = log_file.read(length)
+            if len(payload) < length:
+                return
+            yield Record(command, session, started, duration, payload)
@@ -0,0 +1,75 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+import capture
+from capture import CaptureWriter, Record, read_log
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, COM_QUERY, COM_STMT_PREPARE, \
+     COM_STMT_EXECUTE
+from pysql import MySQLServer
+
+class CaptureTests(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        """ Records should be read back as they were written. """
+        writer = CaptureWriter(self.path)
+        writer.connect(7, "bob", "db")
+        writer.add(Record(COM_QUERY, 7, 100.5, 0.25, "select 1"))
+        writer.disconnect(7)
+        writer.close()
+        records = list(read_log(self.path))
+        self.assertEqual([capture.CONNECT, COM_QUERY, capture.DISCONNECT],
+                         [r.command for r in records])
+        self.assertEqual("bob\0db", records[0].payload)
+        self.assertEqual((7, 100.5, 0.25, "select 1"),
+                         (records[1].session, records[1].time,
+                          records[1].duration, records[1].payload))
+        # A record cut off at the end is left out
+        with open(self.path, "ab") as f:
+            f.write(Record(COM_QUERY, 7, 101, 0, "select 2").pack()[:-3])
+        self.assertEqual(3, len(list(read_log(self.path))))
+
+    def test_server(self):
+        """ The server should record each session's commands. """
+        writer = CaptureWriter(self.path)
+        server = MySQLServer(("127.0.0.1", 0), MemoryBackend(),
+                             capture=writer)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = MySQLClient(port=server.server_address[1])
+            client.query("insert into t (a) values (1)")
+            statement_id = client.prepare("select a from t where a = ?")[0]
+            client.execute(statement_id, [1])
+            client.close()
+            # (The session ends on its own time)
+            deadline = time.time() + 2
+            while time.time() < deadline:
+                records = list(read_log(self.path))
+                if records and records[-1].command == capture.DISCONNECT:
+                    break
+                time.sleep(0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+            writer.close()
+        self.assertEqual([capture.CONNECT, COM_QUERY, COM_STMT_PREPARE,
+                          COM_STMT_EXECUTE, capture.DISCONNECT],
+                         [r.command for r in records])
+        self.assertEqual(1, len(set(r.session for r in records)))
+        self.assertEqual("select a from t where a = ?", records[2].payload)
+        self.assertTrue(records[1].duration > 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
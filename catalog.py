@@ -0,0 +1,384 @@
+"""
+A virtual catalog for the metadata queries clients send on connect.
+
+SHOW DATABASES/TABLES/COLUMNS, DESCRIBE, information_schema and
+SELECT @@variable are answered from cached table lists and schemas
+inferred from a sample of each table's documents. Entries older than
+CACHE_TTL are still served, while a background thread reloads them,
+so these queries never wait on the backend once the cache is warm.
+"""
+
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+from backend import Documents
+
+
+log = logging.getLogger("pysql.catalog")
+
+# How long (in seconds) before cached entries get reloaded
+CACHE_TTL = 30.0
+
+# How many documents to look at when inferring a table's columns
+SAMPLE_SIZE = 100
+
+# Answers for SELECT @@... and SHOW VARIABLES
+SERVER_VARIABLES = OrderedDict([
+    ("auto_increment_increment", 1),
+    ("autocommit", 1),
+    ("character_set_client", "latin1"),
+    ("character_set_connection", "latin1"),
+    ("character_set_results", "latin1"),
+    ("character_set_server", "latin1"),
+    ("collation_connection", "latin1_swedish_ci"),
+    ("collation_server", "latin1_swedish_ci"),
+    ("interactive_timeout", 28800),
+    ("lower_case_table_names", 0),
+    ("max_allowed_packet", 16777216),
+    ("max_execution_time", 0),
+    ("net_write_timeout", 60),
+    ("sql_mode", ""),
+    ("system_time_zone", "UTC"),
+    ("time_zone", "SYSTEM"),
+    ("tx_isolation", "REPEATABLE-READ"),
+    ("version", "5.1.53 - log"),
+    ("version_comment", "pysql"),
+    ("wait_timeout", 28800),
+])
+
+# Column types to report for each kind of value
+COLUMN_TYPES = [
+    (bool, "tinyint(1)"),
+    ((int, long), "bigint(20)"),
+    (float, "double"),
+    (basestring, "varchar(255)"),
+]
+
+# The information_schema tables, and their columns
+INFORMATION_SCHEMA = OrderedDict([
+    ("SCHEMATA", ["CATALOG_NAME", "SCHEMA_NAME",
+                  "DEFAULT_CHARACTER_SET_NAME", "DEFAULT_COLLATION_NAME"]),
+    ("TABLES", ["TABLE_CATALOG", "TABLE_SCHEMA", "TABLE_NAME",
+                "TABLE_TYPE", "ENGINE", "TABLE_COMMENT"]),
+    ("COLUMNS", ["TABLE_CATALOG", "TABLE_SCHEMA", "TABLE_NAME",
+                 "COLUMN_NAME", "ORDINAL_POSITION", "IS_NULLABLE",
+                 "DATA_TYPE", "COLUMN_TYPE", "COLUMN_KEY"]),
+])
+
+show_databases_regex = re.compile(
+    "^\s*SHOW\s+(?:DATABASES|SCHEMAS)\s*;?\s*$", re.I)
+show_tables_regex = re.compile(
+    "^\s*SHOW\s+(FULL\s+)?TABLES(?:\s+(?:FROM|IN)\s+`?(\w+)`?)?\s*;?\s*$",
+    re.I)
+show_columns_regex = re.compile(
+    "^\s*(?:SHOW\s+(?:FULL\s+)?(?:COLUMNS|FIELDS)\s+(?:FROM|IN)|DESC|DESCRIBE)"
+    "\s+`?(\w+)`?(?:\.`?(\w+)`?)?(?:\s+(?:FROM|IN)\s+`?(\w+)`?)?\s*;?\s*$",
+    re.I)
+show_variables_regex = re.compile(
+    "^\s*SHOW\s+(?:GLOBAL\s+|SESSION\s+)?VARIABLES"
+    "(?:\s+LIKE\s+'([^']*)')?\s*;?\s*$", re.I)
+# (the mysql client sends "SELECT @@version_comment LIMIT 1" on connect)
+select_variables_regex = re.compile(
+    "^\s*SELECT\s+(.+?)(?:\s+LIMIT\s+[0-9]+)?\s*;?\s*$", re.I | re.S)
+variable_regex = re.compile(
+    "^(@@(?:session\.|global\.|local\.)?(\w+)|(DATABASE|SCHEMA|USER|"
+    "CURRENT_USER|VERSION|CONNECTION_ID)\s*\(\s*\))"
+    "(?:\s+(?:AS\s+)?(`[^`]+`|\w+))?$", re.I)
+
+
+
+class UnknownVariable (Exception):
+    """ A system variable that isn't in SERVER_VARIABLES. """
+
+
+
+def column_type (value):
+    """ Gets the MySQL column type to show for a value. """
+
+    for kind, name in COLUMN_TYPES:
+        if isinstance(value, kind):
+            return name
+    return "text"
+
+
+def like_regex (pattern):
+    """ Turns a LIKE pattern into a regex. """
+
+    return re.compile("^%s$" % "".join(
+        ".*" if c == "%" else "." if c == "_" else re.escape(c)
+        for c in pattern
+    ), re.I)
+
+
+def upper_fields (conditions):
+    """ Upper cases the field names in some conditions. """
+
+    upper = {}
+    for field, condition in conditions.items():
+        if field in ("$and", "$or"):
+            upper[field] = [upper_fields(c) for c in condition]
+        else:
+            upper[field.upper()] = condition
+    return upper
+
+
+def _equal (conditions, field):
+    """ Gets the value a field is required to equal (if any). """
+
+    value = conditions.get(field)
+    if isinstance(value, basestring):
+        return value
+    return None
+
+
+
+class Catalog (object):
+    """ Cached metadata about a backend's databases. """
+
+    def __init__ (self, backend, ttl=CACHE_TTL, sample_size=SAMPLE_SIZE):
+        self.backend = backend
+        self.ttl = ttl
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        # key -> [value, time loaded, whether it's being reloaded]
+        self.cache = {}
+
+
+    def cached (self, key, load):
+        """
+        Gets a value from the cache, loading it if it isn't there.
+        Stale values are returned as they are, and reloaded
+        in the background.
+        """
+
+        with self.lock:
+            entry = self.cache.get(key)
+            stale = entry is not None and \
+                    time.time() - entry[1] > self.ttl and not entry[2]
+            if stale:
+                entry[2] = True
+
+        if entry is None:
+            metrics.cache_requests.labels("catalog", "miss").inc()
+            value = load()
+            with self.lock:
+                self.cache[key] = [value, time.time(), False]
+            return value
+
+        if stale:
+            metrics.cache_requests.labels("catalog", "stale").inc()
+            thread = threading.Thread(target=self.reload, args=(key, load))
+            thread.daemon = True
+            thread.start()
+        else:
+            metrics.cache_requests.labels("catalog", "hit").inc()
+        return entry[0]
+
+
+    def reload (self, key, load):
+        """ Reloads a cache entry (in the background). """
+
+        try:
+            value = load()
+        except Exception:
+            log.exception("Couldn't reload %s", key)
+            with self.lock:
+                if key in self.cache:
+                    self.cache[key][2] = False
+            return
+        with self.lock:
+            self.cache[key] = [value, time.time(), False]
+
+
+    def invalidate (self, database=None):
+        """ Drops the cached entries (for one database, or all of them). """
+
+        with self.lock:
+            for key in self.cache.keys():
+                # Writes can make new databases, as well as tables
+                if database is None or key[0] == "databases" or \
+                   key[1] == database:
+                    del self.cache[key]
+
+
+    def table_written (self, database, table):
+        """ Notes a write, which could have made a new table. """
+
+        entry = self.cache.get(("tables", database))
+        if entry is not None and table not in entry[0]:
+            self.invalidate(database)
+
+
+    def databases (self):
+        return self.cached(("databases",), self.backend.databases)
+
+
+    def tables (self, database):
+        return self.cached(("tables", database),
+                           self.backend.use(database).tables)
+
+
+    def columns (self, database, table):
+        """ Gets a table's columns, as a list of (name, type). """
+
+        def load ():
+            backend = self.backend.use(database)
+            columns = OrderedDict()
+            for doc in backend.find(table, limit=self.sample_size):
+                for name, value in doc.items():
+                    if name == "_id":
+                        continue
+                    # The first non-NULL value decides the type
+                    if value is None:
+                        columns.setdefault(name, None)
+                    elif columns.get(name) is None:
+                        columns[name] = column_type(value)
+            return [(name, kind or "text") for name, kind in columns.items()]
+
+        return self.cached(("columns", database, table), load)
+
+
+    def stats (self, database, table):
+        return self.cached(("stats", database, table),
+                           lambda: self.backend.use(database).stats(table))
+
+
+    def indexes (self, database, table):
+        return self.cached(("indexes", database, table),
+                           lambda: self.backend.use(database).indexes(table))
+
+
+    def information_schema (self, table, conditions):
+        """
+        Gets the rows of an information_schema table. Equality
+        conditions on the schema and table names narrow down
+        what needs to be looked at.
+        """
+
+        table = table.upper()
+        if table not in INFORMATION_SCHEMA:
+            raise ValueError("Unknown table information_schema.%s" % table)
+        if table == "SCHEMATA":
+            return [{"CATALOG_NAME": "def", "SCHEMA_NAME": database,
+                     "DEFAULT_CHARACTER_SET_NAME": "latin1",
+                     "DEFAULT_COLLATION_NAME": "latin1_swedish_ci"}
+                    for database in self.databases()]
+
+        schema = _equal(conditions, "TABLE_SCHEMA")
+        databases = [schema] if schema else self.databases()
+        name = _equal(conditions, "TABLE_NAME")
+        rows = []
+        for database in databases:
+            tables = self.tables(database)
+            for t in ([name] if name in tables else [] if name else tables):
+                row = {"TABLE_CATALOG": "def", "TABLE_SCHEMA": database,
+                       "TABLE_NAME": t}
+                if table == "TABLES":
+                    row.update(TABLE_TYPE="BASE TABLE", ENGINE="pysql",
+                               TABLE_COMMENT="")
+                    rows.append(row)
+                    continue
+                for i, (column, kind) in enumerate(self.columns(database, t)):
+                    column_row = dict(row)
+                    column_row.update(
+                        COLUMN_NAME=column, ORDINAL_POSITION=i + 1,
+                        IS_NULLABLE="YES", DATA_TYPE=kind.split("(")[0],
+                        COLUMN_TYPE=kind, COLUMN_KEY="")
+                    rows.append(column_row)
+        return rows
+
+
+    def select (self, table, conditions, columns, order, limit, offset):
+        """
+        Runs a SELECT against an information_schema table,
+        returning (columns, rows).
+        """
+
+        conditions = upper_fields(conditions or {})
+        columns = [c.upper() for c in columns] if columns \
+                  else INFORMATION_SCHEMA.get(table.upper())
+        order = [(field.upper(), direction)
+                 for field, direction in order or []]
+        documents = self.information_schema(table, conditions)
+        found = Documents(documents).find(table, conditions, columns, order,
+                                          limit, offset)
+        return columns, [[doc.get(c) for c in columns] for doc in found]
+
+
+    def answer (self, statement, database, user, connection_id,
+                variables=None):
+        """
+        Answers a metadata query, returning (columns, rows),
+        or None if it isn't one. The session's own variables
+        (if any) override SERVER_VARIABLES.
+        """
+
+        if variables:
+            variables = OrderedDict(SERVER_VARIABLES, **variables)
+        else:
+            variables = SERVER_VARIABLES
+
+        match = show_databases_regex.match(statement)
+        if match:
+            return ["Database"], [[name] for name in self.databases()]
+
+        match = show_tables_regex.match(statement)
+        if match:
+            full, database = match.group(1), match.group(2) or database
+            columns = ["Tables_in_%s" % database]
+            rows = [[name] for name in self.tables(database)]
+            if full:
+                columns.append("Table_type")
+                rows = [row + ["BASE TABLE"] for row in rows]
+            return columns, rows
+
+        match = show_columns_regex.match(statement)
+        if match:
+            first, second, other = match.groups()
+            table = second or first
+            database = other or (first if second else database)
+            return (["Field", "Type", "Null", "Key", "Default", "Extra"],
+                    [[name, kind, "YES", "", None, ""]
+                     for name, kind in self.columns(database, table)])
+
+        match = show_variables_regex.match(statement)
+        if match:
+            pattern = like_regex(match.group(1) or "%")
+            return (["Variable_name", "Value"],
+                    [[name, str(value)]
+                     for name, value in variables.items()
+                     if pattern.match(name)])
+
+        # (Checking for "@@" and "(" first keeps this cheap for other SELECTs)
+        match = ("@@" in statement or "(" in statement) and \
+                select_variables_regex.match(statement)
+        if match:
+            items = [variable_regex.match(item.strip())
+                     for item in match.group(1).split(",")]
+            if not all(items):
+                return None
+            functions = {
+                "DATABASE": database, "SCHEMA": database,
+                "USER": user, "CURRENT_USER": user,
+                "VERSION": variables["version"],
+                "CONNECTION_ID": connection_id,
+            }
+            columns = []
+            row = []
+            for item in items:
+                expression, variable, function, alias = item.groups()
+                columns.append((alias or expression).strip("`"))
+                if function:
+                    row.append(functions[function.upper()])
+                elif variable.lower() in variables:
+                    row.append(variables[variable.lower()])
+                else:
+                    raise UnknownVariable(
+                        "Unknown system variable '%s'" % variable)
+            return columns, [row]
+
+        return None
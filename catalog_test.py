@@ -0,0 +1,70 @@
+import unittest
+from catalog import Catalog, UnknownVariable
+from memory_backend import MemoryBackend
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.backend.insert("people", [
+            {"name": "Jon", "age": 25, "city": None},
+            {"name": "Ann", "age": 31, "city": "Worc"},
+        ])
+        self.backend.use("other").insert("things", [{"weight": 1.5}])
+        self.catalog = Catalog(self.backend)
+
+    def answer(self, statement):
+        return self.catalog.answer(statement, "pysql_test", "jon", 7)
+
+    def test_show(self):
+        """ SHOW and DESCRIBE should come from the inferred schemas. """
+        self.assertEqual((["Database"], [["other"], ["pysql_test"]]),
+                         self.answer("SHOW DATABASES"))
+        self.assertEqual((["Tables_in_other", "Table_type"],
+                          [["things", "BASE TABLE"]]),
+                         self.answer("show full tables from `other`;"))
+        columns, rows = self.answer("DESCRIBE people")
+        self.assertEqual([("age", "bigint(20)"), ("city", "varchar(255)"),
+                          ("name", "varchar(255)")],
+                         sorted((row[0], row[1]) for row in rows))
+        self.assertEqual([["weight", "double", "YES", "", None, ""]],
+                         self.answer("SHOW COLUMNS FROM other.things")[1])
+        self.assertEqual(None, self.answer("SELECT name FROM people"))
+
+    def test_variables(self):
+        """ System variables and functions should be answered locally. """
+        self.assertEqual(
+            (["@@session.version_comment", "db", "CONNECTION_ID()"],
+             [["pysql", "pysql_test", 7]]),
+            self.answer("SELECT @@session.version_comment, DATABASE() AS db,"
+                        " CONNECTION_ID()"))
+        self.assertRaises(UnknownVariable, self.answer, "SELECT @@nonsense")
+        self.assertEqual([["max_allowed_packet", "16777216"]],
+                         self.answer("SHOW VARIABLES LIKE 'max_allowed%'")[1])
+
+    def test_information_schema(self):
+        """ information_schema queries should be filtered in the proxy. """
+        self.assertEqual(
+            (["TABLE_NAME"], [["people"]]),
+            self.catalog.select("tables", {"table_schema": "pysql_test"},
+                                ["table_name"], None, None, 0))
+        columns, rows = self.catalog.select(
+            "COLUMNS", {"TABLE_NAME": "people"}, ["COLUMN_NAME"],
+            [("column_name", 1)], 2, 0)
+        self.assertEqual([["age"], ["city"]], rows)
+
+    def test_cache(self):
+        """ Stale entries should be served, then reloaded. """
+        self.catalog.ttl = 0
+        self.assertEqual(["people"], self.catalog.tables("pysql_test"))
+        self.backend.insert("new", [{"a": 1}])
+        self.assertEqual(["people"], self.catalog.tables("pysql_test"))
+        for i in range(100):
+            if self.catalog.cache[("tables", "pysql_test")][0] != ["people"]:
+                break
+            import time; time.sleep(0.01)
+        self.assertEqual(["new", "people"], self.catalog.tables("pysql_test"))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+Group commit for single-row INSERTs.
+
+Clients doing lots of autocommit single-row INSERTs would otherwise
+cost a backend round trip each. With the coalescer, concurrent
+INSERTs into the same table (from any session) are gathered into a
+batch and written with one bulk insert, and each session only gets
+its OK once the whole batch has been written.
+
+The first INSERT into a table starts a batch and becomes its leader.
+The batch is written as soon as:
+    - it has max_batch rows, or
+    - the window (if any) is up, and the table's previous batch has
+      been written (which is when the next batch builds up).
+So with the default window of 0, a lone client doesn't wait at all,
+and batches only form while writes are already in flight. A longer
+window trades each INSERT's latency for bigger batches.
+
+Batches are written unordered, and a backend's WriteErrors are handed
+back to just the sessions whose rows failed. If a batch is turned down
+before anything was written (NothingWritten), each session tries its
+own rows again, on its own. Any other error might have come after some
+(or all) of the rows were written, so everyone in the batch gets it.
+"""
+
+import time
+import bisect
+import threading
+
+import metrics
+from backend import WriteErrors, NothingWritten
+
+
+# How long (in seconds) a batch waits for more rows
+WINDOW = 0.0
+
+# The most rows to write at once
+MAX_BATCH = 1000
+
+
+
+class Batch (object):
+    """ Rows waiting to be written together. """
+
+    def __init__ (self):
+        self.documents = []
+        # Where each session's rows start in the documents
+        self.starts = []
+        # Closed to new rows (once it's being written)
+        self.closed = False
+        self.done = threading.Event()
+        # The error writing the whole batch, or each session's
+        # WriteErrors (by where its rows start)
+        self.error = None
+        self.errors = {}
+
+
+
+class WriteCoalescer (object):
+    """ Gathers INSERTs into the same table into bulk writes. """
+
+    def __init__ (self, window=WINDOW, max_batch=MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        # The batch taking new rows, and the tables being written to,
+        # by (database, table)
+        self.open = {}
+        self.writing = set()
+
+
+    def insert (self, backend, table, documents):
+        """
+        Inserts some documents along with everyone else's, returning
+        once they've been written (and raising WriteErrors, if any of
+        this session's couldn't be).
+        """
+
+        key = (backend.database, table)
+        with self.condition:
+            batch = self.open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.open[key] = Batch()
+            start = len(batch.documents)
+            batch.starts.append(start)
+            # (Copies, since writing can change the documents, eg.
+            # pymongo adds their _ids, and a retry needs them as sent)
+            batch.documents.extend(dict(doc) for doc in documents)
+            if len(batch.documents) >= self.max_batch:
+                self.close(key, batch)
+            if leader:
+                self.gather(key, batch)
+
+        if not leader:
+            batch.done.wait()
+        else:
+            try:
+                backend.insert(table, batch.documents)
+            except WriteErrors, e:
+                batch.errors = self.split(batch, e)
+            except Exception, e:
+                batch.error = e
+            metrics.write_batches.inc()
+            metrics.write_batch_rows.inc(len(batch.documents))
+            with self.condition:
+                self.writing.discard(key)
+                self.condition.notify_all()
+            batch.done.set()
+
+        if batch.error is not None:
+            if len(batch.starts) == 1 or \
+               not isinstance(batch.error, NothingWritten):
+                raise batch.error
+            return backend.insert(table, documents)
+        if start in batch.errors:
+            raise batch.errors[start]
+        return len(documents)
+
+
+    def split (self, batch, error):
+        """ Splits a batch's WriteErrors up by session (by start). """
+
+        errors = {}
+        for index, value in error.errors.items():
+            start = batch.starts[bisect.bisect_right(batch.starts, index) - 1]
+            errors.setdefault(start, {})[index - start] = value
+        return dict((start, WriteErrors(session_errors))
+                    for start, session_errors in errors.items())
+
+
+    def gather (self, key, batch):
+        """
+        Waits (as the batch's leader, holding the condition) for the
+        batch to be ready to write, then marks the table as being
+        written to.
+        """
+
+        deadline = time.time() + self.window
+        while not batch.closed:
+            remaining = deadline - time.time()
+            if remaining > 0:
+                self.condition.wait(remaining)
+            elif key in self.writing:
+                # Only one write per table at a time,
+                # and the next batch builds up meanwhile
+                self.condition.wait()
+            else:
+                self.close(key, batch)
+        while key in self.writing:
+            self.condition.wait()
+        self.writing.add(key)
+
+
+    def close (self, key, batch):
+        """ Stops a batch from taking any more rows. """
+
+        batch.closed = True
+        if self.open.get(key) is batch:
+            del self.open[key]
+        self.condition.notify_all()
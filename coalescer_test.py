@@ -0,0 +1,179 @@
+import time
+import threading
+import unittest
+from backend import WriteErrors, NothingWritten
+from coalescer import WriteCoalescer
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+
+class CountingBackend(MemoryBackend):
+    """ Counts (and takes its time over) its inserts. """
+    def __init__(self, *args, **kwargs):
+        MemoryBackend.__init__(self, *args, **kwargs)
+        self.batches = []
+        self.fail = False
+
+    def insert(self, table, documents):
+        self.batches.append(len(documents))
+        time.sleep(0.01)
+        if self.fail:
+            raise IOError("write failed")
+        MemoryBackend.insert(self, table, documents)
+
+class PartialBackend(CountingBackend):
+    """
+    Fails batches after writing them (like a write concern error), and
+    turns down batches with a bad row before writing anything.
+    """
+    def __init__(self, *args, **kwargs):
+        CountingBackend.__init__(self, *args, **kwargs)
+        self.resent = []
+
+    def insert(self, table, documents):
+        self.batches.append(len(documents))
+        time.sleep(0.01)
+        for i, doc in enumerate(documents):
+            # (As pymongo's insert_many does)
+            if "_id" in doc:
+                self.resent.append(doc)
+            doc["_id"] = "%d.%d" % (len(self.batches), i)
+        if any(doc["a"] == "bad" for doc in documents):
+            raise NothingWritten("bad row")
+        MemoryBackend.insert(self, table, documents)
+        if len(documents) > 1:
+            raise IOError("write concern failed")
+
+class UniqueBackend(CountingBackend):
+    """ Has a unique index on a, skipping (and reporting) duplicates. """
+    def insert(self, table, documents):
+        self.batches.append(len(documents))
+        time.sleep(0.01)
+        seen = set(doc["a"] for doc in self.scan(table))
+        errors = {}
+        for i, doc in enumerate(documents):
+            if doc["a"] in seen:
+                errors[i] = (11000, "E11000 duplicate key: %r" % doc["a"])
+            else:
+                seen.add(doc["a"])
+                MemoryBackend.insert(self, table, [doc])
+        if errors:
+            raise WriteErrors(errors)
+        return len(documents)
+
+class CoalescerTests(unittest.TestCase):
+    def insert_concurrently(self, writes, backend, n):
+        errors = []
+        def insert(i):
+            try:
+                writes.insert(backend, "t", [{"a": i}])
+            except (IOError, WriteErrors, NothingWritten), e:
+                errors.append(e)
+        threads = [threading.Thread(target=insert, args=(i,))
+                   for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_batches(self):
+        """ Concurrent inserts should be written in a few bulk inserts. """
+        backend = CountingBackend()
+        errors = self.insert_concurrently(WriteCoalescer(0.005), backend, 20)
+        self.assertEqual([], errors)
+        self.assertEqual(20, sum(backend.batches))
+        self.assertTrue(len(backend.batches) < 20)
+        self.assertEqual(range(20), sorted(doc["a"]
+                                           for doc in backend.scan("t")))
+
+    def test_max_batch(self):
+        """ Batches shouldn't get bigger than max_batch. """
+        backend = CountingBackend()
+        self.insert_concurrently(WriteCoalescer(0.05, 4), backend, 12)
+        self.assertEqual(12, sum(backend.batches))
+        self.assertTrue(max(backend.batches) <= 4)
+
+    def test_errors(self):
+        """ Everyone in a failed batch should get its error. """
+        backend = CountingBackend()
+        backend.fail = True
+        errors = self.insert_concurrently(WriteCoalescer(0.005), backend, 5)
+        self.assertEqual(5, len(errors))
+
+    def test_partly_written(self):
+        """ A batch that might have been written shouldn't be retried. """
+        backend = PartialBackend()
+        errors = self.insert_concurrently(WriteCoalescer(0.05), backend, 6)
+        self.assertTrue(max(backend.batches) > 1)
+        self.assertEqual(6, sum(backend.batches))
+        self.assertEqual(6, len(errors))
+        self.assertEqual(range(6), sorted(doc["a"]
+                                          for doc in backend.scan("t")))
+
+    def test_nothing_written(self):
+        """ Batches turned down before writing should be retried singly. """
+        backend = PartialBackend()
+        writes = WriteCoalescer(0.05)
+        errors = []
+        def insert_bad():
+            try:
+                writes.insert(backend, "t", [{"a": "bad"}])
+            except NothingWritten, e:
+                errors.append(e)
+        thread = threading.Thread(target=insert_bad)
+        thread.start()
+        # (Single rows, so none of the retries fail after writing)
+        self.assertEqual([], self.insert_concurrently(writes, backend, 4))
+        thread.join()
+        self.assertEqual(1, len(errors))
+        self.assertTrue(max(backend.batches) > 1)
+        self.assertEqual(range(4), sorted(doc["a"]
+                                          for doc in backend.scan("t")))
+        # The retries got the documents as they were sent
+        self.assertEqual([], backend.resent)
+
+    def test_write_errors(self):
+        """ Only the sessions whose rows failed should get an error. """
+        backend = UniqueBackend()
+        backend.insert("t", [{"a": 3}])
+        errors = self.insert_concurrently(WriteCoalescer(0.05), backend, 6)
+        self.assertEqual(1, len(errors))
+        self.assertEqual(1062, errors[0].code)
+        self.assertEqual({0: (11000, "E11000 duplicate key: 3")},
+                         errors[0].errors)
+        self.assertTrue(max(backend.batches) > 1)
+        self.assertEqual(range(6), sorted(doc["a"]
+                                          for doc in backend.scan("t")))
+
+    def test_server(self):
+        """ INSERTs through the server should be coalesced, and readable. """
+        backend = CountingBackend()
+        server = MySQLServer(("127.0.0.1", 0), backend,
+                             coalescer=WriteCoalescer())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = MySQLClient(port=server.server_address[1])
+            client.query("insert into t (a) values (1)")
+            client.query("insert into t (a) values (2), (3)")
+            # A failed row gets an ERR
+            backend.fail = True
+            try:
+                client.query("insert into t (a) values (4)")
+                self.fail("The failed insert got an OK")
+            except MySQLError:
+                pass
+            backend.fail = False
+            self.assertEqual((["a"], [["1"], ["2"], ["3"]]),
+                             client.query("select a from t"))
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
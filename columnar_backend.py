@@ -0,0 +1,261 @@
+"""
+A backend serving read-only tables from memory-mapped columnar files.
+
+Each table is a directory (<directory>/<database>/<table>/) with:
+    schema.json     {"rows": n, "columns": [{"name": ..., "type": ...}]}
+    <column>.col    int64/float64 columns: a little-endian array
+    <column>.off    string columns: n + 1 int64 offsets into...
+    <column>.heap   ...the string heap (UTF-8 bytes)
+    <column>.null   columns with NULLs: a byte per row, 1 for NULL
+                    (the NULL rows hold 0, or "", in the other files)
+
+The files are memory mapped, and conditions are checked by reading
+values straight out of the maps, one column at a time, so only the
+values actually looked at (and the rows actually returned) ever
+become Python objects.
+"""
+
+import os
+import json
+import mmap
+import struct
+import itertools
+import threading
+
+from backend import Backend, NoSuchTable, FILTER, PROJECTION, LIMIT
+from conditions import matches_field, MISSING
+
+
+# Struct formats for each fixed-width column type
+FIXED_TYPES = {
+    "int64": struct.Struct("< q"),
+    "float64": struct.Struct("< d"),
+}
+OFFSET = struct.Struct("< q")
+
+# What the .null files hold for each row
+NULL = "\x01"
+NOT_NULL = "\x00"
+
+
+
+def write_table (directory, name, columns, rows):
+    """
+    Writes a table out in the columnar format,
+    into a database's directory.
+
+    columns is a list of (name, type) pairs ("int64", "float64"
+    or "string"), and rows is a list of dicts.
+    """
+
+    path = os.path.join(directory, name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for column, kind in columns:
+        values = [row.get(column) for row in rows]
+        if None in values:
+            with open(os.path.join(path, column + ".null"), "wb") as f:
+                f.write("".join(NULL if value is None else NOT_NULL
+                                for value in values))
+        if kind in FIXED_TYPES:
+            with open(os.path.join(path, column + ".col"), "wb") as f:
+                packer = FIXED_TYPES[kind]
+                for value in values:
+                    f.write(packer.pack(value or 0))
+        else:
+            offsets = [0]
+            with open(os.path.join(path, column + ".heap"), "wb") as f:
+                for value in values:
+                    if isinstance(value, unicode):
+                        value = value.encode("utf-8")
+                    value = "" if value is None else str(value)
+                    f.write(value)
+                    offsets.append(offsets[-1] + len(value))
+            with open(os.path.join(path, column + ".off"), "wb") as f:
+                for offset in offsets:
+                    f.write(OFFSET.pack(offset))
+    with open(os.path.join(path, "schema.json"), "w") as f:
+        json.dump({
+            "rows": len(rows),
+            "columns": [{"name": c, "type": t} for c, t in columns]
+        }, f)
+
+
+
+def _map (path):
+    """ Memory maps a file (read only). Empty files can't be mapped. """
+
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+
+class Column (object):
+    """ A memory-mapped column. """
+
+    def __init__ (self, path, name, kind):
+        self.name = name
+        self.kind = kind
+        if kind in FIXED_TYPES:
+            self.data = _map(os.path.join(path, name + ".col"))
+            self.struct = FIXED_TYPES[kind]
+        else:
+            self.offsets = _map(os.path.join(path, name + ".off"))
+            self.heap = _map(os.path.join(path, name + ".heap"))
+        # Which rows are NULL (None if none of them are)
+        self.nulls = None
+        if os.path.exists(os.path.join(path, name + ".null")):
+            self.nulls = _map(os.path.join(path, name + ".null"))
+
+
+    def get (self, row):
+        """ Reads a single value. """
+
+        if self.nulls is not None and self.nulls[row] == NULL:
+            return None
+        if self.kind in FIXED_TYPES:
+            return self.struct.unpack_from(self.data, row * self.struct.size)[0]
+        start, = OFFSET.unpack_from(self.offsets, row * 8)
+        end, = OFFSET.unpack_from(self.offsets, row * 8 + 8)
+        return self.heap[start:end]
+
+
+    def filter (self, rows, condition):
+        """ Gets the rows (from a list of row numbers) matching a condition. """
+
+        # Equality on strings can compare bytes without decoding anything
+        if self.kind == "string" and isinstance(condition, str):
+            size = len(condition)
+            offsets, heap, nulls = self.offsets, self.heap, self.nulls
+            matching = []
+            for row in rows:
+                start, = OFFSET.unpack_from(offsets, row * 8)
+                end, = OFFSET.unpack_from(offsets, row * 8 + 8)
+                if end - start == size and heap[start:end] == condition \
+                   and (nulls is None or nulls[row] != NULL):
+                    matching.append(row)
+            return matching
+
+        get = self.get
+        return [row for row in rows if matches_field(get(row), condition)]
+
+
+
+class ColumnarTable (object):
+    """ A table of memory-mapped columns. """
+
+    def __init__ (self, path):
+        with open(os.path.join(path, "schema.json")) as f:
+            schema = json.load(f)
+        self.rows = schema["rows"]
+        self.columns = {}
+        self.names = []
+        for column in schema["columns"]:
+            name = str(column["name"])
+            self.names.append(name)
+            self.columns[name] = Column(path, name, column["type"])
+
+
+    def select (self, conditions, rows=None):
+        """
+        Gets the numbers of the rows matching some conditions
+        (out of the given row numbers, or all of them).
+        """
+
+        if rows is None:
+            rows = xrange(self.rows)
+        for field, condition in conditions.items():
+            if field == "$and":
+                for c in condition:
+                    rows = self.select(c, rows)
+            elif field == "$or":
+                rows = list(rows)
+                matching = set()
+                for c in condition:
+                    matching.update(self.select(c, rows))
+                rows = sorted(matching)
+            elif field in self.columns:
+                rows = self.columns[field].filter(rows, condition)
+            elif not matches_field(MISSING, condition):
+                # Every row is missing this column
+                rows = []
+        return rows
+
+
+    def row (self, row, columns=None):
+        """ Reads a row into a dict. """
+
+        return dict((name, self.columns[name].get(row))
+                    for name in (columns or self.names)
+                    if name in self.columns)
+
+
+
+class ColumnarBackend (Backend):
+    """ Serves tables from memory-mapped columnar files. """
+
+    # Sorting is left to the proxy
+    capabilities = frozenset([FILTER, PROJECTION, LIMIT])
+
+    def __init__ (self, directory, database="pysql_test", _shared=None):
+        self.directory = directory
+        self.database = database
+        # Opened tables (and the lock for opening them), shared by the
+        # backends for each database
+        self._shared = _shared or {
+            "tables": {},
+            "lock": threading.Lock()
+        }
+        self._tables = self._shared["tables"]
+        self._lock = self._shared["lock"]
+
+
+    def use (self, database):
+        return ColumnarBackend(self.directory, database, self._shared)
+
+
+    def table (self, name):
+        """ Gets a table, mapping its files the first time. """
+
+        path = os.path.join(self.directory, self.database, name)
+        if path not in self._tables:
+            if not os.path.exists(os.path.join(path, "schema.json")):
+                raise NoSuchTable(self.database, name)
+            with self._lock:
+                if path not in self._tables:
+                    self._tables[path] = ColumnarTable(path)
+        return self._tables[path]
+
+
+    def databases (self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+
+    def tables (self):
+        path = os.path.join(self.directory, self.database)
+        if not os.path.isdir(path):
+            return []
+        return sorted(
+            name for name in os.listdir(path)
+            if os.path.exists(os.path.join(path, name, "schema.json"))
+        )
+
+
+    def scan (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, **options):
+        table = self.table(table)
+        rows = table.select(conditions or {})
+        if offset or limit is not None:
+            stop = None if limit is None else offset + limit
+            rows = itertools.islice(rows, offset, stop)
+        return (table.row(row, columns) for row in rows)
+
+
+    def stats (self, table):
+        table = self.table(table)
+        return {"rows": table.rows, "size": None, "indexes": 0}
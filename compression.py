@@ -0,0 +1,138 @@
+"""
+The MySQL compressed protocol (CLIENT_COMPRESS).
+
+Once both sides agree on it, everything after the login goes
+inside compressed frames, each with a 7 byte header:
+    3 bytes     length of the (compressed) payload
+    1 byte      frame sequence number
+    3 bytes     length of the payload uncompressed (0 if it isn't)
+The frames carry ordinary MySQL packets, which can be split across
+frames or packed several to a frame.
+"""
+
+import struct
+import zlib
+
+
+# The capability flag for the compressed protocol
+CLIENT_COMPRESS = 0x0020
+
+# Payloads smaller than this go uncompressed (as MySQL does),
+# since zlib won't save anything on them
+MIN_COMPRESS_LENGTH = 50
+
+# zlib's compression level, trading CPU for bandwidth
+COMPRESSION_LEVEL = 6
+
+# The biggest payload a frame can hold
+MAX_FRAME_LENGTH = 0xFFFFFF
+
+HEADER = struct.Struct("< H B B H B")
+
+
+
+class CompressedSocket (object):
+    """
+    Wraps a socket to speak the compressed protocol, so the code
+    reading and writing packets doesn't need to know about it.
+    """
+
+    def __init__ (self, sock, min_length=MIN_COMPRESS_LENGTH,
+                  level=COMPRESSION_LEVEL):
+        self.socket = sock
+        self.min_length = min_length
+        self.level = level
+        # The next frame's sequence number
+        self.sequence = 0
+        # Decompressed data that hasn't been read yet
+        self.buffer = ""
+        # Bytes before and after compression (for the stats)
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+
+    def reset (self):
+        """ Starts a new command (the frame numbers start over). """
+
+        self.sequence = 0
+
+
+    def recv_exactly (self, size):
+        """ Reads exactly size bytes off the underlying socket. """
+
+        data = ""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+    def read_frame (self):
+        """ Reads a frame, adding its payload to the buffer. """
+
+        header = self.recv_exactly(7)
+        if len(header) < 7:
+            return False
+        low, high, sequence, raw_low, raw_high = HEADER.unpack(header)
+        length = low + (high << 16)
+        raw_length = raw_low + (raw_high << 16)
+        payload = self.recv_exactly(length)
+        if len(payload) < length:
+            return False
+        # Replies carry on from the other side's numbering
+        self.sequence = (sequence + 1) & 0xFF
+        if raw_length:
+            payload = zlib.decompress(payload)
+        self.buffer += payload
+        return True
+
+
+    def recv (self, size):
+        """ Reads up to size bytes of (decompressed) data. """
+
+        if size <= 0:
+            return ""
+        if not self.buffer and not self.read_frame():
+            return ""
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+    def frame (self, data):
+        """ Makes a frame out of some data, compressing it if it's worth it. """
+
+        raw_length = 0
+        if len(data) >= self.min_length:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                raw_length = len(data)
+                data = compressed
+        length = len(data)
+        header = HEADER.pack(length & 0xFFFF, length >> 16, self.sequence,
+                             raw_length & 0xFFFF, raw_length >> 16)
+        self.sequence = (self.sequence + 1) & 0xFF
+        return header + data
+
+
+    def sendall (self, data):
+        """ Sends some data, in as few frames as it'll fit in. """
+
+        frames = []
+        # Compressed payloads could come out a little bigger than
+        # the data (if it won't compress), so split well under the max
+        step = MAX_FRAME_LENGTH - 1024
+        for start in xrange(0, len(data), step):
+            frames.append(self.frame(data[start:start + step]))
+        frames = "".join(frames)
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(frames)
+        self.socket.sendall(frames)
+
+    send = sendall
+
+
+    def __getattr__ (self, name):
+        # Everything else (close, settimeout, ...) goes to the socket
+        return getattr(self.socket, name)
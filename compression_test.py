@@ -0,0 +1,44 @@
+import socket
+import unittest
+from compression import CompressedSocket
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.client = CompressedSocket(a)
+        self.server = CompressedSocket(b)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def read(self, sock, size):
+        data = ""
+        while len(data) < size:
+            data += sock.recv(size - len(data))
+        return data
+
+    def test_round_trip(self):
+        """ Big payloads should get compressed, small ones shouldn't. """
+        big = "SELECT name FROM people;" * 100
+        self.client.sendall(big)
+        self.assertEqual(big, self.read(self.server, len(big)))
+        self.assertTrue(self.client.wire_bytes < len(big) / 10)
+
+        self.server.sendall("tiny")
+        self.assertEqual(11, self.server.wire_bytes)
+        self.assertEqual("tiny", self.read(self.client, 4))
+
+    def test_sequence(self):
+        """ Replies should carry on from the other side's numbering. """
+        self.client.sendall("a")
+        self.client.sendall("b")
+        self.read(self.server, 2)
+        self.assertEqual(2, self.server.sequence)
+        self.client.reset()
+        self.assertEqual(0, self.client.sequence)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Evaluates MongoDB-style query documents against Python dicts.
+
+The WHERE parser produces MongoDB query documents, so this lets
+anything that isn't MongoDB (eg. the benchmark's stand-in)
+filter rows the same way.
+"""
+
+import operator
+from collections import Mapping
+
+import patterns
+
+
+# Comparison operators, and how to check them in Python
+COMPARISONS = {
+    "$ne": operator.ne,
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+MISSING = object()
+
+
+
+def get_path (doc, path):
+    """
+    Gets a (possibly dotted) field from a document (a dict, or a raw
+    BSON document). Numbers in the path index into arrays (eg. tags.0).
+    """
+
+    for part in path.split("."):
+        if isinstance(doc, (dict, Mapping)) and part in doc:
+            doc = doc[part]
+        elif isinstance(doc, list) and part.isdigit() and int(part) < len(doc):
+            doc = doc[int(part)]
+        else:
+            return MISSING
+    return doc
+
+
+def matches (doc, conditions):
+    """ Checks whether a document matches a query document. """
+
+    for field, condition in conditions.items():
+        if field == "$and":
+            if not all(matches(doc, c) for c in condition):
+                return False
+        elif field == "$or":
+            if not any(matches(doc, c) for c in condition):
+                return False
+        elif not matches_field(get_path(doc, field), condition):
+            return False
+    return True
+
+
+def matches_field (value, condition):
+    """ Checks a single field's value against its condition. """
+
+    # Plain values are an equality check
+    if not isinstance(condition, dict) or \
+       not all(key.startswith("$") for key in condition):
+        return value == condition
+
+    for op, argument in condition.items():
+        if op == "$in":
+            if value not in argument:
+                return False
+        elif op == "$nin":
+            if value in argument:
+                return False
+        elif op == "$exists":
+            if (value is not MISSING) != bool(argument):
+                return False
+        elif op == "$regex":
+            # (Compiled once, rather than for every row)
+            regex = argument if hasattr(argument, "search") else \
+                    patterns.compiled(argument, condition.get("$options"))
+            if not isinstance(value, basestring) or not regex.search(value):
+                return False
+        elif op == "$options":
+            continue
+        elif op in COMPARISONS:
+            # Missing fields only ever match $ne
+            if value is MISSING:
+                if op != "$ne":
+                    return False
+            elif not COMPARISONS[op](value, argument):
+                return False
+        else:
+            raise ValueError("Unsupported query operator: %s" % op)
+    return True
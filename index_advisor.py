@@ -0,0 +1,265 @@
+"""
+Recommends secondary indexes from the queries going through the proxy.
+
+Every SELECT's conditions and ORDER BY are reduced to a fingerprint
+(which fields are matched exactly, which by range, and the sort),
+counted along with their latency, and compared with the indexes the
+backend already has. The uncovered shapes costing the most time come
+out on top of SHOW INDEX ADVICE.
+"""
+
+import threading
+import logging
+
+
+log = logging.getLogger("pysql.index_advisor")
+
+# Create the recommended index by itself once a query shape has been
+# seen this many times (None never creates any)
+AUTO_CREATE_THRESHOLD = None
+
+# Operators that make for a range scan (rather than an exact match)
+RANGE_OPERATORS = frozenset(["$gt", "$gte", "$lt", "$lte", "$ne", "$nin"])
+
+
+
+class QueryShape (object):
+    """ The fields a query filters and sorts on. """
+
+    __slots__ = ("equality", "range", "sort")
+
+    def __init__ (self, equality=(), range=(), sort=()):
+        self.equality = tuple(sorted(set(equality)))
+        self.range = tuple(sorted(set(range) - set(equality)))
+        self.sort = tuple(sort)
+
+
+    def key (self):
+        return (self.equality, self.range, self.sort)
+
+
+    def fingerprint (self):
+        """ A readable form of the shape, eg. "eq(city) range(age)". """
+
+        parts = []
+        if self.equality:
+            parts.append("eq(%s)" % ", ".join(self.equality))
+        if self.range:
+            parts.append("range(%s)" % ", ".join(self.range))
+        if self.sort:
+            parts.append("sort(%s)" % ", ".join(
+                "%s%s" % (field, " desc" if direction < 0 else "")
+                for field, direction in self.sort))
+        return " ".join(parts) or "scan"
+
+
+    def index (self):
+        """
+        The index that would serve this shape best, as a list of
+        (field, direction). Follows the equality, sort, range rule:
+        exact matches first, then the sort, then the range fields.
+        """
+
+        fields = [(field, 1) for field in self.equality]
+        used = set(self.equality)
+        for field, direction in self.sort:
+            if field not in used:
+                fields.append((field, direction))
+                used.add(field)
+        for field in self.range:
+            if field not in used:
+                fields.append((field, 1))
+                used.add(field)
+        return fields
+
+
+
+def shapes (conditions, order=None):
+    """
+    Gets the query shapes for some conditions.
+
+    Each branch of an $or needs an index of its own,
+    so those come out as separate shapes.
+    """
+
+    equality = []
+    ranges = []
+    branches = []
+    for field, condition in (conditions or {}).items():
+        if field == "$and":
+            for c in condition:
+                for shape in shapes(c):
+                    equality += shape.equality
+                    ranges += shape.range
+        elif field == "$or":
+            branches.append(condition)
+        elif field.startswith("$"):
+            continue
+        elif isinstance(condition, dict) and \
+             set(condition) & RANGE_OPERATORS:
+            ranges.append(field)
+        elif isinstance(condition, dict) and "$regex" in condition:
+            # (Regexes without a prefix range can't use an index)
+            continue
+        else:
+            # Plain values and $in lists are both exact matches
+            equality.append(field)
+
+    base = QueryShape(equality, ranges, order or ())
+    if not branches:
+        return [base]
+    result = []
+    for branch in branches:
+        for condition in branch:
+            for shape in shapes(condition):
+                result.append(QueryShape(
+                    base.equality + shape.equality,
+                    base.range + shape.range,
+                    base.sort
+                ))
+    return result
+
+
+def covered (index, indexes):
+    """
+    Checks whether an existing index already serves a recommended one
+    (ie. the recommended fields are a prefix of an existing index).
+    """
+
+    fields = [field for field, direction in index]
+    for existing in indexes.values():
+        existing = [field for field, direction in existing]
+        if existing[:len(fields)] == fields:
+            return True
+    return False
+
+
+
+class Recommendation (object):
+    """ A recommended index, and the queries that would use it. """
+
+    def __init__ (self, table, index):
+        self.table = table
+        self.index = index
+        self.queries = 0
+        self.total_time = 0.0
+        self.fingerprints = set()
+
+    @property
+    def name (self):
+        return "_".join("%s_%d" % (field, direction)
+                        for field, direction in self.index)
+
+
+
+class IndexAdvisor (object):
+    """ Keeps track of query shapes, and recommends indexes for them. """
+
+    def __init__ (self, auto_create_threshold=AUTO_CREATE_THRESHOLD):
+        self.lock = threading.Lock()
+        # (database, table, shape key) -> [shape, count, total time]
+        self.shapes = {}
+        self.auto_create_threshold = auto_create_threshold
+        self.created = set()
+
+
+    def record (self, backend, table, conditions, order, duration):
+        """ Records a query's shape(s) and how long it took. """
+
+        for shape in shapes(conditions, order):
+            if not shape.equality and not shape.range and not shape.sort:
+                continue
+            key = (backend.database, table, shape.key())
+            with self.lock:
+                entry = self.shapes.get(key)
+                if entry is None:
+                    entry = self.shapes[key] = [shape, 0, 0.0]
+                entry[1] += 1
+                entry[2] += duration
+                count = entry[1]
+            threshold = self.auto_create_threshold
+            if threshold is not None and count == threshold:
+                self.create(backend, table, shape.index())
+
+
+    def recommend (self, backend):
+        """
+        Gets the recommended indexes for a backend's database,
+        most costly (total query time) first.
+        """
+
+        with self.lock:
+            entries = [(table, shape, count, total)
+                       for (database, table, key), (shape, count, total)
+                       in self.shapes.items()
+                       if database == backend.database]
+
+        existing = {}
+        recommendations = {}
+        for table, shape, count, total in entries:
+            if table not in existing:
+                try:
+                    existing[table] = backend.indexes(table)
+                except Exception:
+                    existing[table] = {}
+            index = shape.index()
+            if covered(index, existing[table]):
+                continue
+            key = (table, tuple(index))
+            if key not in recommendations:
+                recommendations[key] = Recommendation(table, index)
+            recommendation = recommendations[key]
+            recommendation.queries += count
+            recommendation.total_time += total
+            recommendation.fingerprints.add(shape.fingerprint())
+
+        return sorted(recommendations.values(),
+                      key=lambda r: r.total_time, reverse=True)
+
+
+    def create (self, backend, table, index):
+        """ Creates an index in the background (once). """
+
+        key = (backend.database, table, tuple(index))
+        with self.lock:
+            if key in self.created:
+                return
+            self.created.add(key)
+
+        def run ():
+            try:
+                if not covered(index, backend.indexes(table)):
+                    log.info("Creating index on %s: %s", table, index)
+                    backend.create_index(table, index)
+            except Exception:
+                log.exception("Couldn't create index on %s", table)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+    def reset (self):
+        with self.lock:
+            self.shapes.clear()
+
+
+def advice_rows (recommendations):
+    """ Rows for SHOW INDEX ADVICE. """
+
+    return [
+        [r.table, r.name,
+         ", ".join("%s %s" % (field, "DESC" if direction < 0 else "ASC")
+                   for field, direction in r.index),
+         str(r.queries), "%.6f" % r.total_time,
+         "%.6f" % (r.total_time / r.queries),
+         "; ".join(sorted(r.fingerprints))]
+        for r in recommendations
+    ]
+
+ADVICE_COLUMNS = ["Table", "Index_name", "Columns", "Queries", "Total_time",
+                  "Avg_time", "Query_shapes"]
+
+
+# The advisor for the whole server
+advisor = IndexAdvisor()
@@ -0,0 +1,37 @@
+import unittest
+from index_advisor import IndexAdvisor, shapes
+from memory_backend import MemoryBackend
+
+class IndexAdvisorTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.backend.insert("people", [{"name": "Jon", "age": 25}])
+
+    def test_shapes(self):
+        """ Shapes should follow the equality, sort, range rule. """
+        shape, = shapes({"city": "NYC", "age": {"$gt": 20}}, [("name", -1)])
+        self.assertEqual("eq(city) range(age) sort(name desc)",
+                         shape.fingerprint())
+        self.assertEqual([("city", 1), ("name", -1), ("age", 1)],
+                         shape.index())
+        # Each $or branch gets a shape of its own
+        self.assertEqual(["eq(age, city)", "eq(city, name)"], sorted(
+            s.fingerprint() for s in shapes(
+                {"city": "NYC", "$or": [{"name": "Jon"}, {"age": 25}]})))
+
+    def test_recommend(self):
+        """ Uncovered shapes should be ranked by their total time. """
+        advisor = IndexAdvisor()
+        for i in range(3):
+            advisor.record(self.backend, "people", {"name": "Jon"}, None, 0.1)
+        advisor.record(self.backend, "people", {"age": {"$lt": 30}}, None, 1)
+        self.assertEqual(["age_1", "name_1"], [
+            r.name for r in advisor.recommend(self.backend)])
+        self.backend.create_index("people", "age")
+        advice, = advisor.recommend(self.backend)
+        self.assertEqual((3, [("name", 1)]), (advice.queries, advice.index))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
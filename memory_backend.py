@@ -0,0 +1,351 @@
+"""
+An in-memory backend, with hash and sorted secondary indexes.
+
+Needs nothing outside the standard library, so it works as a cache tier
+in front of a slower backend, and as the backend for tests and benchmarks.
+"""
+
+import bisect
+import itertools
+import threading
+
+from backend import Backend, FILTER, PROJECTION, SORT, LIMIT, \
+                    sort_documents, project
+from conditions import matches, get_path
+
+
+# Range operators a sorted index can answer
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+# Sorts after every row id (which are ints), for bisecting (value, id) pairs
+_MAX_ID = float("inf")
+
+
+
+class HashIndex (object):
+    """ Maps each value of a field to the ids of the rows that have it. """
+
+    kind = "hash"
+
+    def __init__ (self, field):
+        self.field = field
+        self.entries = {}
+        # Rows whose value can't be hashed (eg. lists), which
+        # have to be checked by hand
+        self.unhashable = set()
+
+
+    def add (self, row_id, doc):
+        value = get_path(doc, self.field)
+        try:
+            self.entries.setdefault(value, set()).add(row_id)
+        except TypeError:
+            self.unhashable.add(row_id)
+
+
+    def remove (self, row_id, doc):
+        value = get_path(doc, self.field)
+        try:
+            ids = self.entries.get(value)
+        except TypeError:
+            self.unhashable.discard(row_id)
+            return
+        if ids:
+            ids.discard(row_id)
+            if not ids:
+                del self.entries[value]
+
+
+    def lookup (self, value):
+        """ Gets the ids of the rows that might have a value. """
+
+        try:
+            return self.entries.get(value, set()) | self.unhashable
+        except TypeError:
+            return None
+
+
+
+class SortedIndex (object):
+    """
+    Keeps (value, id) pairs for a field in sorted order,
+    for range queries and ordered scans.
+
+    A sorted array searched with bisect: inserts cost a memmove,
+    but lookups and ordered reads are as cheap as they get in Python.
+    """
+
+    kind = "sorted"
+
+    def __init__ (self, field):
+        self.field = field
+        self.keys = []
+
+
+    def add (self, row_id, doc):
+        bisect.insort(self.keys, (get_path(doc, self.field), row_id))
+
+
+    def remove (self, row_id, doc):
+        key = (get_path(doc, self.field), row_id)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+
+    def lookup (self, value):
+        return self.range({"$gte": value, "$lte": value})
+
+
+    def range (self, condition):
+        """ Gets the ids of the rows in a range, in order. """
+
+        low, high = 0, len(self.keys)
+        for op, value in condition.items():
+            if op == "$gte":
+                low = max(low, bisect.bisect_left(self.keys, (value, -1)))
+            elif op == "$gt":
+                low = max(low, bisect.bisect_right(self.keys, (value, _MAX_ID)))
+            elif op == "$lte":
+                high = min(high, bisect.bisect_right(self.keys, (value, _MAX_ID)))
+            elif op == "$lt":
+                high = min(high, bisect.bisect_left(self.keys, (value, -1)))
+        return [row_id for value, row_id in self.keys[low:high]]
+
+
+    def ordered (self, direction=1):
+        """ Gets all the row ids, ordered by the field. """
+
+        ids = [row_id for value, row_id in self.keys]
+        if direction < 0:
+            ids.reverse()
+        return ids
+
+
+
+class MemoryTable (object):
+    """ A table of documents, with its indexes. """
+
+    def __init__ (self, name):
+        self.name = name
+        self.rows = {}
+        self.indexes = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+
+    def insert (self, documents):
+        with self.lock:
+            for doc in documents:
+                doc = dict(doc)
+                row_id = next(self.ids)
+                doc.setdefault("_id", row_id)
+                self.rows[row_id] = doc
+                for index in self.indexes.values():
+                    index.add(row_id, doc)
+        return len(documents)
+
+
+    def create_index (self, field, kind="sorted"):
+        """ Adds an index on a field ("hash" or "sorted"). """
+
+        index = (HashIndex if kind == "hash" else SortedIndex)(field)
+        with self.lock:
+            for row_id, doc in self.rows.items():
+                index.add(row_id, doc)
+            name = "%s_%s" % (field, kind)
+            self.indexes[name] = index
+        return name
+
+
+    def plan (self, conditions, order):
+        """
+        Picks the cheapest way to find the candidate rows.
+
+        Returns (row ids, whether they're already in order).
+        The ids might include rows that don't match; those get
+        filtered out afterwards.
+        """
+
+        best = None
+        for field, condition in conditions.items():
+            for index in self.indexes.values():
+                if index.field != field:
+                    continue
+                ids = self.lookup(index, condition)
+                if ids is not None and (best is None or len(ids) < len(best)):
+                    best = ids
+        if best is not None:
+            return best, False
+
+        # Read through a sorted index if it gives us the order for free
+        if order and len(order) == 1:
+            field, direction = order[0]
+            for index in self.indexes.values():
+                if index.kind == "sorted" and index.field == field:
+                    return index.ordered(direction), True
+
+        return self.rows.keys(), False
+
+
+    def lookup (self, index, condition):
+        """ Uses an index for a field's condition (None if it can't). """
+
+        if not isinstance(condition, dict):
+            return index.lookup(condition)
+        if "$in" in condition:
+            ids = set()
+            for value in condition["$in"]:
+                found = index.lookup(value)
+                if found is None:
+                    return None
+                ids.update(found)
+            return ids
+        ranges = dict((op, value) for op, value in condition.items()
+                      if op in RANGE_OPERATORS)
+        if ranges and index.kind == "sorted":
+            return index.range(ranges)
+        return None
+
+
+    def scan (self, conditions, order):
+        """ Gets the matching documents, in order. """
+
+        with self.lock:
+            ids, ordered = self.plan(conditions, order)
+            rows = self.rows
+            docs = [rows[i] for i in ids if i in rows]
+        if conditions:
+            docs = [doc for doc in docs if matches(doc, conditions)]
+        if order and not ordered:
+            sort_documents(docs, order)
+        return docs
+
+
+    def update (self, conditions, changes):
+        with self.lock:
+            count = 0
+            for row_id, doc in self.rows.items():
+                if matches(doc, conditions):
+                    for index in self.indexes.values():
+                        index.remove(row_id, doc)
+                    doc.update(changes)
+                    for index in self.indexes.values():
+                        index.add(row_id, doc)
+                    count += 1
+            return count
+
+
+    def delete (self, conditions):
+        with self.lock:
+            count = 0
+            for row_id, doc in self.rows.items():
+                if matches(doc, conditions):
+                    for index in self.indexes.values():
+                        index.remove(row_id, doc)
+                    del self.rows[row_id]
+                    count += 1
+            return count
+
+
+
+class MemoryBackend (Backend):
+    """ Serves tables kept in memory. """
+
+    capabilities = frozenset([FILTER, PROJECTION, SORT, LIMIT])
+
+    def __init__ (self, database="pysql_test", _shared=None):
+        # The backends for each database share the storage (and the
+        # lock for adding to it)
+        self._shared = _shared or {
+            "databases": {},
+            "lock": threading.Lock()
+        }
+        self._databases = self._shared["databases"]
+        self._lock = self._shared["lock"]
+        self.database = database
+
+
+    def use (self, database):
+        return MemoryBackend(database, self._shared)
+
+
+    def databases (self):
+        return sorted(set(self._databases) | set([self.database]))
+
+
+    def table (self, name, create=False):
+        """ Gets a table (or None if it doesn't exist and create is False). """
+
+        tables = self._databases.get(self.database)
+        if tables is None or name not in tables:
+            if not create:
+                return None
+            with self._lock:
+                tables = self._databases.setdefault(self.database, {})
+                if name not in tables:
+                    tables[name] = MemoryTable(name)
+        return tables[name]
+
+
+    def tables (self):
+        return sorted(self._databases.get(self.database, {}))
+
+
+    def scan (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, **options):
+        table = self.table(table)
+        if table is None:
+            return iter([])
+        docs = table.scan(conditions or {}, order)
+        if offset or limit is not None:
+            stop = None if limit is None else offset + limit
+            docs = docs[offset:stop]
+        if columns:
+            return (project(doc, columns) for doc in docs)
+        # Hand back copies, so the stored rows can't be changed
+        return (dict(doc) for doc in docs)
+
+
+    def insert (self, table, documents):
+        return self.table(table, create=True).insert(documents)
+
+
+    def update (self, table, conditions, changes):
+        table = self.table(table)
+        return table.update(conditions, changes) if table else 0
+
+
+    def delete (self, table, conditions):
+        table = self.table(table)
+        return table.delete(conditions) if table else 0
+
+
+    def stats (self, table):
+        table = self.table(table)
+        return {
+            "rows": len(table.rows) if table else 0,
+            "size": None,
+            "indexes": len(table.indexes) if table else 0,
+        }
+
+
+    def indexes (self, table):
+        table = self.table(table)
+        if table is None:
+            return {}
+        return dict((name, [(index.field, 1)])
+                    for name, index in table.indexes.items())
+
+
+    def create_index (self, table, fields, kind="sorted"):
+        """
+        Creates an index. Only single field indexes are supported,
+        so compound indexes get an index on their first field.
+        """
+
+        if isinstance(fields, basestring):
+            field = fields
+        else:
+            field = fields[0][0]
+        return self.table(table, create=True).create_index(field, kind)
@@ -0,0 +1,126 @@
+import unittest
+import threading
+import backend
+import parallel_scan
+from memory_backend import MemoryBackend
+from backend import Backend
+from parallel_scan import ParallelScan
+
+class MemoryBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.backend.insert("people", [
+            {"name": "Jon", "age": 25, "city": "NYC"},
+            {"name": "Ann", "age": 31, "city": "Worc"},
+            {"name": "Bob", "age": 19, "city": "NYC"},
+            {"name": "Eve", "age": 42},
+        ])
+
+    def names(self, *args, **kwargs):
+        return [doc["name"] for doc in self.backend.find("people", *args,
+                                                         **kwargs)]
+
+    def test_indexes(self):
+        """ Indexed and unindexed queries should give the same answers. """
+        queries = [
+            ({"city": "NYC"}, [("name", 1)]),
+            ({"age": {"$gte": 25, "$lt": 42}}, [("age", -1)]),
+            ({"city": {"$in": ["NYC", "Worc"]}, "age": {"$gt": 20}}, None),
+            ({}, [("age", 1)]),
+        ]
+        def run():
+            # Unordered results can come back in any order
+            return [self.names(c, order=o) if o else sorted(self.names(c))
+                    for c, o in queries]
+        before = run()
+        self.backend.create_index("people", "city", kind="hash")
+        self.backend.create_index("people", [("age", 1)])
+        self.assertEqual(before, run())
+        self.assertEqual([["Bob", "Jon"], ["Ann", "Jon"], ["Ann", "Jon"],
+                          ["Bob", "Jon", "Ann", "Eve"]], run())
+
+    def test_writes(self):
+        """ Updates and deletes should keep the indexes up to date. """
+        self.backend.create_index("people", "city", kind="hash")
+        self.assertEqual(2, self.backend.update("people", {"city": "NYC"},
+                                                {"city": "LA"}))
+        self.assertEqual([], self.names({"city": "NYC"}))
+        self.assertEqual(1, self.backend.delete("people", {"name": "Jon"}))
+        self.assertEqual(["Bob"], self.names({"city": "LA"}))
+        self.assertEqual(3, self.backend.stats("people")["rows"])
+
+    def test_find_fallback(self):
+        """ Backend.find should do whatever the backend can't. """
+        class ScanOnly(Backend):
+            def scan(inner, table, *args, **kwargs):
+                return self.backend.scan(table)
+        docs = list(ScanOnly().find("people", {"city": "NYC"}, ["name"],
+                                    [("age", 1)], limit=1))
+        self.assertEqual([{"name": "Bob"}], docs)
+
+    def test_in_batches(self):
+        """ Long $in lists should be queried in batches, and merged. """
+        size = backend.IN_BATCH_SIZE
+        backend.IN_BATCH_SIZE = 1
+        try:
+            self.assertEqual(4, len(backend.split_in(
+                {"name": {"$in": ["Jon", "Ann", "Bob", "Eve"]}})))
+            ages = {"$in": [42, 25, 19, 31, 7]}
+            self.assertEqual([{"name": "Jon"}, {"name": "Ann"}],
+                             list(self.backend.find("people", {"age": ages},
+                                                    ["name"], [("age", 1)],
+                                                    limit=2, offset=1)))
+            self.assertEqual(["Ann", "Bob", "Eve", "Jon"],
+                             sorted(self.names({"age": ages})))
+        finally:
+            backend.IN_BATCH_SIZE = size
+
+    def test_shared_tables(self):
+        """ Sessions creating the same table should all get the one table. """
+        sessions = [self.backend.use("other") for i in range(8)]
+        self.assertTrue(all(s._lock is self.backend._lock for s in sessions))
+        tables = []
+        def create(session):
+            tables.append(session.table("new", create=True))
+        threads = [threading.Thread(target=create, args=(s,))
+                   for s in sessions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8, len(tables))
+        self.assertTrue(all(t is tables[0] for t in tables))
+        self.assertTrue(self.backend.use("other").table("new") is tables[0])
+
+    def test_limit_zero(self):
+        """ LIMIT 0 should return nothing (without opening a cursor). """
+        self.assertEqual([], list(self.backend.find("people", {}, limit=0)))
+        # (There's no collection to scan, so any cursor would fail)
+        self.assertEqual([], list(parallel_scan.scan(None, limit=0, degree=4)))
+        self.assertEqual([], list(parallel_scan.scan(None, limit=0)))
+
+    def test_nested_order(self):
+        """ Merges (of batches and partitions) should sort by dotted paths. """
+        cities = ["a", "d", "b", "c", "e", "f"]
+        self.backend.insert("places", [{"id": i, "address": {"city": city}}
+                                       for i, city in enumerate(cities)])
+        order = [("address.city", 1)]
+        size = backend.IN_BATCH_SIZE
+        backend.IN_BATCH_SIZE = 2
+        try:
+            docs = self.backend.find("places", {"id": {"$in": range(6)}},
+                                     None, order)
+            self.assertEqual(sorted(cities),
+                             [doc["address"]["city"] for doc in docs])
+        finally:
+            backend.IN_BATCH_SIZE = size
+        partitions = [[{"address": {"city": c}} for c in sorted(part)]
+                      for part in (cities[:3], cities[3:])]
+        self.assertEqual(sorted(cities),
+                         [doc["address"]["city"]
+                          for doc in ParallelScan(partitions, order)])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+"""
+In-process metrics, exported in the Prometheus text format.
+
+Counters and histograms are sharded per thread: each thread only ever
+writes to its own shard, so the per-packet path never takes a lock.
+The shards get summed up when the metrics are scraped.
+"""
+
+import math
+import weakref
+import threading
+
+
+# Where the metrics are served from, by default
+HTTP_PORT = 9104
+
+# Histogram precision: each power of 2 is split into this many buckets,
+# so bucket bounds are within 1/SUB_BUCKETS of any recorded value.
+SUB_BUCKETS = 4
+# Histograms cover 2**MIN_EXPONENT to 2**MAX_EXPONENT
+# (about 1 microsecond to 2 minutes, when measuring seconds)
+MIN_EXPONENT = -20
+MAX_EXPONENT = 7
+
+
+
+class Metric (object):
+    """ A named metric, possibly split up by labels. """
+
+    type = None
+
+    def __init__ (self, name, help="", labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+
+    def labels (self, *values):
+        """ Gets the child metric for a set of label values. """
+
+        try:
+            return self.children[values]
+        except KeyError:
+            # Only creating a child needs the lock
+            with self.lock:
+                if values not in self.children:
+                    self.children[values] = self.child()
+                return self.children[values]
+
+
+    def child (self):
+        raise NotImplementedError
+
+
+    def expose (self):
+        """ Gets the lines for this metric in the text exposition format. """
+
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type)
+        ]
+        for values, child in sorted(self.children.items()):
+            labels = ",".join(
+                '%s="%s"' % (name, _escape(value))
+                for name, value in zip(self.label_names, values)
+            )
+            lines += child.expose(self.name, labels)
+        return lines
+
+
+
+class _Shards (object):
+    """
+    Per-thread lists of numbers, which only their own thread writes to.
+
+    When a thread goes away, its shard gets folded into a shared total,
+    so short-lived connection threads don't pile up shards.
+    """
+
+    def __init__ (self, size):
+        self.size = size
+        self.local = threading.local()
+        self.live = {}
+        self.retired = [0] * size
+        self.lock = threading.Lock()
+
+
+    def get (self):
+        """ Gets the calling thread's shard. """
+
+        try:
+            return self.local.owner.shard
+        except AttributeError:
+            return self._add()
+
+
+    def _add (self):
+        owner = self.local.owner = _ShardOwner([0] * self.size)
+        shard = owner.shard
+        key = id(shard)
+
+        # Runs once the thread (and so its thread-local owner) is gone
+        def retire (ref):
+            with self.lock:
+                self.live.pop(key, None)
+                for i, value in enumerate(shard):
+                    self.retired[i] += value
+
+        with self.lock:
+            self.live[key] = (weakref.ref(owner, retire), shard)
+        return shard
+
+
+    def total (self):
+        """ Sums up all of the shards. """
+
+        with self.lock:
+            shards = [shard for ref, shard in self.live.values()]
+            shards.append(list(self.retired))
+        return [sum(column) for column in zip(*shards)]
+
+
+
+class _ShardOwner (object):
+    """ Holds a thread's shard, so we can tell when the thread is gone. """
+
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__ (self, shard):
+        self.shard = shard
+
+
+
+class _CounterValue (object):
+    def __init__ (self):
+        self.shards = _Shards(1)
+
+    def inc (self, amount=1):
+        self.shards.get()[0] += amount
+
+    def dec (self, amount=1):
+        self.shards.get()[0] -= amount
+
+    @property
+    def value (self):
+        return self.shards.total()[0]
+
+    def expose (self, name, labels):
+        return ["%s%s %s" % (name, _braces(labels), _number(self.value))]
+
+
+
+class Counter (Metric):
+    """ A number that only goes up. """
+
+    type = "counter"
+
+    def child (self):
+        return _CounterValue()
+
+    def inc (self, amount=1):
+        self.labels().inc(amount)
+
+    @property
+    def value (self):
+        return self.labels().value
+
+
+
+class Gauge (Counter):
+    """
+    A number that goes up and down, or one that's read from
+    a function when the metrics are scraped.
+    """
+
+    type = "gauge"
+
+    def __init__ (self, name, help="", labels=(), registry=None,
+                  function=None):
+        self.function = function
+        super(Gauge, self).__init__(name, help, labels, registry)
+
+    def dec (self, amount=1):
+        self.labels().dec(amount)
+
+    def expose (self):
+        if self.function:
+            return [
+                "# HELP %s %s" % (self.name, self.help),
+                "# TYPE %s %s" % (self.name, self.type),
+                "%s %s" % (self.name, _number(self.function()))
+            ]
+        return super(Gauge, self).expose()
+
+
+
+def _bucket_bounds ():
+    """ The upper bounds of the histogram buckets (log-linear). """
+
+    bounds = []
+    for exponent in range(MIN_EXPONENT, MAX_EXPONENT):
+        for i in range(SUB_BUCKETS):
+            bounds.append(
+                math.ldexp(0.5 + 0.5 * (i + 1) / SUB_BUCKETS, exponent + 1))
+    return bounds
+
+BUCKET_BOUNDS = _bucket_bounds()
+
+
+class _HistogramValue (object):
+    # Shard layout: [bucket counts..., +Inf count, sum]
+
+    def __init__ (self):
+        self.shards = _Shards(len(BUCKET_BOUNDS) + 2)
+
+    def observe (self, value):
+        shard = self.shards.get()
+        shard[_bucket(value)] += 1
+        shard[-1] += value
+
+    def totals (self):
+        """ Gets (bucket counts, sum). """
+
+        total = self.shards.total()
+        return total[:-1], total[-1]
+
+    def expose (self, name, labels):
+        counts, total = self.totals()
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(BUCKET_BOUNDS + [None], counts):
+            cumulative += count
+            le = "+Inf" if bound is None else repr(bound)
+            lines.append('%s_bucket{%s%sle="%s"} %d'
+                         % (name, labels, separator, le, cumulative))
+        lines.append("%s_sum%s %s" % (name, _braces(labels), _number(total)))
+        lines.append("%s_count%s %d" % (name, _braces(labels), cumulative))
+        return lines
+
+
+def _bucket (value):
+    """ Finds the index of the bucket a value goes in. """
+
+    if value <= 0:
+        return 0
+    mantissa, exponent = math.frexp(value)
+    if exponent <= MIN_EXPONENT:
+        return 0
+    if exponent > MAX_EXPONENT:
+        return len(BUCKET_BOUNDS)
+    # The mantissa is in [0.5, 1), so split that range linearly
+    # (powers of 2 land on the previous bucket's upper bound)
+    sub = int(math.ceil((mantissa - 0.5) * 2 * SUB_BUCKETS)) - 1
+    return max((exponent - 1 - MIN_EXPONENT) * SUB_BUCKETS + sub, 0)
+
+
+
+class Histogram (Metric):
+    """ Counts of observed values (usually latencies, in seconds). """
+
+    type = "histogram"
+
+    def child (self):
+        return _HistogramValue()
+
+    def observe (self, value):
+        self.labels().observe(value)
+
+
+
+class Registry (object):
+    """ A collection of metrics to be exported together. """
+
+    def __init__ (self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register (self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def expose (self):
+        """ Gets all the metrics in the text exposition format. """
+
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+# The metrics for the whole server
+REGISTRY = Registry()
+
+
+def _braces (labels):
+    return "{%s}" % labels if labels else ""
+
+def _escape (value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')\
+                     .replace("\n", "\\n")
+
+def _number (value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+def start_http_server (port=HTTP_PORT, host="0.0.0.0", registry=REGISTRY):
+    """
+    Starts serving the metrics on a background thread.
+    Returns the HTTP server (its server_address has the actual port).
+    """
+
+    # (The HTTP modules are slow to import, so they're only
+    # loaded by processes that serve the metrics)
+    from metrics_http import MetricsHTTPServer, MetricsHandler
+    server = MetricsHTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+
+# The proxy's own metrics
+sessions_active = Gauge(
+    "pysql_sessions_active", "Client sessions currently connected.")
+commands = Counter(
+    "pysql_commands_total", "Commands received, by type.", ["command"])
+command_latency = Histogram(
+    "pysql_command_latency_seconds", "Time taken to answer commands.",
+    ["command"])
+bytes_received = Counter(
+    "pysql_bytes_received_total", "Bytes read from clients.")
+bytes_sent = Counter(
+    "pysql_bytes_sent_total", "Bytes written to clients.")
+backend_connections = Gauge(
+    "pysql_backend_connections",
+    "Open connections in the MongoDB connection pool.")
+backend_connections_in_use = Gauge(
+    "pysql_backend_connections_in_use",
+    "MongoDB connections checked out of the pool by queries.")
+cache_requests = Counter(
+    "pysql_cache_requests_total", "Cache lookups, by cache and result.",
+    ["cache", "result"])
+cursors_open = Gauge(
+    "pysql_cursors_open", "Server-side cursors held open for COM_STMT_FETCH.")
+queries_interrupted = Counter(
+    "pysql_queries_interrupted_total",
+    "Queries stopped by KILL QUERY or max_execution_time, by reason.",
+    ["reason"])
+write_batches = Counter(
+    "pysql_write_batches_total", "Bulk writes made by the write coalescer.")
+write_batch_rows = Counter(
+    "pysql_write_batch_rows_total",
+    "Rows written by the write coalescer (over write_batches, the batch size).")
+capture_dropped = Counter(
+    "pysql_capture_dropped_total",
+    "Captured commands dropped because the capture log fell behind.")
+queries_queued = Gauge(
+    "pysql_queries_queued", "Queries waiting for the scheduler, by class.",
+    ["class"])
+queries_rejected = Counter(
+    "pysql_queries_rejected_total",
+    "Queries turned away because the scheduler's queue was full, by class.",
+    ["class"])
+queue_wait = Histogram(
+    "pysql_queue_wait_seconds", "Time queries spent waiting to run, by class.",
+    ["class"])
@@ -0,0 +1,33 @@
+"""
+Serves the metrics over HTTP, for Prometheus to scrape
+(see metrics.start_http_server).
+"""
+
+import BaseHTTPServer
+import SocketServer
+
+
+
+class MetricsHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the server's registry at /metrics. """
+
+    def do_GET (self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.expose()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        # Scrapes are too frequent to be worth logging
+        pass
+
+
+class MetricsHTTPServer (SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
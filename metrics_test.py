@@ -0,0 +1,106 @@
+import unittest
+import threading
+import urllib2
+import metrics
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient
+from pysql import MySQLServer
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.server = metrics.start_http_server(0, "127.0.0.1", self.registry)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def scrape(self):
+        url = "http://127.0.0.1:%d/metrics" % self.server.server_address[1]
+        return urllib2.urlopen(url).read().splitlines()
+
+    def test_scrape(self):
+        """ Counters from several threads should add up in a scrape. """
+        counter = metrics.Counter("test_commands_total", "Commands.",
+                                  ["command"], registry=self.registry)
+        def work():
+            for i in range(1000):
+                counter.labels("Query").inc()
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        lines = self.scrape()
+        self.assertIn("# TYPE test_commands_total counter", lines)
+        self.assertIn('test_commands_total{command="Query"} 4000', lines)
+
+    def test_histogram(self):
+        """ Histogram buckets are cumulative, ending with +Inf. """
+        latency = metrics.Histogram("test_latency_seconds", "Latency.",
+                                    registry=self.registry)
+        for value in (0.0005, 0.002, 0.002, 5.0, 1000.0):
+            latency.observe(value)
+        lines = self.scrape()
+        buckets = []
+        for line in lines:
+            if line.startswith("test_latency_seconds_bucket"):
+                le = line.split('le="')[1].split('"')[0]
+                buckets.append((float(le), int(line.split()[-1])))
+
+        def count_upto(value):
+            return min((le, count) for le, count in buckets if le >= value)[1]
+        self.assertEqual(1, count_upto(0.0005))
+        self.assertEqual(3, count_upto(0.002))
+        self.assertEqual(4, count_upto(5.0))
+        self.assertEqual(5, buckets[-1][1])
+        self.assertIn("test_latency_seconds_count 5", lines)
+
+class ServerMetricsTests(unittest.TestCase):
+    def setUp(self):
+        backend = MemoryBackend()
+        backend.insert("t", [{"a": 1}, {"a": 2}])
+        self.server = MySQLServer(("127.0.0.1", 0), backend)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.http = metrics.start_http_server(0, "127.0.0.1")
+
+    def tearDown(self):
+        self.http.shutdown()
+        self.http.server_close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def scrape(self):
+        url = "http://127.0.0.1:%d/metrics" % self.http.server_address[1]
+        values = {}
+        for line in urllib2.urlopen(url).read().splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                values[name] = float(value)
+        return values
+
+    def test_server(self):
+        """ A running server's scrape should count the queries it answers. """
+        name = 'pysql_commands_total{command="Query"}'
+        before = self.scrape().get(name, 0)
+        client = MySQLClient(port=self.server.server_address[1])
+        try:
+            self.assertEqual((["a"], [["1"], ["2"]]),
+                             client.query("select a from t"))
+            # (A command's counted once it's answered, so by the time
+            # the ping comes back, the query has been)
+            client.ping()
+            values = self.scrape()
+            self.assertEqual(before + 1, values[name])
+            self.assertGreaterEqual(values["pysql_sessions_active"], 1)
+            latency = 'pysql_command_latency_seconds_count{command="Query"}'
+            self.assertEqual(values[name], values[latency])
+        finally:
+            client.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+"""
+The MongoDB backend.
+
+Tables are collections, and the whole query (conditions, projection,
+sort, limit, and any unwinding) is pushed down to MongoDB.
+"""
+
+import logging
+import threading
+
+import pymongo
+from bson.son import SON
+from pymongo.errors import ExecutionTimeout, OperationFailure, \
+     BulkWriteError
+
+# Raw documents (pymongo 3 and up) let the rows be read
+# straight out of the BSON (see row_mapping), and pymongo 3.6
+# and up can hand over whole batches of them (find_raw_batches)
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:
+    RawBSONDocument = None
+
+# Multi-document transactions need pymongo 3.7 (and a replica set)
+try:
+    from pymongo.write_concern import WriteConcern
+except ImportError:
+    WriteConcern = None
+
+# Connection pool events (for the metrics) need pymongo 3.9
+try:
+    from pymongo.monitoring import ConnectionPoolListener
+except ImportError:
+    ConnectionPoolListener = object
+
+import metrics
+import bson_scan
+import parallel_scan
+from backend import Backend, QueryTimeout, WriteErrors, FILTER, PROJECTION, \
+                    SORT, LIMIT, UNWIND
+
+
+log = logging.getLogger("pysql.mongo")
+
+# The error for transactions on a standalone server
+ILLEGAL_OPERATION = 20
+
+
+class MongoBackend (Backend):
+    """ Serves tables from a MongoDB database. """
+
+    capabilities = frozenset([FILTER, PROJECTION, SORT, LIMIT, UNWIND])
+
+    def __init__ (self, connection=None, database="pysql_test",
+                  _shared=None):
+        """
+        Uses the given pymongo connection, or makes one
+        (to localhost) the first time it's needed.
+        """
+
+        # The backends for each database share the one connection (pool)
+        self._shared = _shared or {
+            "connection": connection,
+            "lock": threading.Lock()
+        }
+        self.database = database
+
+
+    @property
+    def connection (self):
+        shared = self._shared
+        if shared["connection"] is None:
+            with shared["lock"]:
+                if shared["connection"] is None:
+                    # (Acknowledged writes, so errors like duplicate
+                    # keys get back to the client)
+                    options = {"w": 1}
+                    if ConnectionPoolListener is not object:
+                        options["event_listeners"] = [PoolMetrics()]
+                    shared["connection"] = pymongo.MongoClient(**options)
+        return shared["connection"]
+
+
+    def collection (self, table):
+        return self.connection[self.database][table]
+
+
+    def use (self, database):
+        return MongoBackend(database=database, _shared=self._shared)
+
+
+    def databases (self):
+        return sorted(self.connection.database_names())
+
+
+    def tables (self):
+        return sorted(
+            name for name in self.connection[self.database].collection_names()
+            if not name.startswith("system.")
+        )
+
+
+    def scan (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, parallel=None, max_time_ms=None,
+              unwind=None, raw=False, **options):
+        # (MongoDB takes a limit of 0 to mean no limit at all, so LIMIT 0
+        # doesn't open a cursor)
+        if limit == 0:
+            return iter([])
+        collection = self.collection(table)
+        single = (parallel or parallel_scan.DEFAULT_DEGREE) <= 1
+        if raw and single and not unwind and \
+           hasattr(collection, "find_raw_batches"):
+            # The documents get read in place, out of each batch
+            return timed(raw_batches(collection.find_raw_batches(
+                conditions, columns, sort=order, skip=offset,
+                limit=limit or 0, max_time_ms=max_time_ms)))
+        if raw and RawBSONDocument is not None:
+            collection = collection.with_options(codec_options=CodecOptions(
+                document_class=RawBSONDocument))
+        if unwind:
+            return timed(self.aggregate(collection, unwind, conditions,
+                                        columns, order, limit, offset,
+                                        max_time_ms))
+        return timed(parallel_scan.scan(
+            collection, conditions,
+            fields=columns, order=order,
+            limit=limit, offset=offset,
+            degree=parallel, max_time_ms=max_time_ms
+        ))
+
+
+    def aggregate (self, collection, unwind, conditions=None, columns=None,
+                   order=None, limit=None, offset=0, max_time_ms=None):
+        """ Runs a query with an $unwind, as an aggregation pipeline. """
+
+        pipeline = [{"$unwind": "$" + unwind}]
+        if conditions:
+            pipeline.append({"$match": conditions})
+        if order:
+            pipeline.append({"$sort": SON(order)})
+        if offset:
+            pipeline.append({"$skip": offset})
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+        if columns:
+            pipeline.append({"$project": dict((c, 1) for c in columns)})
+        options = {"cursor": {}}
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
+        return collection.aggregate(pipeline, **options)
+
+
+    def insert (self, table, documents):
+        """
+        Inserts the documents (unordered, so one bad document doesn't
+        stop the rest), raising WriteErrors for any that failed.
+        """
+
+        try:
+            self.collection(table).insert_many(documents, ordered=False)
+        except BulkWriteError, e:
+            errors = e.details.get("writeErrors")
+            if not errors:
+                # (eg. a write concern error, which doesn't say which
+                # documents were written)
+                raise
+            raise WriteErrors(dict(
+                (error["index"], (error.get("code"), error.get("errmsg")))
+                for error in errors))
+        return len(documents)
+
+
+    def commit (self, writes):
+        """
+        Applies a transaction's writes in a MongoDB transaction, if
+        the server (and pymongo) can, or one by one if it can't.
+        """
+
+        client = self.connection
+        if not hasattr(client, "start_session") or \
+           self._shared.get("transactions") is False:
+            return Backend.commit(self, writes)
+        try:
+            with client.start_session() as session:
+                # (Transactions can't use unacknowledged writes)
+                with session.start_transaction(
+                        write_concern=WriteConcern("majority")):
+                    for database, table, documents in writes:
+                        client[database][table].insert_many(
+                            documents, session=session)
+        except OperationFailure, e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            # A standalone server (nothing got written)
+            log.warning("MongoDB doesn't have transactions here (%s), "
+                        "so they won't be atomic", e)
+            self._shared["transactions"] = False
+            Backend.commit(self, writes)
+
+
+    def update (self, table, conditions, changes):
+        result = self.collection(table).update(
+            conditions, {"$set": changes}, multi=True)
+        return result.get("n", 0) if result else 0
+
+
+    def delete (self, table, conditions):
+        result = self.collection(table).remove(conditions)
+        return result.get("n", 0) if result else 0
+
+
+    def stats (self, table):
+        stats = self.connection[self.database].command("collstats", table)
+        return {
+            "rows": stats.get("count", 0),
+            "size": stats.get("size"),
+            "indexes": stats.get("nindexes", 0),
+        }
+
+
+    def indexes (self, table):
+        return dict(
+            (name, [(field, direction) for field, direction in info["key"]])
+            for name, info in self.collection(table).index_information().items()
+        )
+
+
+    def create_index (self, table, fields):
+        return self.collection(table).create_index(fields)
+
+
+
+class PoolMetrics (ConnectionPoolListener):
+    """
+    Keeps the backend connection metrics up to date, from the
+    connection pool's events.
+    """
+
+    def connection_created (self, event):
+        metrics.backend_connections.inc()
+
+    def connection_closed (self, event):
+        metrics.backend_connections.dec()
+
+    def connection_checked_out (self, event):
+        metrics.backend_connections_in_use.inc()
+
+    def connection_checked_in (self, event):
+        metrics.backend_connections_in_use.dec()
+
+    # (The rest of the events don't change either)
+    def pool_created (self, event): pass
+    def pool_ready (self, event): pass
+    def pool_cleared (self, event): pass
+    def pool_closed (self, event): pass
+    def connection_ready (self, event): pass
+    def connection_check_out_started (self, event): pass
+    def connection_check_out_failed (self, event): pass
+
+
+
+def raw_batches (cursor):
+    """ Hands out the documents in a cursor's raw batches. """
+
+    try:
+        for batch in cursor:
+            for start in bson_scan.documents(batch):
+                yield bson_scan.RawDocument(batch, start)
+    finally:
+        cursor.close()
+
+
+def timed (results):
+    """
+    Passes on a scan's results, turning MongoDB's timeouts into
+    QueryTimeouts. Closing it (when a query is stopped early)
+    closes the cursors, which kills them on the server.
+    """
+
+    try:
+        for doc in results:
+            yield doc
+    except ExecutionTimeout, e:
+        raise QueryTimeout(str(e))
+    finally:
+        if hasattr(results, "close"):
+            results.close()
@@ -0,0 +1,420 @@
+"""
+A minimal, pure-Python MySQL client.
+
+Speaks just enough of the protocol (handshake, COM_QUERY, text result
+sets) to drive a pysql server from the benchmarks and tests,
+without needing a MySQL driver installed.
+"""
+
+import socket
+import struct
+import hashlib
+
+from compression import CompressedSocket, CLIENT_COMPRESS
+from prepared import read_length_coded
+
+
+# The longest payload a packet can have (longer ones are split up)
+MAX_PACKET_LENGTH = 0xFFFFFF
+
+# Capability flags sent with the login request
+CLIENT_LONG_PASSWORD = 0x0001
+CLIENT_CONNECT_WITH_DB = 0x0008
+CLIENT_PROTOCOL_41 = 0x0200
+CLIENT_TRANSACTIONS = 0x2000
+CLIENT_SECURE_CONNECTION = 0x8000
+
+# Commands
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_QUERY = 0x03
+COM_PING = 0x0e
+COM_CHANGE_USER = 0x11
+COM_STMT_PREPARE = 0x16
+COM_STMT_EXECUTE = 0x17
+COM_STMT_SEND_LONG_DATA = 0x18
+COM_STMT_CLOSE = 0x19
+COM_STMT_RESET = 0x1a
+COM_STMT_FETCH = 0x1c
+COM_RESET_CONNECTION = 0x1f
+
+
+# Prepared statement parameter types
+MYSQL_TYPE_DOUBLE = 0x05
+MYSQL_TYPE_NULL = 0x06
+MYSQL_TYPE_LONGLONG = 0x08
+MYSQL_TYPE_VAR_STRING = 0xfd
+
+# How fixed-size values are packed in binary rows, by column type
+BINARY_TYPES = {
+    0x01: "< b", 0x02: "< h", 0x03: "< i", 0x04: "< f",
+    MYSQL_TYPE_DOUBLE: "< d", MYSQL_TYPE_LONGLONG: "< q", 0x09: "< i",
+    0x0d: "< h",
+}
+
+CURSOR_TYPE_READ_ONLY = 0x01
+SERVER_STATUS_LAST_ROW_SENT = 0x0080
+
+
+
+class MySQLError (Exception):
+    """ An ERR packet from the server. """
+
+    def __init__ (self, code, message):
+        Exception.__init__(self, "(%d) %s" % (code, message))
+        self.code = code
+        self.message = message
+
+
+
+def scramble (password, salt):
+    """
+    Computes the mysql_native_password auth response:
+    SHA1(password) XOR SHA1(salt + SHA1(SHA1(password)))
+    """
+
+    if not password:
+        return ""
+    stage1 = hashlib.sha1(password).digest()
+    stage2 = hashlib.sha1(stage1).digest()
+    mask = hashlib.sha1(salt + stage2).digest()
+    return "".join(chr(ord(a) ^ ord(b)) for a, b in zip(stage1, mask))
+
+
+def length_coded_string (value):
+    """ Encodes a length coded string. """
+
+    length = len(value)
+    if length < 251:
+        return chr(length) + value
+    elif length < 0x10000:
+        return "\xFC" + struct.pack("< H", length) + value
+    elif length < 0x1000000:
+        return "\xFD" + struct.pack("< I", length)[:3] + value
+    return "\xFE" + struct.pack("< Q", length) + value
+
+
+def read_length_coded_string (data, pos):
+    """ Reads a length coded string (None for NULL). """
+
+    length, pos = read_length_coded(data, pos)
+    if length is None:
+        return None, pos
+    return data[pos:pos + length], pos + length
+
+
+
+class MySQLClient (object):
+    """ A connection to a MySQL (or pysql) server. """
+
+    def __init__ (self, host="127.0.0.1", port=3306, user="root",
+                  password="", database=None, timeout=None, compress=False):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = ""
+        self.number = 0
+        self.compress = compress
+        self.handshake(user, password, database)
+        if compress:
+            self.socket = CompressedSocket(self.socket)
+
+
+    def recv_exactly (self, size):
+        """ Reads exactly size bytes from the socket. """
+
+        while len(self.buffer) < size:
+            data = self.socket.recv(max(65536, size - len(self.buffer)))
+            if not data:
+                raise EOFError("The server closed the connection")
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+    def read_packet (self):
+        """ Reads a packet, returning its payload. """
+
+        header = self.recv_exactly(4)
+        length, length_byte3, self.number = struct.unpack("< H B B", header)
+        length += length_byte3 << 16
+        return self.recv_exactly(length)
+
+
+    def send_packet (self, data, number=None):
+        """
+        Sends a packet with the given payload (split over several,
+        if it's too long for one).
+        """
+
+        if number is None:
+            number = (self.number + 1) & 0xFF
+        packets = []
+        while True:
+            chunk, data = data[:MAX_PACKET_LENGTH], data[MAX_PACKET_LENGTH:]
+            length = len(chunk)
+            packets.append(struct.pack("< H B B", length & 0xFFFF,
+                                       length >> 16, number) + chunk)
+            self.number = number
+            number = (number + 1) & 0xFF
+            if length < MAX_PACKET_LENGTH:
+                break
+        self.socket.sendall("".join(packets))
+
+
+    def handshake (self, user, password, database):
+        """ Reads the greeting, and logs in. """
+
+        greeting = self.read_packet()
+        if greeting[0] == "\xFF":
+            self.raise_error(greeting)
+        self.protocol_version = ord(greeting[0])
+        end = greeting.index("\0", 1)
+        self.server_version = greeting[1:end]
+        pos = end + 1
+        self.thread_id = struct.unpack("< I", greeting[pos:pos + 4])[0]
+        salt = greeting[pos + 4:pos + 12]
+        # Skip the filler, capabilities, charset, status and reserved bytes
+        pos += 13 + 18
+        salt += greeting[pos:].split("\0", 1)[0]
+        self.salt = salt
+
+        flags = CLIENT_LONG_PASSWORD | CLIENT_PROTOCOL_41 | \
+                CLIENT_TRANSACTIONS | CLIENT_SECURE_CONNECTION
+        if database:
+            flags |= CLIENT_CONNECT_WITH_DB
+        if self.compress:
+            flags |= CLIENT_COMPRESS
+        auth = scramble(password, salt[:20])
+        login = struct.pack("< I I B 23s", flags, 1 << 24, 8, "") + \
+                user + "\0" + chr(len(auth)) + auth
+        if database:
+            login += database + "\0"
+        self.send_packet(login)
+        self.read_result()
+
+
+    def raise_error (self, packet):
+        code = struct.unpack("< H", packet[1:3])[0]
+        message = packet[3:]
+        # Skip the SQL state (#HY000) if there is one
+        if message.startswith("#"):
+            message = message[6:]
+        raise MySQLError(code, message)
+
+
+    def command (self, command, argument=""):
+        """ Sends a command, and reads its result. """
+
+        if self.compress:
+            self.socket.reset()
+        self.send_packet(chr(command) + argument, 0)
+        return self.read_result()
+
+
+    def query (self, sql):
+        """
+        Runs a query.
+
+        Returns (columns, rows) for result sets,
+        or the number of affected rows otherwise.
+        """
+
+        return self.command(COM_QUERY, sql)
+
+
+    def ping (self):
+        """ Checks that the connection is still alive. """
+
+        return self.command(COM_PING)
+
+
+    def select_db (self, database):
+        """ Switches to another database. """
+
+        return self.command(COM_INIT_DB, database)
+
+
+    def change_user (self, user, password="", database=None):
+        """ Logs in as someone else, on the same connection. """
+
+        auth = scramble(password, self.salt[:20])
+        argument = user + "\0" + chr(len(auth)) + auth + \
+                   (database or "") + "\0" + struct.pack("< H", 8)
+        return self.command(COM_CHANGE_USER, argument)
+
+
+    def reset_connection (self):
+        """ Resets the session's state, keeping the connection. """
+
+        return self.command(COM_RESET_CONNECTION)
+
+
+    def read_result (self):
+        """ Reads an OK packet, an ERR packet or a result set. """
+
+        packet = self.read_packet()
+        first = packet[0]
+        if first == "\x00":
+            affected_rows, pos = read_length_coded(packet, 1)
+            insert_id, pos = read_length_coded(packet, pos)
+            # The server status flags (eg. whether we're in a transaction)
+            self.status = struct.unpack("< H", packet[pos:pos + 2])[0]
+            return affected_rows
+        elif first == "\xFF":
+            self.raise_error(packet)
+        elif first == "\xFE" and len(packet) < 9:
+            # An EOF with no result set (eg. COM_STMT_FETCH is done)
+            return None
+
+        field_count = read_length_coded(packet, 0)[0]
+        columns = [name for name, kind in self.read_columns()]
+
+        rows = []
+        while True:
+            packet = self.read_packet()
+            if packet[0] == "\xFE" and len(packet) < 9:
+                self.status = struct.unpack("< H", packet[3:5])[0]
+                break
+            elif packet[0] == "\xFF":
+                self.raise_error(packet)
+            row = []
+            pos = 0
+            for i in range(field_count):
+                value, pos = read_length_coded_string(packet, pos)
+                row.append(value)
+            rows.append(row)
+        return columns, rows
+
+
+    def read_columns (self):
+        """ Reads column definitions up to an EOF, as (name, type). """
+
+        columns = []
+        while True:
+            packet = self.read_packet()
+            if packet[0] == "\xFE" and len(packet) < 9:
+                self.status = struct.unpack("< H", packet[3:5])[0]
+                return columns
+            # The name is the 5th length coded string
+            pos = 0
+            for i in range(6):
+                value, pos = read_length_coded_string(packet, pos)
+                if i == 4:
+                    name = value
+            # Then a filler, the charset, length and type
+            columns.append((name, ord(packet[pos + 7])))
+
+
+    def prepare (self, sql):
+        """ Prepares a statement, returning (statement id, parameters). """
+
+        self.send_packet(chr(COM_STMT_PREPARE) + sql, 0)
+        packet = self.read_packet()
+        if packet[0] == "\xFF":
+            self.raise_error(packet)
+        statement_id, columns, params = struct.unpack("< I H H", packet[1:9])
+        if params:
+            self.read_columns()
+        if columns:
+            self.read_columns()
+        return statement_id, params
+
+
+    def execute (self, statement_id, params=(), cursor=False):
+        """
+        Runs a prepared statement. Returns the same as query(), except
+        that with a cursor the rows are left to fetch().
+        """
+
+        types = []
+        values = []
+        nulls = bytearray((len(params) + 7) // 8)
+        for i, param in enumerate(params):
+            if param is None:
+                nulls[i // 8] |= 1 << (i % 8)
+                types.append(MYSQL_TYPE_NULL)
+            elif isinstance(param, (int, long)):
+                types.append(MYSQL_TYPE_LONGLONG)
+                values.append(struct.pack("< q", param))
+            elif isinstance(param, float):
+                types.append(MYSQL_TYPE_DOUBLE)
+                values.append(struct.pack("< d", param))
+            else:
+                types.append(MYSQL_TYPE_VAR_STRING)
+                values.append(length_coded_string(str(param)))
+        argument = struct.pack("< I B I", statement_id,
+                               CURSOR_TYPE_READ_ONLY if cursor else 0, 1)
+        if params:
+            argument += str(nulls) + "\x01" + \
+                        struct.pack("< %dH" % len(types), *types) + \
+                        "".join(values)
+        return self.send_execute(argument, cursor)
+
+
+    def send_execute (self, argument, cursor=False):
+        """ Sends a COM_STMT_EXECUTE as is (eg. a replayed one). """
+
+        self.send_packet(chr(COM_STMT_EXECUTE) + argument, 0)
+        packet = self.read_packet()
+        if packet[0] == "\x00":
+            return read_length_coded(packet, 1)[0]
+        elif packet[0] == "\xFF":
+            self.raise_error(packet)
+        self.columns = self.read_columns()
+        columns = [name for name, kind in self.columns]
+        if cursor:
+            return columns, []
+        return columns, self.read_binary_rows()[0]
+
+
+    def fetch (self, statement_id, count):
+        """ Fetches rows from a cursor, returning (rows, whether it's done). """
+
+        self.send_packet(chr(COM_STMT_FETCH) +
+                         struct.pack("< I I", statement_id, count), 0)
+        return self.read_binary_rows()
+
+
+    def read_binary_rows (self):
+        """ Reads binary rows up to an EOF, returning (rows, last row sent). """
+
+        rows = []
+        while True:
+            packet = self.read_packet()
+            if packet[0] == "\xFE" and len(packet) < 9:
+                status = struct.unpack("< H", packet[3:5])[0]
+                return rows, bool(status & SERVER_STATUS_LAST_ROW_SENT)
+            elif packet[0] == "\xFF":
+                self.raise_error(packet)
+            pos = 1 + (len(self.columns) + 9) // 8
+            row = []
+            for i, (name, kind) in enumerate(self.columns):
+                if ord(packet[1 + (i + 2) // 8]) & (1 << ((i + 2) % 8)):
+                    row.append(None)
+                elif kind in BINARY_TYPES:
+                    packer = struct.Struct(BINARY_TYPES[kind])
+                    row.append(packer.unpack_from(packet, pos)[0])
+                    pos += packer.size
+                else:
+                    value, pos = read_length_coded_string(packet, pos)
+                    row.append(value)
+            rows.append(row)
+
+
+    def close_statement (self, statement_id):
+        """ Closes a prepared statement (there's no response). """
+
+        self.send_packet(chr(COM_STMT_CLOSE) +
+                         struct.pack("< I", statement_id), 0)
+
+
+    def close (self):
+        """ Sends COM_QUIT, and closes the socket. """
+
+        try:
+            if self.compress:
+                self.socket.reset()
+            self.send_packet(chr(COM_QUIT), 0)
+        except socket.error:
+            pass
+        self.socket.close()
@@ -0,0 +1,273 @@
+"""
+Parallel partitioned scans.
+
+Splits a collection into _id ranges and reads each range on its own
+thread, so a big SELECT isn't stuck behind a single cursor.
+Each thread gets its own socket out of pymongo's connection pool.
+"""
+
+import threading
+import itertools
+import heapq
+import Queue
+
+from conditions import get_path
+
+
+# How many partitions to scan at once, unless a query asks otherwise
+# (via a /*+ PARALLEL(n) */ hint). 1 means a plain single cursor.
+DEFAULT_DEGREE = 1
+
+# Collections smaller than this aren't worth splitting up
+MIN_PARTITION_SIZE = 1000
+
+# How many rows each partition can read ahead of the client
+QUEUE_SIZE = 1000
+
+
+
+def split_points (collection, degree):
+    """
+    Gets the _id values that split a collection into
+    (roughly) equal partitions.
+
+    Uses the splitVector command when the server allows it,
+    and falls back to skipping through the _id index otherwise.
+    """
+
+    count = collection.count()
+    degree = min(degree, count // MIN_PARTITION_SIZE)
+    if degree <= 1:
+        return []
+
+    # Ask the server for split points, based on the collection's size
+    try:
+        stats = collection.database.command("collstats", collection.name)
+        result = collection.database.command(
+            "splitVector", collection.full_name,
+            keyPattern={"_id": 1},
+            maxChunkSizeBytes=max(stats["size"] // degree, 1)
+        )
+        points = [key["_id"] for key in result["splitKeys"]]
+        if points:
+            return points[:degree - 1]
+    except Exception:
+        pass
+
+    # Walk the _id index instead
+    step = count // degree
+    points = []
+    for i in range(1, degree):
+        doc = next(iter(collection.find({}, {"_id": 1})
+                        .sort("_id", 1).skip(i * step).limit(1)), None)
+        if doc is not None:
+            points.append(doc["_id"])
+    return points
+
+
+def partitions (points):
+    """ Turns split points into a list of _id range conditions. """
+
+    bounds = [None] + list(points) + [None]
+    ranges = []
+    for low, high in zip(bounds, bounds[1:]):
+        condition = {}
+        if low is not None:
+            condition["$gte"] = low
+        if high is not None:
+            condition["$lt"] = high
+        ranges.append(condition)
+    return ranges
+
+
+def scan (collection, conditions=None, fields=None, order=None,
+          limit=None, offset=0, degree=None, max_time_ms=None):
+    """
+    Runs a find() on a collection, returning an iterator over the results.
+
+    If the degree of parallelism is above 1, the collection is read
+    in partitions at the same time. With an order given, the partitions
+    are each sorted and merged back together, so the order is kept.
+
+    With max_time_ms, MongoDB stops the query (each partition's)
+    once it's run that long.
+    """
+
+    # (MongoDB takes a limit of 0 to mean no limit at all)
+    if limit == 0:
+        return iter([])
+
+    conditions = conditions or {}
+    degree = DEFAULT_DEGREE if degree is None else degree
+    points = split_points(collection, degree) if degree > 1 else []
+
+    # Small collections (or no parallelism) just get the one cursor
+    if not points:
+        cursor = collection.find(conditions, fields)
+        if order:
+            cursor = cursor.sort(order)
+        if offset:
+            cursor = cursor.skip(offset)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if max_time_ms:
+            cursor = cursor.max_time_ms(max_time_ms)
+        return iter(cursor)
+
+    # Each partition might need to supply all of the rows
+    # (up to the limit), since we don't know where they'll come from
+    per_partition = None if limit is None else offset + limit
+    cursors = []
+    for id_range in partitions(points):
+        partition_conditions = {"$and": [conditions, {"_id": id_range}]}
+        cursor = collection.find(partition_conditions, fields)
+        if order:
+            cursor = cursor.sort(order)
+        if per_partition is not None:
+            cursor = cursor.limit(per_partition)
+        if max_time_ms:
+            cursor = cursor.max_time_ms(max_time_ms)
+        cursors.append(cursor)
+
+    scanner = ParallelScan(cursors, order)
+    if offset or limit is not None:
+        stop = None if limit is None else offset + limit
+        return itertools.islice(scanner, offset, stop)
+    return iter(scanner)
+
+
+
+class ParallelScan (object):
+    """
+    Reads several cursors at once on background threads,
+    and hands back their rows through a single iterator.
+    """
+
+    # Marks the end of a partition in its queue
+    DONE = object()
+
+    def __init__ (self, cursors, order=None):
+        self.cursors = cursors
+        self.order = order
+        self.stopped = threading.Event()
+
+
+    def __iter__ (self):
+        # Ordered scans need a queue per partition for the merge,
+        # while unordered ones can share a single queue.
+        if self.order:
+            queues = [Queue.Queue(QUEUE_SIZE) for c in self.cursors]
+        else:
+            queues = [Queue.Queue(QUEUE_SIZE)] * len(self.cursors)
+
+        threads = []
+        for cursor, queue in zip(self.cursors, queues):
+            thread = threading.Thread(target=self.read, args=(cursor, queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            if self.order:
+                rows = self.merge(queues)
+            else:
+                rows = self.drain(queues[0], len(threads))
+            for row in rows:
+                yield row
+        finally:
+            # Let any remaining readers know they can stop,
+            # in case the client stopped reading early.
+            self.stopped.set()
+
+
+    def read (self, cursor, queue):
+        """ Reads a cursor into a queue (runs on its own thread). """
+
+        try:
+            for row in cursor:
+                if not self.put(queue, row):
+                    cursor.close()
+                    return
+            self.put(queue, self.DONE)
+        except Exception, e:
+            self.put(queue, e)
+
+
+    def put (self, queue, item):
+        """
+        Puts an item in a queue, giving up once the scan is stopped.
+        Returns False if the item couldn't be added.
+        """
+
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+
+    def get (self, queue):
+        """ Gets the next item from a partition's queue. """
+
+        item = queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+    def drain (self, queue, count):
+        """ Reads rows from a shared queue until every partition is done. """
+
+        while count:
+            row = self.get(queue)
+            if row is self.DONE:
+                count -= 1
+            else:
+                yield row
+
+
+    def merge (self, queues):
+        """ Merges the (sorted) partitions back into a single sorted stream. """
+
+        def partition (queue):
+            while True:
+                row = self.get(queue)
+                if row is self.DONE:
+                    return
+                yield row
+
+        # Decorate each row with its sort key (and partition number,
+        # so rows with equal keys never have to be compared)
+        streams = []
+        for i, queue in enumerate(queues):
+            streams.append(
+                ((SortKey(row, self.order), i, row) for row in partition(queue))
+            )
+        for key, i, row in heapq.merge(*streams):
+            yield row
+
+
+
+class SortKey (object):
+    """ Compares documents according to an ORDER BY. """
+
+    __slots__ = ("values", "directions")
+
+    def __init__ (self, doc, order):
+        # (Dotted paths reach into subdocuments, as in sort_documents)
+        self.values = [get_path(doc, field) for field, direction in order]
+        self.directions = [direction for field, direction in order]
+
+    def __eq__ (self, other):
+        return self.values == other.values
+
+    def __ne__ (self, other):
+        return self.values != other.values
+
+    def __lt__ (self, other):
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            if a != b:
+                return (a < b) if direction > 0 else (a > b)
+        return False
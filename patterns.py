@@ -0,0 +1,164 @@
+"""
+Turns LIKE and REGEXP into conditions the backends can use.
+
+A pattern with a fixed prefix (name LIKE 'abc%', or name REGEXP '^abc')
+becomes a range on the field ({$gte: "abc", $lt: "abd"}), which any
+backend's index on the field can serve. Whatever the range doesn't
+cover is checked with a $regex as well, and a LIKE without wildcards
+is just an equality check.
+
+As with =, matching is case sensitive (MongoDB compares strings as
+bytes).
+
+Regexes are compiled once and cached, so filtering in the proxy
+(conditions.matches) doesn't recompile them for every row.
+"""
+
+import re
+
+
+# How many compiled regexes to keep (the cache is emptied when full)
+CACHE_SIZE = 256
+
+# MongoDB's $options, as Python regex flags
+OPTION_FLAGS = {"i": re.I, "m": re.M, "s": re.S, "x": re.X}
+
+# Characters that end a regex's literal prefix
+REGEX_SPECIAL = set(".^$*+?{}[]()|\\")
+
+# Quantifiers, which make the character before them optional
+REGEX_QUANTIFIERS = set("*?{")
+
+_cache = {}
+
+
+
+def compiled (pattern, options=""):
+    """ Gets a compiled regex (with MongoDB-style $options). """
+
+    key = (pattern, options)
+    regex = _cache.get(key)
+    if regex is None:
+        flags = 0
+        for option in options or "":
+            flags |= OPTION_FLAGS.get(option, 0)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        regex = _cache[key] = re.compile(pattern, flags)
+    return regex
+
+
+def inline (pattern, options=""):
+    """ Puts a regex's options into the pattern itself (eg. "(?s)..."). """
+
+    options = "".join(option for option in options or ""
+                      if option in OPTION_FLAGS)
+    if options:
+        return "(?%s)%s" % (options, pattern)
+    return pattern
+
+
+def regexp (pattern, value):
+    """ Checks a value against a regex (as SQLite's REGEXP function). """
+
+    return isinstance(value, basestring) and \
+           compiled(pattern).search(value) is not None
+
+
+def prefix_range (prefix):
+    """
+    Gets the range of strings starting with a prefix, or None
+    if there isn't one that's safe to send to the backend.
+    """
+
+    if not prefix:
+        return None
+    last = ord(prefix[-1])
+    # (Bumping a byte of a multibyte UTF-8 character would make the
+    # bound invalid UTF-8)
+    if last >= 0x7F:
+        return None
+    return {"$gte": prefix, "$lt": prefix[:-1] + chr(last + 1)}
+
+
+def like_parts (pattern):
+    """
+    Splits up a LIKE pattern, returning (the regex for it, its literal
+    prefix, whether it has any wildcards, and whether it's just the
+    prefix then %s).
+    """
+
+    regex = []
+    prefix = []
+    wildcards = False
+    chars = iter(pattern)
+    for char in chars:
+        if char == "\\":
+            # An escaped wildcard (or backslash)
+            char = next(chars, "\\")
+        elif char in "%_":
+            wildcards = True
+            regex.append(".*" if char == "%" else ".")
+            continue
+        if not wildcards:
+            prefix.append(char)
+        regex.append(re.escape(char))
+    prefix = "".join(prefix)
+    rest = regex[len(prefix):]
+    only_prefix = bool(rest) and all(part == ".*" for part in rest)
+    return "".join(regex), prefix, wildcards, only_prefix
+
+
+def like (pattern):
+    """ Gets the condition for field LIKE pattern. """
+
+    regex, prefix, wildcards, only_prefix = like_parts(pattern)
+    if not wildcards:
+        return prefix
+    condition = prefix_range(prefix)
+    if condition is None:
+        condition = {}
+    elif only_prefix:
+        # The range is the whole of it
+        return condition
+    # (% matches newlines too)
+    condition.update({"$regex": "^%s$" % regex, "$options": "s"})
+    return condition
+
+
+def regex_prefix (pattern):
+    """ Gets the literal prefix of an anchored regex ("" if none). """
+
+    if not pattern.startswith("^") or "|" in pattern:
+        return ""
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and \
+           not pattern[i + 1].isalnum():
+            # An escaped punctuation character is a literal
+            char = pattern[i + 1]
+            i += 1
+        elif char in REGEX_SPECIAL:
+            break
+        prefix.append(char)
+        i += 1
+    if i < len(pattern) and pattern[i] in REGEX_QUANTIFIERS:
+        prefix = prefix[:-1]
+    return "".join(prefix)
+
+
+def regexp_condition (pattern):
+    """ Gets the condition for field REGEXP pattern. """
+
+    condition = prefix_range(regex_prefix(pattern)) or {}
+    condition["$regex"] = pattern
+    return condition
+
+
+# The condition builders for each pattern operator type
+PATTERN_OPERATORS = {
+    "like": like,
+    "regular_expression": regexp_condition,
+}
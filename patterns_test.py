@@ -0,0 +1,62 @@
+import unittest
+import patterns
+from conditions import matches
+from memory_backend import MemoryBackend
+from pysql import SelectQuery
+
+class PatternTests(unittest.TestCase):
+    def test_like(self):
+        """ LIKE should become ranges where it can, and regexes otherwise. """
+        self.assertEqual({"$gte": "abc", "$lt": "abd"}, patterns.like("abc%"))
+        self.assertEqual("a%c", patterns.like("a\\%c"))
+        self.assertEqual({"$gte": "a", "$lt": "b", "$regex": "^a.c.*$",
+                          "$options": "s"}, patterns.like("a_c%"))
+        self.assertEqual({"$regex": "^.*\\.txt$", "$options": "s"},
+                         patterns.like("%.txt"))
+        # No range for a multibyte last character
+        self.assertEqual({"$regex": "^caf\\\xc3\\\xa9.*$", "$options": "s"},
+                         patterns.like("caf\xc3\xa9%"))
+
+    def test_regexp(self):
+        """ Anchored regexes should get a range for their prefix. """
+        self.assertEqual({"$gte": "ab", "$lt": "ac", "$regex": "^abc?d"},
+                         patterns.regexp_condition("^abc?d"))
+        self.assertEqual({"$gte": "a.b", "$lt": "a.c", "$regex": "^a\\.b"},
+                         patterns.regexp_condition("^a\\.b"))
+        self.assertEqual({"$regex": "^a|b"}, patterns.regexp_condition("^a|b"))
+        self.assertEqual({"$regex": "abc"}, patterns.regexp_condition("abc"))
+
+    def test_matches(self):
+        """ Filtering in the proxy should agree with the patterns. """
+        names = ["abc", "abd", "xabc", "ab\nc", "Abc", 5, None]
+        cases = [("name LIKE 'ab%'", ["abc", "abd", "ab\nc"]),
+                 ("name LIKE 'a_c'", ["abc"]),
+                 ("name LIKE '%b%c'", ["abc", "xabc", "ab\nc", "Abc"]),
+                 ("name REGEXP 'b[cd]$'", ["abc", "abd", "xabc", "Abc"])]
+        for where, expected in cases:
+            table, conditions = SelectQuery(
+                "select name from t where " + where).execute()
+            self.assertEqual(expected, [name for name in names
+                                        if matches({"name": name}, conditions)])
+
+    def test_index(self):
+        """ A LIKE prefix should be looked up in a sorted index. """
+        backend = MemoryBackend()
+        backend.insert("t", [{"name": name} for name in
+                             ["apple", "apricot", "banana", "ap"]])
+        backend.create_index("t", [("name", 1)])
+        condition = {"name": patterns.like("apr%")}
+        ids, ordered = backend.table("t").plan(condition, None)
+        self.assertEqual(1, len(ids))
+        self.assertEqual(["apricot"], [doc["name"] for doc in
+                                       backend.find("t", condition)])
+
+    def test_cache(self):
+        """ Regexes should only be compiled once. """
+        self.assertTrue(patterns.compiled("^a.c$", "s") is
+                        patterns.compiled("^a.c$", "s"))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+Pre-fork server mode, for using more than one core.
+
+The proxy's parsing and packet encoding are Python, so one process
+can only keep one core busy (the GIL). In pre-fork mode a supervisor
+starts N worker processes, which each bind the same port with
+SO_REUSEPORT and run an ordinary (threaded) MySQLServer, with their
+own backend connections. The kernel spreads new connections across
+them, and the supervisor restarts any worker that dies.
+
+Each worker publishes its metrics into a shared memory area every
+PUBLISH_INTERVAL, and the supervisor serves the totals on the metrics
+port, so a scrape sees the whole server rather than one worker.
+"""
+
+import os
+import time
+import mmap
+import errno
+import signal
+import socket
+import struct
+import logging
+import threading
+
+import sessions
+
+
+log = logging.getLogger("pysql.prefork")
+
+# SO_REUSEPORT (Python 2's socket module doesn't have it, but Linux does)
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# How often workers publish their metrics (in seconds)
+PUBLISH_INTERVAL = 1.0
+
+# Room for each worker's metrics in the shared area
+SLOT_SIZE = 1 << 20
+
+# Workers that die sooner than this after starting get restarted
+# after RESTART_DELAY, rather than straight away (so a worker that
+# can't start doesn't turn into a fork loop)
+MIN_UPTIME = 5.0
+RESTART_DELAY = 1.0
+
+# Each worker's session ids start at slot << ID_BITS, so KILL and
+# SHOW PROCESSLIST ids are unique across the workers. (Each worker
+# only lists, and can only KILL, its own sessions, and a KILL of
+# another worker's session gets an error saying so.)
+ID_BITS = 24
+
+# The top bits of a worker's ids are its generation (how many times
+# its slot has been started), so a restarted worker doesn't hand out
+# the ids its predecessor's clients (or capture logs) still have
+GENERATION_BITS = 4
+
+# Slot header: generation (odd while it's being written), length
+HEADER = struct.Struct("< Q I")
+
+
+
+def merge_exposition (texts):
+    """
+    Adds up metrics in the Prometheus text format (from each worker).
+    Samples with the same name and labels are summed, which is right
+    for counters, histogram buckets and the gauges we have (which
+    count things like sessions).
+    """
+
+    order = []
+    values = {}
+    for text in texts:
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                key, value = line, None
+            else:
+                key, value = line.rsplit(" ", 1)
+                value = float(value) if "." in value or "e" in value \
+                        else int(value)
+            if key not in values:
+                order.append(key)
+                values[key] = value
+            elif value is not None:
+                values[key] += value
+
+    lines = []
+    for key in order:
+        value = values[key]
+        if value is None:
+            lines.append(key)
+        else:
+            lines.append("%s %s" % (key, repr(value)
+                                    if isinstance(value, float) else value))
+    return "\n".join(lines) + "\n"
+
+
+
+class SharedMetrics (object):
+    """
+    A shared memory area with a slot for each worker's metrics.
+
+    It's made before forking, so the workers and the supervisor all
+    map the same memory. Each slot has a single writer (its worker),
+    and readers check its generation number around their copy, so
+    no lock is needed (and a worker dying mid-write can't block
+    anyone).
+    """
+
+    def __init__ (self, slots, slot_size=SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        # Anonymous maps are shared with the children after a fork
+        self.memory = mmap.mmap(-1, slots * slot_size)
+
+
+    def publish (self, slot, text):
+        """ Writes a worker's metrics into its slot. """
+
+        start = slot * self.slot_size
+        room = self.slot_size - HEADER.size
+        if len(text) > room:
+            log.warning("Metrics too big for the shared area (%d bytes)",
+                        len(text))
+            text = text[:text.rfind("\n", 0, room) + 1]
+        generation, length = HEADER.unpack_from(self.memory, start)
+        # An odd generation marks the slot as being written
+        HEADER.pack_into(self.memory, start, generation + 1, length)
+        body = start + HEADER.size
+        self.memory[body:body + len(text)] = text
+        HEADER.pack_into(self.memory, start, generation + 2, len(text))
+
+
+    def read (self, slot, tries=10):
+        """ Reads a worker's metrics (or "" if they're mid-write). """
+
+        start = slot * self.slot_size
+        body = start + HEADER.size
+        for i in range(tries):
+            generation, length = HEADER.unpack_from(self.memory, start)
+            if generation % 2 == 0:
+                text = self.memory[body:body + length]
+                if HEADER.unpack_from(self.memory, start)[0] == generation:
+                    return text
+            time.sleep(0.001)
+        return ""
+
+
+    def clear (self, slot):
+        """ Empties a slot (for a worker starting over). """
+
+        start = slot * self.slot_size
+        generation, length = HEADER.unpack_from(self.memory, start)
+        # Keep it even (the old writer might have died mid-write)
+        HEADER.pack_into(self.memory, start, generation + 2 - generation % 2,
+                         0)
+
+
+    def expose (self):
+        """ Gets every worker's metrics, added up (like a Registry). """
+
+        return merge_exposition(self.read(slot) for slot in range(self.slots))
+
+
+    def publish_forever (self, slot, registry, interval=PUBLISH_INTERVAL):
+        while True:
+            try:
+                self.publish(slot, registry.expose())
+            except Exception:
+                log.exception("Couldn't publish the metrics")
+            time.sleep(interval)
+
+
+
+def id_range (slot, generation):
+    """ Gets the (first, last) session ids for a worker. """
+
+    session_bits = ID_BITS - GENERATION_BITS
+    start = (slot << ID_BITS) + \
+            ((generation % (1 << GENERATION_BITS)) << session_bits)
+    return start + 1, start + (1 << session_bits) - 1
+
+
+
+class Supervisor (object):
+    """
+    Runs a server in several worker processes, restarting them if
+    they die.
+
+    make_server is called in each worker (after the fork) to make
+    the server it runs, which should bind with SO_REUSEPORT.
+    """
+
+    def __init__ (self, make_server, workers, shared=None, registry=None):
+        self.make_server = make_server
+        self.workers = workers
+        # The metrics to publish from each worker (see metrics.REGISTRY)
+        self.registry = registry
+        self.shared = shared or SharedMetrics(workers)
+        # pid -> (slot, start time)
+        self.pids = {}
+        # How many workers each slot has started
+        self.generations = [0] * workers
+        self.stopping = False
+
+
+    def spawn (self, slot):
+        """ Starts a worker process in a slot. """
+
+        self.shared.clear(slot)
+        generation = self.generations[slot]
+        self.generations[slot] += 1
+        pid = os.fork()
+        if pid == 0:
+            self.worker(slot, generation)
+        self.pids[pid] = (slot, time.time())
+        log.info("Started worker %d (pid %d)", slot, pid)
+        return pid
+
+
+    def worker (self, slot, generation=0):
+        """ Runs a worker (in the child process). Never returns. """
+
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            sessions.registry = sessions.SessionRegistry(
+                *id_range(slot, generation))
+            server = self.make_server()
+            if self.registry is not None:
+                publisher = threading.Thread(
+                    target=self.shared.publish_forever,
+                    args=(slot, self.registry))
+                publisher.daemon = True
+                publisher.start()
+            server.serve_forever()
+            status = 0
+        except Exception:
+            log.exception("Worker %d failed", slot)
+        finally:
+            os._exit(status)
+
+
+    def run (self):
+        """ Starts the workers, and restarts them until stopped. """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                # (Interrupted by a signal)
+                if e.errno in (errno.EINTR, errno.ECHILD):
+                    continue
+                raise
+            if pid not in self.pids:
+                continue
+            slot, started = self.pids.pop(pid)
+            if self.stopping:
+                continue
+            log.warning("Worker %d (pid %d) died with status %d, restarting",
+                        slot, pid, status)
+            if time.time() - started < MIN_UPTIME:
+                time.sleep(RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(slot)
+
+
+    def stop (self, *args):
+        """ Stops the workers (from a signal handler, or another thread). """
+
+        self.stopping = True
+        for pid in self.pids.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
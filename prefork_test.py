@@ -0,0 +1,104 @@
+import os
+import threading
+import unittest
+import prefork
+import sessions
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+
+class PreforkTests(unittest.TestCase):
+    def test_merge(self):
+        """ Samples from each worker should be added up. """
+        one = "# TYPE c counter\nc{a=\"x y\"} 2\nh_sum 0.5\n"
+        two = "# TYPE c counter\nc{a=\"x y\"} 3\nc{a=\"z\"} 1\nh_sum 0.25\n"
+        self.assertEqual("# TYPE c counter\nc{a=\"x y\"} 5\nh_sum 0.75\n"
+                         "c{a=\"z\"} 1\n",
+                         prefork.merge_exposition([one, two]))
+
+    def test_shared_metrics(self):
+        """ Metrics published by a child should be seen by the parent. """
+        shared = prefork.SharedMetrics(2, slot_size=4096)
+        shared.publish(0, "c 1\n")
+        pid = os.fork()
+        if pid == 0:
+            shared.publish(1, "c 2\nd 3\n")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual("c 3\nd 3\n", shared.expose())
+        shared.clear(1)
+        self.assertEqual("c 1\n", shared.expose())
+
+    def test_reuse_port(self):
+        """ Two servers should be able to listen on the one port. """
+        one = MySQLServer(("127.0.0.1", 0), MemoryBackend(), reuse_port=True)
+        port = one.server_address[1]
+        two = MySQLServer(("127.0.0.1", port), MemoryBackend(),
+                          reuse_port=True)
+        try:
+            self.assertEqual(port, two.server_address[1])
+        finally:
+            one.server_close()
+            two.server_close()
+
+    def test_id_ranges(self):
+        """ Restarted workers shouldn't reuse their predecessors' ids. """
+        ranges = [prefork.id_range(slot, generation)
+                  for slot in range(3)
+                  for generation in range(1 << prefork.GENERATION_BITS)]
+        self.assertEqual(1, ranges[0][0])
+        for (first, last), (next_first, next_last) in zip(ranges, ranges[1:]):
+            self.assertEqual(last + 2, next_first)
+        self.assertTrue(ranges[-1][1] < 3 << prefork.ID_BITS)
+        # (The generations wrap around, eventually)
+        self.assertEqual(prefork.id_range(0, 0),
+                         prefork.id_range(0, 1 << prefork.GENERATION_BITS))
+
+    def test_id_wrap(self):
+        """ A worker out of ids should start over, skipping live ones. """
+        class Session(object):
+            def __init__(self, thread_id):
+                self.thread_id = thread_id
+        registry = sessions.SessionRegistry(first_id=5, last_id=7)
+        ids = [registry.next_id() for i in range(3)]
+        self.assertEqual([5, 6, 7], ids)
+        registry.add(Session(5))
+        registry.add(Session(7))
+        self.assertEqual(6, registry.next_id())
+        self.assertEqual(6, registry.next_id())
+
+    def test_kill_other_worker(self):
+        """ KILLing another worker's session should say why it can't. """
+        registry = sessions.registry
+        # (As worker 1 sets it up)
+        sessions.registry = sessions.SessionRegistry(*prefork.id_range(1, 0))
+        server = MySQLServer(("127.0.0.1", 0), MemoryBackend())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = MySQLClient(port=server.server_address[1])
+            self.assertEqual((1 << prefork.ID_BITS) + 1, client.thread_id)
+            # Worker 0's first session
+            try:
+                client.query("KILL 1")
+                self.fail("KILL of another worker's session went through")
+            except MySQLError, e:
+                self.assertEqual(1235, e.code)
+                self.assertTrue("another pysql worker" in e.message)
+            # Its own unknown ids are still just unknown
+            try:
+                client.query("KILL %d" % ((1 << prefork.ID_BITS) + 99))
+                self.fail("KILL of an unknown session went through")
+            except MySQLError, e:
+                self.assertEqual(sessions.ER_NO_SUCH_THREAD, e.code)
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            sessions.registry = registry
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+"""
+Prepared statements and server-side cursors.
+
+Statements are prepared by counting their ? placeholders, and
+executed by binding the parameters (sent in the binary protocol)
+into the SQL as literals, which then runs like any other query.
+
+Executing with the cursor flag keeps the backend's cursor open, and
+COM_STMT_FETCH reads N rows at a time off it, so a client can page
+through a huge result without the proxy holding (or sending) any
+more of it than was asked for. Cursors left idle for longer than
+CURSOR_IDLE_TIMEOUT are closed, freeing the backend cursor.
+"""
+
+import re
+import time
+import struct
+import logging
+import itertools
+import threading
+
+import metrics
+
+
+log = logging.getLogger("pysql.prepared")
+
+# Close cursors nobody has fetched from for this long (in seconds)
+CURSOR_IDLE_TIMEOUT = 300.0
+
+# How often to look for idle cursors
+REAP_INTERVAL = 10.0
+
+# COM_STMT_EXECUTE flags
+CURSOR_TYPE_READ_ONLY = 0x01
+
+# Server status flags for cursors
+SERVER_STATUS_CURSOR_EXISTS = 0x0040
+SERVER_STATUS_LAST_ROW_SENT = 0x0080
+
+# Column types (for the parameters)
+MYSQL_TYPE_DECIMAL = 0x00
+MYSQL_TYPE_TINY = 0x01
+MYSQL_TYPE_SHORT = 0x02
+MYSQL_TYPE_LONG = 0x03
+MYSQL_TYPE_FLOAT = 0x04
+MYSQL_TYPE_DOUBLE = 0x05
+MYSQL_TYPE_NULL = 0x06
+MYSQL_TYPE_TIMESTAMP = 0x07
+MYSQL_TYPE_LONGLONG = 0x08
+MYSQL_TYPE_INT24 = 0x09
+MYSQL_TYPE_DATE = 0x0a
+MYSQL_TYPE_TIME = 0x0b
+MYSQL_TYPE_DATETIME = 0x0c
+MYSQL_TYPE_YEAR = 0x0d
+MYSQL_TYPE_VAR_STRING = 0xfd
+MYSQL_TYPE_STRING = 0xfe
+
+# How the fixed-size types are packed (signed, unsigned)
+FIXED_TYPES = {
+    MYSQL_TYPE_TINY: ("< b", "< B"),
+    MYSQL_TYPE_SHORT: ("< h", "< H"),
+    MYSQL_TYPE_YEAR: ("< h", "< H"),
+    MYSQL_TYPE_LONG: ("< i", "< I"),
+    MYSQL_TYPE_INT24: ("< i", "< I"),
+    MYSQL_TYPE_LONGLONG: ("< q", "< Q"),
+    MYSQL_TYPE_FLOAT: ("< f", "< f"),
+    MYSQL_TYPE_DOUBLE: ("< d", "< d"),
+}
+DATE_TYPES = (MYSQL_TYPE_DATE, MYSQL_TYPE_DATETIME, MYSQL_TYPE_TIMESTAMP)
+
+# Quoted strings (which can have ?s in them) and placeholders
+placeholder_regex = re.compile(r"'(?:[^'\\]|\\[\s\S]|'')*'"
+                               r'|"(?:[^"\\]|\\[\s\S]|"")*"'
+                               r"|`[^`]*`|(\?)")
+
+
+
+class PreparedStatementError (Exception):
+    """ A prepared statement couldn't be executed. """
+
+
+
+def read_length_coded (data, pos):
+    """
+    Reads a length coded binary, returning (value, new position), with
+    None for a NULL.
+    """
+
+    first = ord(data[pos])
+    if first < 251:
+        return first, pos + 1
+    elif first == 251:
+        return None, pos + 1
+    elif first == 252:
+        return struct.unpack("< H", data[pos + 1:pos + 3])[0], pos + 3
+    elif first == 253:
+        return struct.unpack("< I", data[pos + 1:pos + 4] + "\0")[0], pos + 4
+    else:
+        return struct.unpack("< Q", data[pos + 1:pos + 9])[0], pos + 9
+
+
+def read_value (data, pos, kind):
+    """ Reads a binary protocol value, returning (value, new position). """
+
+    unsigned = kind & 0x8000
+    kind &= 0xFF
+    if kind in FIXED_TYPES:
+        packer = struct.Struct(FIXED_TYPES[kind][1 if unsigned else 0])
+        return packer.unpack_from(data, pos)[0], pos + packer.size
+    elif kind in DATE_TYPES:
+        # A length, then as many of the parts as aren't zero
+        length = ord(data[pos])
+        raw = data[pos + 1:pos + 1 + length]
+        year = month = day = hour = minute = second = 0
+        if length >= 4:
+            year, month, day = struct.unpack("< H B B", raw[:4])
+        if length >= 7:
+            hour, minute, second = struct.unpack("< B B B", raw[4:7])
+        value = "%04d-%02d-%02d" % (year, month, day)
+        if kind != MYSQL_TYPE_DATE:
+            value += " %02d:%02d:%02d" % (hour, minute, second)
+        return value, pos + 1 + length
+    elif kind == MYSQL_TYPE_TIME:
+        length = ord(data[pos])
+        value = "00:00:00"
+        if length:
+            negative, days, hours, minutes, seconds = struct.unpack(
+                "< B I B B B", data[pos + 1:pos + 9])
+            value = "%s%02d:%02d:%02d" % ("-" if negative else "",
+                                          days * 24 + hours, minutes, seconds)
+        return value, pos + 1 + length
+    # Everything else (strings, decimals, blobs) is length coded
+    length, pos = read_length_coded(data, pos)
+    return data[pos:pos + length], pos + length
+
+
+def literal (value):
+    """ Turns a parameter into an SQL literal. """
+
+    if value is None:
+        return "NULL"
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+
+class PreparedStatement (object):
+    """ A statement prepared with COM_STMT_PREPARE. """
+
+    def __init__ (self, statement_id, sql):
+        self.id = statement_id
+        self.sql = sql
+        # Split the SQL around its placeholders
+        self.parts = []
+        start = 0
+        for match in placeholder_regex.finditer(sql):
+            if match.group(1):
+                self.parts.append(sql[start:match.start()])
+                start = match.end()
+        self.parts.append(sql[start:])
+        self.params = len(self.parts) - 1
+        # The parameter types, which the client only sends when
+        # they change, and any COM_STMT_SEND_LONG_DATA values
+        self.types = None
+        self.long_data = {}
+
+
+    def read_execute (self, data):
+        """
+        Reads the arguments of a COM_STMT_EXECUTE (after the
+        statement id), returning (flags, parameters).
+        """
+
+        flags, iterations = struct.unpack("< B I", data[:5])
+        pos = 5
+        values = []
+        if self.params:
+            bitmap = data[pos:pos + (self.params + 7) // 8]
+            pos += len(bitmap)
+            if ord(data[pos]):
+                self.types = struct.unpack(
+                    "< %dH" % self.params,
+                    data[pos + 1:pos + 1 + 2 * self.params])
+                pos += 2 * self.params
+            pos += 1
+            if self.types is None:
+                raise PreparedStatementError("No parameter types were sent")
+            for i in range(self.params):
+                if ord(bitmap[i // 8]) & (1 << (i % 8)):
+                    values.append(None)
+                elif i in self.long_data:
+                    values.append(self.long_data[i])
+                else:
+                    value, pos = read_value(data, pos, self.types[i])
+                    values.append(value)
+        self.long_data = {}
+        return flags, values
+
+
+    def bind (self, values):
+        """ Puts parameters into the SQL. """
+
+        if len(values) != self.params:
+            raise PreparedStatementError(
+                "Expected %d parameters, got %d" % (self.params, len(values)))
+        sql = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            sql.append(literal(value))
+            sql.append(part)
+        return "".join(sql)
+
+
+
+class CursorClosed (Exception):
+    """ A cursor was closed (eg. for being idle too long). """
+
+
+
+class Cursor (object):
+    """ An open result set, read N rows at a time by COM_STMT_FETCH. """
+
+    def __init__ (self, columns, rows, source=None):
+        self.columns = columns
+        # The rows (as lists), and the backend cursor they come from
+        self.rows = rows
+        self.source = source
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.closed = False
+        cursors.add(self)
+
+
+    def fetch (self, count):
+        """ Gets the next rows, and whether those were the last ones. """
+
+        with self.lock:
+            if self.closed:
+                raise CursorClosed()
+            rows = list(itertools.islice(self.rows, count))
+            self.last_used = time.time()
+        return rows, len(rows) < count
+
+
+    def idle (self):
+        return time.time() - self.last_used
+
+
+    def close (self):
+        """ Closes the cursor, and the backend's cursor with it. """
+
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for it in (self.rows, self.source):
+                if hasattr(it, "close"):
+                    try:
+                        it.close()
+                    except Exception:
+                        log.exception("Couldn't close a cursor")
+            # Dropping the references lets anything without
+            # a close() (eg. pymongo's cursors) clean up too
+            self.rows = self.source = None
+        cursors.remove(self)
+
+
+
+class CursorRegistry (object):
+    """ Keeps track of every open cursor, closing the idle ones. """
+
+    def __init__ (self, timeout=CURSOR_IDLE_TIMEOUT, interval=REAP_INTERVAL):
+        self.timeout = timeout
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.cursors = set()
+        self.reaper = None
+
+
+    def add (self, cursor):
+        with self.lock:
+            self.cursors.add(cursor)
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap_forever)
+                self.reaper.daemon = True
+                self.reaper.start()
+        metrics.cursors_open.inc()
+
+
+    def remove (self, cursor):
+        with self.lock:
+            if cursor not in self.cursors:
+                return
+            self.cursors.discard(cursor)
+        metrics.cursors_open.dec()
+
+
+    def reap (self):
+        """ Closes the cursors that have been idle too long. """
+
+        with self.lock:
+            idle = [c for c in self.cursors if c.idle() > self.timeout]
+        for cursor in idle:
+            log.info("Closing a cursor idle for %.0fs", cursor.idle())
+            cursor.close()
+        return len(idle)
+
+
+    def reap_forever (self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception:
+                log.exception("Couldn't reap cursors")
+
+
+# All the open cursors (across sessions)
+cursors = CursorRegistry()
@@ -0,0 +1,84 @@
+import threading
+import unittest
+import prepared
+from prepared import PreparedStatement, Cursor, CursorClosed
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient
+from pysql import MySQLServer
+
+class PreparedTests(unittest.TestCase):
+    def test_bind(self):
+        """ Placeholders in quotes should be left alone. """
+        statement = PreparedStatement(1, "SELECT a FROM t WHERE b = ? "
+                                         "AND c = 'it\\'s ?' AND d < ?")
+        self.assertEqual(2, statement.params)
+        self.assertEqual("SELECT a FROM t WHERE b = 'it\\'s' "
+                         "AND c = 'it\\'s ?' AND d < NULL",
+                         statement.bind(["it's", None]))
+
+    def test_reap(self):
+        """ Idle cursors should get closed, along with their source. """
+        class Source(object):
+            closed = False
+            def close(self):
+                self.closed = True
+        source = Source()
+        cursor = Cursor(["a"], iter([[1], [2], [3]]), source)
+        self.assertEqual(([[1], [2]], False), cursor.fetch(2))
+        registry = prepared.cursors
+        timeout, registry.timeout = registry.timeout, 0
+        try:
+            self.assertTrue(registry.reap() >= 1)
+        finally:
+            registry.timeout = timeout
+        self.assertTrue(source.closed)
+        self.assertRaises(CursorClosed, cursor.fetch, 1)
+
+    def test_fetch(self):
+        """ Cursors should hand out the rows a few at a time. """
+        backend = MemoryBackend()
+        backend.insert("t", [{"a": i, "b": "x%d" % i} for i in range(10)])
+        server = MySQLServer(("127.0.0.1", 0), backend)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = MySQLClient(port=server.server_address[1])
+        try:
+            statement, params = client.prepare(
+                "SELECT a, b FROM t WHERE a >= ? ORDER BY a")
+            self.assertEqual(1, params)
+            self.assertEqual((["a", "b"], [["8", "x8"], ["9", "x9"]]),
+                             client.execute(statement, [8]))
+            client.execute(statement, [3], cursor=True)
+            self.assertEqual(([["3", "x3"], ["4", "x4"], ["5", "x5"]], False),
+                             client.fetch(statement, 3))
+            rows, done = client.fetch(statement, 10)
+            self.assertEqual((4, True), (len(rows), done))
+            # An empty result still gets its columns, and a cursor
+            self.assertEqual((["a", "b"], []),
+                             client.execute(statement, [100], cursor=True))
+            self.assertEqual(([], True), client.fetch(statement, 10))
+            everything = client.prepare("SELECT * FROM t WHERE a > ?")[0]
+            self.assertEqual((["a", "b"], []),
+                             client.execute(everything, [100], cursor=True))
+            self.assertEqual(([], True), client.fetch(everything, 10))
+            client.close_statement(statement)
+            self.assertEqual(0, client.ping())
+
+            # Any string should bind (and match itself)
+            statement = client.prepare("SELECT a FROM t WHERE b = ?")[0]
+            for i, b in enumerate(["", "it's \"quoted\"", "back\\slash\\",
+                                   "50% \\% _ \\_ \0 \n ?"]):
+                client.query("INSERT INTO t (a, b) VALUES (%d, %s)"
+                             % (100 + i, prepared.literal(b)))
+                self.assertEqual((["a"], [[str(100 + i)]]),
+                                 client.execute(statement, [b]))
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""
+Per-query timing instrumentation.
+
+Each query gets a QueryProfile, which records how long each phase
+(packet read, tokenize, parse, plan, backend, encode, write) took.
+Finished profiles are kept by QueryStats, which backs SHOW PROFILE(S),
+SHOW STATUS and the pysql.query_stats virtual table.
+"""
+
+import time
+import logging
+import threading
+import collections
+import itertools
+
+
+log = logging.getLogger("pysql")
+slow_log = logging.getLogger("pysql.slow")
+
+# Queries taking longer than this (in seconds) go to the slow query log
+SLOW_QUERY_TIME = 1.0
+
+# How many finished queries to keep around for pysql.query_stats
+HISTORY_SIZE = 100
+
+# The phases, in the order they happen
+PHASES = ("read", "tokenize", "parse", "plan", "backend", "encode", "write")
+
+
+
+class QueryProfile (object):
+    """ Timings and counters for a single query. """
+
+    _ids = itertools.count(1)
+
+    def __init__ (self, statement=""):
+        self.id = next(self._ids)
+        self.statement = statement
+        self.started = time.time()
+        self.duration = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows = 0
+        self.bytes_sent = 0
+
+
+    def add (self, phase, seconds):
+        """ Adds some time to a phase (phases can be timed in pieces). """
+
+        self.phases[phase] += seconds
+
+
+    def phase (self, name):
+        """
+        Times a block of code as part of a phase, eg.
+            with profile.phase("parse"):
+                ...
+        """
+
+        return _PhaseTimer(self, name)
+
+
+    def timed_rows (self, rows, phase="backend"):
+        """
+        Wraps a row iterator, counting the rows and adding the time
+        spent waiting on the next one to a phase.
+        """
+
+        rows = iter(rows)
+        clock = time.time
+        while True:
+            start = clock()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.phases[phase] += clock() - start
+                return
+            self.phases[phase] += clock() - start
+            self.rows += 1
+            yield row
+
+
+    def finish (self):
+        """ Marks the query as done, and records it. """
+
+        self.duration = time.time() - self.started
+        stats.record(self)
+
+
+
+class _PhaseTimer (object):
+    __slots__ = ("profile", "name", "start")
+
+    def __init__ (self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__ (self):
+        self.start = time.time()
+
+    def __exit__ (self, *exc_info):
+        self.profile.phases[self.name] += time.time() - self.start
+
+
+
+class QueryStats (object):
+    """ Server-wide query history and status counters. """
+
+    def __init__ (self, history_size=HISTORY_SIZE):
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=history_size)
+        self.status = collections.OrderedDict([
+            ("Questions", 0),
+            ("Slow_queries", 0),
+            ("Rows_sent", 0),
+            ("Bytes_sent", 0),
+            ("Threads_connected", 0),
+        ])
+
+
+    def record (self, profile):
+        """ Adds a finished query to the history and the counters. """
+
+        with self.lock:
+            self.history.append(profile)
+            self.status["Questions"] += 1
+            self.status["Rows_sent"] += profile.rows
+            self.status["Bytes_sent"] += profile.bytes_sent
+            slow = profile.duration >= SLOW_QUERY_TIME
+            if slow:
+                self.status["Slow_queries"] += 1
+
+        if slow:
+            slow_log.warning(
+                "Slow query (%.3fs, %d rows): %s",
+                profile.duration, profile.rows, profile.statement
+            )
+
+
+    def adjust (self, name, amount):
+        """ Adds to (or subtracts from) a status counter. """
+
+        with self.lock:
+            self.status[name] = self.status.get(name, 0) + amount
+
+
+    def recent (self):
+        """ Gets a snapshot of the recent queries, oldest first. """
+
+        with self.lock:
+            return list(self.history)
+
+
+    def snapshot (self):
+        """ Gets a snapshot of the status counters. """
+
+        with self.lock:
+            return self.status.items()
+
+
+# The stats for the whole server
+stats = QueryStats()
+
+
+def profile_rows (profile):
+    """ Rows for SHOW PROFILE: one per phase. """
+
+    return [[name, "%.6f" % profile.phases[name]] for name in PHASES]
+
+
+def query_stats_rows (profiles):
+    """ Rows for the pysql.query_stats table. """
+
+    rows = []
+    for p in profiles:
+        rows.append(
+            [str(p.id), p.statement, "%.6f" % p.duration, str(p.rows),
+             str(p.bytes_sent)] +
+            ["%.6f" % p.phases[name] for name in PHASES]
+        )
+    return rows
+
+QUERY_STATS_COLUMNS = ["Query_ID", "Query", "Duration", "Rows_sent",
+                       "Bytes_sent"] + [name.capitalize() for name in PHASES]
@@ -0,0 +1,119 @@
+import time
+import logging
+import threading
+import unittest
+import profiling
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient
+from pysql import MySQLServer
+
+class SlowBackend(MemoryBackend):
+    """ Takes its time over the rows of the "slow" table. """
+    def scan(self, table, *args, **options):
+        for doc in MemoryBackend.scan(self, table, *args, **options):
+            if table == "slow":
+                time.sleep(0.1)
+            yield doc
+
+class LogRecords(logging.Handler):
+    """ Keeps the records logged to it. """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class ProfilingTests(unittest.TestCase):
+    def setUp(self):
+        backend = SlowBackend()
+        backend.insert("t", [{"a": 1}, {"a": 2}])
+        backend.insert("slow", [{"a": 1}, {"a": 2}])
+        self.server = MySQLServer(("127.0.0.1", 0), backend)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = MySQLClient(port=self.server.server_address[1])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def status(self):
+        return dict(self.client.query("SHOW STATUS")[1])
+
+    def test_show_profile(self):
+        """ SHOW PROFILE(S) should cover the session's own queries. """
+        self.assertEqual((["a"], [["1"], ["2"]]),
+                         self.client.query("select a from t"))
+        columns, rows = self.client.query("SHOW PROFILES")
+        self.assertEqual(["Query_ID", "Duration", "Query"], columns)
+        self.assertEqual(["select a from t"], [row[2] for row in rows])
+        query_id = rows[0][0]
+
+        columns, rows = self.client.query("SHOW PROFILE")
+        self.assertEqual(["Status", "Duration"], columns)
+        self.assertEqual(list(profiling.PHASES), [row[0] for row in rows])
+        # (Now the last query is SHOW PROFILES)
+        columns, rows = self.client.query("SHOW PROFILE FOR QUERY " + query_id)
+        self.assertEqual(list(profiling.PHASES), [row[0] for row in rows])
+        self.assertEqual([], self.client.query("SHOW PROFILE FOR QUERY 0")[1])
+
+        # Another session's queries are its own
+        other = MySQLClient(port=self.server.server_address[1])
+        try:
+            self.assertEqual([], other.query("SHOW PROFILES")[1])
+        finally:
+            other.close()
+
+    def test_show_status(self):
+        """ SHOW STATUS should count the queries and the rows sent. """
+        before = self.status()
+        self.assertEqual((["a"], [["1"], ["2"]]),
+                         self.client.query("select a from t"))
+        after = self.status()
+        # (The first SHOW STATUS, and the SELECT)
+        self.assertEqual(int(before["Questions"]) + 2, int(after["Questions"]))
+        self.assertEqual(int(before["Rows_sent"]) + 2 + len(before),
+                         int(after["Rows_sent"]))
+        self.assertGreaterEqual(int(after["Threads_connected"]), 1)
+
+    def test_query_stats(self):
+        """ pysql.query_stats should list recent queries, with their rows. """
+        self.client.query("select a from t where a = 2")
+        columns, rows = self.client.query("SELECT * FROM pysql.query_stats")
+        self.assertEqual(profiling.QUERY_STATS_COLUMNS, columns)
+        stats = dict((row[1], row) for row in rows)
+        row = stats["select a from t where a = 2"]
+        self.assertEqual("1", row[columns.index("Rows_sent")])
+        self.assertTrue(float(row[columns.index("Duration")]) >= 0)
+
+    def test_slow_log(self):
+        """ Only queries over the threshold should go to the slow log. """
+        handler = LogRecords()
+        profiling.slow_log.addHandler(handler)
+        threshold = profiling.SLOW_QUERY_TIME
+        profiling.SLOW_QUERY_TIME = 0.15
+        try:
+            slow = int(self.status()["Slow_queries"])
+            self.assertEqual((["a"], [["1"], ["2"]]),
+                             self.client.query("select a from t"))
+            self.assertEqual((["a"], [["1"], ["2"]]),
+                             self.client.query("select a from slow"))
+            # (A query's recorded once it's answered, so by the time the
+            # ping comes back, the last one has been)
+            self.client.ping()
+        finally:
+            profiling.SLOW_QUERY_TIME = threshold
+            profiling.slow_log.removeHandler(handler)
+        messages = [record.getMessage() for record in handler.records]
+        self.assertEqual(1, len(messages))
+        self.assertIn("select a from slow", messages[0])
+        self.assertIn("2 rows", messages[0])
+        self.assertEqual(slow + 1, int(self.status()["Slow_queries"]))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
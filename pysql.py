@@ -7,11 +7,117 @@ __author__ = "Jon Botelho"
 
 
 import SocketServer
+import socket
 import struct
 import os
+import time
+import logging
 from types import StringType
-import pymongo
 import re
+import itertools
+import functools
+import sql_parsers
+import profiling
+import metrics
+import auth
+import index_advisor
+import row_mapping
+import sessions
+import prefork
+import coalescer
+import capture
+import scheduler
+import transactions
+import backend
+import parallel_scan
+from compression import CompressedSocket, CLIENT_COMPRESS
+from backend import QueryTimeout, WriteErrors, ReadOnlyTable, NoSuchTable
+from sessions import QueryControl, QueryInterrupted
+from scheduler import SchedulerBusy
+from transactions import Transaction, ReadOnlyTransaction, \
+                         SERVER_STATUS_IN_TRANS, SERVER_STATUS_AUTOCOMMIT
+from profiling import QueryProfile
+from catalog import Catalog, UnknownVariable
+from prepared import PreparedStatement, PreparedStatementError, Cursor, \
+                     CursorClosed, CURSOR_TYPE_READ_ONLY, \
+                     SERVER_STATUS_CURSOR_EXISTS, SERVER_STATUS_LAST_ROW_SENT
+
+
+log = logging.getLogger("pysql")
+
+
+# The longest payload a packet can have (longer ones are split up)
+MAX_PACKET_LENGTH = 0xFFFFFF
+
+# Capability flags
+CLIENT_CONNECT_WITH_DB = 0x0008
+CLIENT_PROTOCOL_41 = 0x0200
+CLIENT_SECURE_CONNECTION = 0x8000
+
+# Commands
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_QUERY = 0x03
+COM_PING = 0x0e
+COM_CHANGE_USER = 0x11
+COM_STMT_PREPARE = 0x16
+COM_STMT_EXECUTE = 0x17
+COM_STMT_SEND_LONG_DATA = 0x18
+COM_STMT_CLOSE = 0x19
+COM_STMT_RESET = 0x1a
+COM_STMT_FETCH = 0x1c
+COM_RESET_CONNECTION = 0x1f
+
+
+
+def length_coded (n):
+    """ Encodes a number as a MySQL length coded binary. """
+
+    if n < 251:
+        return chr(n)
+    elif n < 0x10000:
+        return "\xFC" + struct.pack("< H", n)
+    elif n < 0x1000000:
+        return "\xFD" + struct.pack("< I", n)[:3]
+    else:
+        return "\xFE" + struct.pack("< Q", n)
+
+
+def length_coded_string (value):
+    """
+    Encodes a value as a MySQL length coded string,
+    in the text format used by row data (None is NULL).
+    """
+
+    if value is None:
+        return "\xFB"
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        value = str(value)
+    return length_coded(len(value)) + value
+
+
+
+class ConnectionClosed (Exception):
+    """ The client went away. """
+
+
+
+def recv_exactly (sock, size):
+    """
+    Reads exactly size bytes (a recv can return less than asked for),
+    raising ConnectionClosed if the client goes away first.
+    """
+
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionClosed()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
 
 
 
@@ -36,17 +142,33 @@ class MySQLPacket (object):
         # Make a new instance of this class
         packet = cls()
         # Get the packet length (3 bytes), and the packet number (1 byte)
-        packet.length, length_byte3, packet.packet_number \
-            = struct.unpack("< HB B", sock.recv(4))
-        packet.length += length_byte3 << 16
+        packet.length, packet.packet_number = cls.read_header(sock)
+        # Note when the packet started coming in (for profiling)
+        packet.received = time.time()
         if get_data:
             # Read the packet's data, now that we have the length
-            packet.data = sock.recv(packet.length)
+            packet.data = recv_exactly(sock, packet.length)
+            # Payloads of MAX_PACKET_LENGTH or more are split up, and
+            # carry on in the next packets (until a shorter one)
+            length = packet.length
+            while length == MAX_PACKET_LENGTH:
+                length, number = cls.read_header(sock)
+                packet.data += recv_exactly(sock, length)
+                packet.length += length
 
         # We're done; return the complete packet
         return packet
 
 
+    @staticmethod
+    def read_header (sock):
+        """ Reads a packet header, returning (length, packet number). """
+
+        length, length_byte3, number = struct.unpack(
+            "< HB B", recv_exactly(sock, 4))
+        return length + (length_byte3 << 16), number
+
+
     def __str__ (self):
         """ Encode the packet for sending. """
         
@@ -81,11 +203,12 @@ class GreetingPacket (MySQLPacket):
         """
 
         # Generate a random salt if a valid one was not given
+        # (printable, since the second part is null-terminated)
         try:
             salt = str(salt)
             assert(len(salt) == 20)
         except:
-            salt = os.urandom(20)
+            salt = "".join(chr(33 + ord(c) % 94) for c in os.urandom(20))
             assert(len(salt) == 20)
         self.salt = salt
 
@@ -104,7 +227,7 @@ class GreetingPacket (MySQLPacket):
 
         # Encode the packet's payload
         self.data = struct.pack(
-            "< B %ssB I 8sB H B H 13s 8sB" % len(self.server_version),
+            "< B %ssB I 8sB H B H 13s 12sB" % len(self.server_version),
             self.protocol_version,
             self.server_version, 0,
             self.thread_id,
@@ -133,25 +256,60 @@ class LoginRequestPacket (MySQLPacket):
 
         # Get some basic information from our parent class,
         # and use the resulting object here-on
-        packet = super(LoginRequestPacket, cls).fromSocket(sock)
+        packet = super(LoginRequestPacket, cls).fromSocket(sock, get_data=True)
+        data = packet.data
         # Decode the first part of the packet
-        packet.client_capabilities, packet.extended_client_capabilities,\
-        packet.max_packet_size, packet.charset \
-            = struct.unpack("< H H I B", sock.recv(9))
+        packet.client_capabilities, = struct.unpack("< H", data[:2])
+        if packet.client_capabilities & CLIENT_PROTOCOL_41:
+            packet.client_capabilities, packet.max_packet_size, \
+            packet.charset = struct.unpack("< I I B", data[:9])
+            # Then there's 23 bytes of filler
+            rest = data[32:]
+        else:
+            # The old (4.0) format
+            packet.max_packet_size, = struct.unpack("< I", data[2:5] + "\0")
+            packet.charset = None
+            rest = data[5:]
         # The second part is tricky because it contains null-terminated strings
-        rest = sock.recv(packet.length - 9)
         # Get the null-terminated username string
-        packet.username, rest = rest.split("\0", 1)[0]
-        # The password is an SHA-1 hash (20-bytes/160-bits)
-        packet.password = rest[:20]
+        packet.username, rest = (rest.split("\0", 1) + [""])[:2]
+        packet.password, rest = read_auth_response(
+            rest, packet.client_capabilities)
         # The last thing is the schema name (null-terminated)
-        packet.schema = rest[20:-1]
+        packet.schema = None
+        if packet.client_capabilities & CLIENT_CONNECT_WITH_DB:
+            packet.schema = rest.split("\0", 1)[0] or None
 
         # We're done; return the filled-in packet object
         return packet
 
 
 
+def read_auth_response (data, capabilities):
+    """
+    Reads the auth response out of a login/change user packet,
+    returning (response, the rest of the data).
+    """
+
+    if capabilities & CLIENT_SECURE_CONNECTION:
+        # The password is an SHA-1 hash (20-bytes/160-bits), length coded
+        length = ord(data[0]) if data else 0
+        return data[1:1 + length], data[1 + length:]
+    # Older clients send it null-terminated
+    return tuple((data.split("\0", 1) + [""])[:2])
+
+
+
+class ChangeUserPacket (object):
+    """ The arguments of a COM_CHANGE_USER command. """
+
+    def __init__ (self, data, capabilities):
+        self.username, rest = (data.split("\0", 1) + [""])[:2]
+        self.password, rest = read_auth_response(rest, capabilities)
+        self.schema = rest.split("\0", 1)[0] or None
+
+
+
 class OKPacket (MySQLPacket):
     """
     Sent as a response to packets sent from the client.
@@ -159,7 +317,6 @@ class OKPacket (MySQLPacket):
 
     def __init__ (self, number=1, field_count=0, affected_rows=0,
                   insert_id=0, server_status=0, warnings=0):
-        # TODO: Change numeric fields to use length coded binary
         self.number = number
         self.field_count = field_count
         self.affected_rows = affected_rows
@@ -172,13 +329,11 @@ class OKPacket (MySQLPacket):
         """ Encode the packet for sending. """
 
         # Encode the packet's payload
-        self.data = struct.pack(
-            "< B B B H H",
-            self.field_count,
-            self.affected_rows,
-            self.insert_id,
-            self.server_status,
-            self.warnings
+        self.data = (
+            struct.pack("B", self.field_count) +
+            length_coded(self.affected_rows) +
+            length_coded(self.insert_id) +
+            struct.pack("< H H", self.server_status, self.warnings)
         )
         # Return the encoded packet
         return super(OKPacket, self).__str__()
@@ -186,14 +341,51 @@ class OKPacket (MySQLPacket):
 
 
 
+class ErrorPacket (MySQLPacket):
+    """
+    Sent instead of an OK packet when something went wrong.
+    """
+
+    def __init__ (self, number=1, code=1105, message="Unknown error",
+                  sql_state="HY000"):
+        self.number = number
+        self.code = code
+        self.message = message
+        self.sql_state = sql_state
+
+
+    def __str__ (self):
+        """ Encode the packet for sending. """
+
+        message = self.message
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        # Encode the packet's payload
+        self.data = struct.pack("< B H", 0xFF, self.code) + \
+                    "#" + self.sql_state[:5] + message
+        # Return the encoded packet
+        return super(ErrorPacket, self).__str__()
+
+
+
 class CommandPacket(MySQLPacket):
     """
     A packet containing a command from the client.
     """
 
     commands = {
-        1: "Quit",
-        3: "Query"
+        COM_QUIT: "Quit",
+        COM_INIT_DB: "Init DB",
+        COM_QUERY: "Query",
+        COM_PING: "Ping",
+        COM_CHANGE_USER: "Change user",
+        COM_STMT_PREPARE: "Prepare",
+        COM_STMT_EXECUTE: "Execute",
+        COM_STMT_SEND_LONG_DATA: "Long data",
+        COM_STMT_CLOSE: "Close stmt",
+        COM_STMT_RESET: "Reset stmt",
+        COM_STMT_FETCH: "Fetch",
+        COM_RESET_CONNECTION: "Reset connection",
     }
 
     @classmethod
@@ -202,17 +394,19 @@ class CommandPacket(MySQLPacket):
         
         # Get some basic information from our parent class,
         # and use the resulting object here-on
-        packet = super(CommandPacket, cls).fromSocket(sock)
+        packet = super(CommandPacket, cls).fromSocket(sock, get_data=True)
+        if not packet.data:
+            raise ConnectionClosed()
         # Decode the command type
-        packet.command = struct.unpack("< B", sock.recv(1))[0]
+        packet.command = ord(packet.data[0])
         # Fill in a command description (for convenience)
         if packet.command in cls.commands:
             packet.description = cls.commands[packet.command]
         else:
             packet.description = "Unknown"
         # Decode the actual command/statement
-        # (Usually SQL)
-        packet.statement = sock.recv(packet.length - 1)
+        # (Usually SQL, and there's none for eg. COM_PING)
+        packet.statement = packet.data[1:]
 
         # We're done; return the completed command object
         return packet
@@ -346,24 +540,90 @@ class RowDataPacket(MySQLPacket):
         """ Encode the packet for sending. """
 
         # Encode the packet's payload
-        # TODO: Do length encoded strings for real
-        # TODO: Figure out how to encode numbers, NULLs, etc.
-        self.data = ""
-        for value in self.values:
-            self.data += struct.pack("B", len(value))
-            self.data += value
+        self.data = "".join([length_coded_string(v) for v in self.values])
         # Return the encoded packet
         return super(RowDataPacket, self).__str__()
 
 
+class EncodedRowDataPacket(MySQLPacket):
+    """
+    A text row that's already been encoded (straight from raw BSON).
+    """
+
+    def __init__ (self, number=1, data=""):
+        self.number = number
+        self.data = data
+
+
+
+class BinaryRowDataPacket(MySQLPacket):
+    """
+    A row of a prepared statement's result set (the binary protocol).
+    """
+
+    def __init__ (self, number=1, values=[]):
+        self.number = number
+        self.values = values
+
+
+    def __str__ (self):
+        """ Encode the packet for sending. """
+
+        # A header, then a bitmap of the NULL values (which starts
+        # at bit 2), then the values. The columns are all sent as
+        # strings, which are length coded like in text rows.
+        nulls = bytearray((len(self.values) + 9) // 8)
+        for i, value in enumerate(self.values):
+            if value is None:
+                nulls[(i + 2) // 8] |= 1 << ((i + 2) % 8)
+        self.data = "\0" + str(nulls) + "".join(
+            [length_coded_string(v) for v in self.values if v is not None])
+        # Return the encoded packet
+        return super(BinaryRowDataPacket, self).__str__()
+
+
+
+class StmtPrepareOKPacket(MySQLPacket):
+    """
+    The response to COM_STMT_PREPARE.
+    """
+
+    def __init__ (self, number=1, statement_id=0, columns=0, params=0,
+                  warnings=0):
+        self.number = number
+        self.statement_id = statement_id
+        self.columns = columns
+        self.params = params
+        self.warnings = warnings
+
+
+    def __str__ (self):
+        """ Encode the packet for sending. """
+
+        self.data = struct.pack("< B I H H B H", 0, self.statement_id,
+                                self.columns, self.params, 0, self.warnings)
+        return super(StmtPrepareOKPacket, self).__str__()
+
+
+
 class ResultSet(object):
     """ Used to send a set of results back to the client. """
 
-    def __init__ (self, columns=[], rows=[], table="", database=""):
+    def __init__ (self, columns=[], rows=[], table="", database="",
+                  binary=False, cursor=False, encoded=False, status=0):
         self.columns = columns
         self.rows = rows
         self.table = table
         self.database = database
+        # Whether the rows are in the binary protocol (for prepared
+        # statements), and whether they're left in a cursor to fetch
+        self.binary = binary
+        self.cursor = cursor
+        # Whether the rows are already encoded text row payloads
+        # (see row_mapping.RawRowEncoder)
+        self.encoded = encoded
+        # Server status flags for the EOFs (eg. SERVER_STATUS_IN_TRANS)
+        self.status = status
 
     def toPackets (self):
         """
@@ -371,37 +631,114 @@ class ResultSet(object):
         result set to the client.
         """
 
+        return list(self.iterPackets())
+
+
+    def iterPackets (self):
+        """
+        Generates the MySQL packets for this result set one by one,
+        so the rows can come from a cursor instead of a list.
+        """
+
         # First make a header packet
         i = 1
         field_count = len(self.columns)
-        packets = [ResultSetHeaderPacket(i, field_count)]
+        yield ResultSetHeaderPacket(i, field_count)
 
         # Then the field packets for each column
         for col in self.columns:
             i += 1
-            packets += [
-                FieldPacket(
-                    i,
-                    database=self.database,
-                    table=self.table,
-                    name=col
-                )
-            ]
+            yield FieldPacket(
+                i,
+                database=self.database,
+                table=self.table,
+                name=col
+            )
 
         # Then an EOF
         i += 1
-        packets += [EOFPacket(i)]
+        if self.cursor:
+            # The rows get fetched with COM_STMT_FETCH
+            yield EOFPacket(i, server_status=SERVER_STATUS_CURSOR_EXISTS |
+                                             self.status)
+            return
+        yield EOFPacket(i, server_status=self.status)
 
         # Then the row data
+        # (packet numbers wrap around after 255)
+        Row = EncodedRowDataPacket if self.encoded else \
+              BinaryRowDataPacket if self.binary else RowDataPacket
         for row in self.rows:
             i += 1
-            packets += [RowDataPacket(i, row)]
+            yield Row(i & 0xFF, row)
 
         # Then another EOF to finish it off
         i += 1
-        packets += [EOFPacket(i)]
-        
-        return packets
+        yield EOFPacket(i & 0xFF, server_status=self.status)
+
+
+    def send (self, sock, buffer_size=16384, profile=None, check=None):
+        """
+        Streams the result set out to a socket as it's encoded,
+        sending the packets in chunks of about buffer_size bytes.
+
+        If a profile is given, the encoding and writing time
+        (and bytes sent) get added to it.
+
+        check (eg. QueryControl.check) is called before each packet.
+        If it raises QueryInterrupted, the result set is cut off with
+        an ERR packet, and the exception passed on (marked as sent).
+        """
+
+        profile = profile or QueryProfile()
+        clock = time.time
+        encode_time = 0.0
+        chunk = []
+        size = 0
+        sent = 0
+        number = 0
+        packets = self.iterPackets()
+        while True:
+            # Rows are pulled from the cursor as the packets are made,
+            # so only the time spent encoding counts towards "encode".
+            try:
+                if check is not None:
+                    check()
+                packet = next(packets)
+            except StopIteration:
+                break
+            except (QueryInterrupted, QueryTimeout), e:
+                if isinstance(e, QueryTimeout):
+                    e = QueryInterrupted(timeout=True)
+                # Stop reading from the backend, and finish off
+                # what's been sent with the error
+                packets.close()
+                chunk.append(str(ErrorPacket(
+                    (number + 1) & 0xFF, e.code, str(e), e.sql_state)))
+                with profile.phase("write"):
+                    sock.sendall("".join(chunk))
+                profile.bytes_sent += sent + sum(len(c) for c in chunk)
+                e.sent = True
+                raise e
+            number = packet.number
+            start = clock()
+            data = str(packet)
+            encode_time += clock() - start
+            chunk.append(data)
+            size += len(data)
+            if size >= buffer_size:
+                with profile.phase("write"):
+                    sock.sendall("".join(chunk))
+                sent += size
+                chunk = []
+                size = 0
+        if chunk:
+            with profile.phase("write"):
+                sock.sendall("".join(chunk))
+            sent += size
+
+        profile.add("encode", encode_time)
+        profile.bytes_sent += sent
 
 
     def __str__ (self):
@@ -410,18 +747,66 @@ class ResultSet(object):
 
 
 class Query(object):
-    pass
+    """ Base class for SQL queries, which are parsed clause by clause. """
 
-        
+    def parse (self, profile=None):
+        """
+        Scans the statement, and runs each clause through its parser
+        (from sql_parsers), setting the results on the query object.
+
+        Returns False if the statement couldn't be scanned.
+        """
+
+        profile = profile or QueryProfile(self.statement)
+
+        # Figure out what the query actually means
+        with profile.phase("tokenize"):
+            tokens = SQLStatement(self.statement).scan()
+        if tokens[1]:
+            log.info("Could not parse statement. Error around: %s", tokens[1])
+            return False
+        tokens = tokens[0]
+        log.debug("Tokens: %s", tokens)
+
+        with profile.phase("parse"):
+            keyword = ""
+            arguments = []
+            # Scan through, collecting each keyword's arguments
+            # until the next keyword (or the end) comes along.
+            for token_type, token_value in tokens + [("operator", ";")]:
+                is_clause = token_type == "keyword" and \
+                            hasattr(sql_parsers, token_value.upper())
+                name = token_value.upper() if is_clause else token_value
+                if is_clause or token_value == ";":
+                    # There was a previous keyword,
+                    # so we need to parse its arguments before moving on.
+                    if keyword:
+                        result = getattr(sql_parsers, keyword)(arguments)
+                        for clause, value in result.items():
+                            setattr(self, clause, value)
+                    keyword = name if is_clause else ""
+                    arguments = []
+                elif keyword:
+                    arguments.append((token_type, token_value))
+                else:
+                    raise sql_parsers.UnsupportedSQLExpression(
+                        "Unexpected %s: %s" % (token_type, token_value))
+        return True
 
 
 
 
 
-SQL_IDENTIFIER_REGEX = "(?:`[^`]+`|[$\w]+)"
-# TODO: Add support for quote escapes
+# (Dotted paths, eg. address.city, are a single identifier)
+SQL_IDENTIFIER_REGEX = "(?:`[^`]+`|[$\w]+)(?:\.(?:`[^`]+`|[$\w]+))*"
+# (Strings can have backslash escapes, and doubled quotes, in them)
 # TODO: Add support for floats and hex numbers
-SQL_VALUE_REGEX = "(?:[0-9]+|'[^']+'|\"[^\"]+\")"
+SQL_VALUE_REGEX = ("(?:[0-9]+"
+                   r"|'(?:[^'\\]|\\[\s\S]|'')*'"
+                   r'|"(?:[^"\\]|\\[\s\S]|"")*")')
+# IN lists of plain values are scanned as one token (see sql_parsers.in_list),
+# since they can have thousands of values
+SQL_IN_LIST_REGEX = "IN\s*\(\s*{0}(?:\s*,\s*{0})*\s*\)".format(SQL_VALUE_REGEX)
 SQL_CONDITION_REGEX = ""
 SQL_REGEX_DICT = {
     "ident": SQL_IDENTIFIER_REGEX,
@@ -430,32 +815,57 @@ SQL_REGEX_DICT = {
 
 
 from sql_constants import *
-SQL_OPERATORS_REGEX = "|".join(SQL_ESCAPED_OPERATORS)
+# The symbol operators, longest first, so "<=" doesn't get scanned as
+# "<", "=" (word operators are scanned as words, and looked up)
+SQL_OPERATORS_REGEX = "|".join(
+    op for op in sorted(SQL_ESCAPED_OPERATORS,
+                        key=lambda op: len(op.replace("\\", "")),
+                        reverse=True)
+    if not op[-1].isalpha()
+)
+
+
+def parse_op (scanner, token): return "operator", token
+def parse_value (scanner, token): return "value", token
+def parse_list (scanner, token): return "list", token
+
+def parse_word (scanner, token):
+    """ Tells keywords and word operators (eg. AND) from identifiers. """
+
+    word = token.upper()
+    if word in SQL_WORD_OPERATORS:
+        return "operator", token
+    if word in SQL_KEYWORDS:
+        return "keyword", token
+    return "identifier", token
+
 
 class SQLStatement(object):
+    # The scanner (made the first time it's needed, and then shared)
+    scanner = None
+
     def __init__ (self, statement):
         self.statement = statement
 
+    @classmethod
+    def get_scanner (cls):
+        if cls.scanner is None:
+            cls.scanner = re.Scanner([
+                (SQL_IN_LIST_REGEX, parse_list),
+                (SQL_OPERATORS_REGEX, parse_op),
+                (SQL_VALUE_REGEX, parse_value),
+                (SQL_IDENTIFIER_REGEX, parse_word),
+                ("\s+", None)
+            ], re.I)
+        return cls.scanner
+
     def scan (self):
         """
         Scans through the SQL statement, and splits it up
         into tokens like "FROM", "=", "(", etc.
         """
 
-        def parse_op (scanner, token): return "operator", token
-        def parse_ident (scanner, token): return "identifier", token
-        def parse_value (scanner, token): return "value", token
-        def parse_kw (scanner, token): return "keyword", token
-
-        scanner = re.Scanner([
-            (SQL_OPERATORS_REGEX, parse_op),
-            (SQL_KEYWORDS_REGEX, parse_kw),
-            (SQL_VALUE_REGEX, parse_value),
-            (SQL_IDENTIFIER_REGEX, parse_ident),
-            ("\s*", None)
-        ])
-
-        return scanner.scan(self.statement)
+        return self.get_scanner().scan(self.statement)
 
 
 class SelectQuery(Query):
@@ -470,118 +880,837 @@ class SelectQuery(Query):
             "\s+({ident})\s*(=)\s*({value})" +
         ")?\s*;?\s*"
     ).format(**SQL_REGEX_DICT), re.I | re.S | re.M)
-    
+
+    # Optimizer hints, eg.
+    # SELECT /*+ PARALLEL(4) MAX_EXECUTION_TIME(1000) */ * FROM big_table
+    # SELECT /*+ UNNEST(items) */ _id, items.sku FROM orders
+    hint_comment_regex = re.compile("/\*\+(.*?)\*/", re.S)
+    # The degree of parallelism
+    parallel_hint_regex = re.compile(
+        "\\bPARALLEL\s*\(\s*([0-9]+)\s*\)", re.I)
+    # The time limit (in ms)
+    max_execution_time_hint_regex = re.compile(
+        "\\bMAX_EXECUTION_TIME\s*\(\s*([0-9]+)\s*\)", re.I)
+    # An array field to unnest into a row per element
+    unnest_hint_regex = re.compile(
+        "\\bUNNEST\s*\(\s*(" + SQL_IDENTIFIER_REGEX + ")\s*\)", re.I)
+
     def __init__ (self, statement):
         # Make sure we have a SELECT query
-        if not statement.lower().startswith("select"):
+        if not statement.lower().lstrip().startswith("select"):
             raise ValueError("The given statement a SELECT query.")
         self.statement = statement
+        self.database = None
+        self.table = None
+        self.conditions = {}
+        self.columns = None
+        self.order = None
+        self.limit = None
+        self.offset = 0
+        self.parallel = None
+        self.max_execution_time = None
+        self.unnest = None
+
+        # Pull out the hints (if any) before scanning
+        match = self.hint_comment_regex.search(statement)
+        if match:
+            hints = match.group(1)
+            parallel = self.parallel_hint_regex.search(hints)
+            if parallel:
+                self.parallel = int(parallel.group(1))
+            max_time = self.max_execution_time_hint_regex.search(hints)
+            if max_time:
+                self.max_execution_time = int(max_time.group(1))
+            unnest = self.unnest_hint_regex.search(hints)
+            if unnest:
+                self.unnest = sql_parsers.identifier(unnest.group(1))
+            self.statement = self.hint_comment_regex.sub(" ", statement)
+
+    def execute (self, profile=None):
+        """
+        Parses the statement into its clauses.
 
-    def execute (self):
-        # Figure out what the query actually means
-        tokens = SQLStatement(self.statement).scan()
-        if tokens[1]:
-            print "Could not parse statement. Error around: %s" % tokens[1]
+        Returns (table, conditions), leaving the rest of the clauses
+        (columns, order, limit, offset) on the query object.
+        """
+
+        if not self.parse(profile):
             return
-        tokens = tokens[0]
-        print "Tokens: %s" % (tokens,)
-        keyword = ""
-        arguments = []
-        parsed = []
-        i = 0
-        for token_type, token_value in tokens:
-            # TODO: Rework this to loop through without the i += 1 nonsense
-            # Should scan through, keep adding on to keyword args array
-            # until another keyword is encountered. Then, parse the args.
-            # Check if we have a keyword
-            if token_value.upper() in SQL_KEYWORDS or token_value == ";":
-                # The there was a previous keyword,
-                # We need to parse its arguments now before moving on.
-                if keyword:
-                    if hasattr(sql_parsers, keyword):
-                        result = getattr(sql_parsers, keyword)(arguments)
-                        parsed.append((keyword, result))
-                    else:
-                        raise Exception("No parser found for %s" % keyword)
-            else:
-                arguments += (token_type, token_value)
-                keyword = token_value.upper()
+        return self.table, self.conditions
+
+
+
+class InsertQuery(Query):
+    """ Represents an SQL INSERT query. """
+
+    def __init__ (self, statement):
+        # Make sure we have an INSERT query
+        if not statement.lower().lstrip().startswith("insert"):
+            raise ValueError("The given statement isn't an INSERT query.")
+        self.statement = statement
+        self.table = None
+        self.columns = None
+        self.values = []
 
-        # TODO: Get a table back out here
-        # TODO: Get the conditions
-        return table, conditions
+    def execute (self, profile=None):
+        """
+        Parses the statement, returning (table, documents)
+        with a document for each row of values.
+        """
+
+        if not self.parse(profile):
+            return
+        if not self.table or not self.columns or not self.values:
+            raise sql_parsers.UnsupportedSQLExpression(
+                "INSERTs need a table, columns and values")
+        documents = []
+        for row in self.values:
+            if len(row) != len(self.columns):
+                raise sql_parsers.UnsupportedSQLExpression(
+                    "Column count doesn't match value count")
+            documents.append(dict(zip(self.columns, row)))
+        return self.table, documents
 
 
 
 
 
 class MySQLServerSession(object):
-    def __init__ (self, sock, client):
+
+    # Statements answered from the query stats rather than the database
+    show_profile_regex = re.compile(
+        "^\s*SHOW\s+PROFILE(?:\s+FOR\s+QUERY\s+([0-9]+))?\s*;?\s*$", re.I)
+    show_profiles_regex = re.compile("^\s*SHOW\s+PROFILES\s*;?\s*$", re.I)
+    show_status_regex = re.compile(
+        "^\s*SHOW\s+(?:GLOBAL\s+|SESSION\s+)?STATUS\s*;?\s*$", re.I)
+    query_stats_regex = re.compile(
+        "^\s*SELECT\s+\*\s+FROM\s+`?pysql`?\.`?query_stats`?\s*;?\s*$", re.I)
+    index_advice_regex = re.compile(
+        "^\s*SHOW\s+INDEX\s+ADVICE\s*;?\s*$", re.I)
+    use_regex = re.compile("^\s*USE\s+(\S+?)\s*;?\s*$", re.I)
+    # Statements for finding and stopping queries
+    kill_regex = re.compile(
+        "^\s*KILL\s+(?:(QUERY|CONNECTION)\s+)?([0-9]+)\s*;?\s*$", re.I)
+    show_processlist_regex = re.compile(
+        "^\s*SHOW\s+(?:FULL\s+)?PROCESSLIST\s*;?\s*$", re.I)
+    set_max_execution_time_regex = re.compile(
+        "^\s*SET\s+(?:SESSION\s+|@@(?:SESSION\.)?)?max_execution_time"
+        "\s*=\s*([0-9]+)\s*;?\s*$", re.I)
+    # Transactions
+    begin_regex = re.compile(
+        "^\s*(?:BEGIN(?:\s+WORK)?|START\s+TRANSACTION((?:\s*,?\s*(?:READ\s+"
+        "ONLY|READ\s+WRITE|WITH\s+CONSISTENT\s+SNAPSHOT))*))\s*;?\s*$", re.I)
+    commit_regex = re.compile("^\s*COMMIT(?:\s+WORK)?\s*;?\s*$", re.I)
+    rollback_regex = re.compile("^\s*ROLLBACK(?:\s+WORK)?\s*;?\s*$", re.I)
+    set_autocommit_regex = re.compile(
+        "^\s*SET\s+(?:SESSION\s+|@@(?:SESSION\.)?)?autocommit"
+        "\s*=\s*(0|1|ON|OFF|TRUE|FALSE)\s*;?\s*$", re.I)
+    # Statements that are answered with an OK, and nothing else
+    # (settings that don't change anything here, and empty statements);
+    # anything else that isn't understood gets an error
+    noop_regex = re.compile(
+        "^\s*(?:SET\s+(?:NAMES|CHARACTER\s+SET|CHARSET)\s+\S+.*|"
+        "SET\s+(?:SESSION\s+|LOCAL\s+)?TRANSACTION\s+.+|"
+        "SET\s+(?:(?:SESSION|LOCAL)\s+|@@(?:SESSION\.|LOCAL\.)?)?"
+        "(?:sql_mode|time_zone|character_set_\w+|collation_\w+|"
+        "sql_auto_is_null|sql_safe_updates|sql_select_limit|wait_timeout|"
+        "interactive_timeout|net_\w+_timeout|transaction_isolation|"
+        "tx_isolation|group_concat_max_len)\s*=.+|)\s*;?\s*$", re.I | re.S)
+
+    def __init__ (self, sock, client, backend=None, credentials=None,
+                  catalog=None, max_execution_time=sessions.MAX_EXECUTION_TIME,
+                  coalescer=None, capture=None, scheduler=None):
         self.socket = sock
+        self.client = client
+        # The profiles of this session's queries (for SHOW PROFILES)
+        self.profiles = []
+        # Who can log in (None lets anyone in)
+        self.credentials = credentials
+        # Prepared statements, and their open cursors, by statement id
+        self.statements = {}
+        self.cursors = {}
+        self.statement_ids = itertools.count(1)
+        # Whether results go out in the binary protocol
+        # (while running a prepared statement)
+        self.binary = False
+        # The time limit for SELECTs (in ms, 0 for none), and the
+        # server's, which a reset goes back to
+        self.max_execution_time = max_execution_time
+        self.default_max_execution_time = max_execution_time
+        # The server's coalescer.WriteCoalescer (None writes each
+        # INSERT on its own)
+        self.coalescer = coalescer
+        # The server's capture.CaptureWriter (None when not capturing)
+        self.capture = capture
+        # The server's scheduler.Scheduler (None runs every SELECT
+        # as soon as it comes in)
+        self.scheduler = scheduler
+        # The command being run, and the running query's QueryControl
+        # (for SHOW PROCESSLIST and KILL)
+        self.current = None
+        self.control = None
+        self.killed = False
+        # The open transaction (None outside of one, which is when
+        # statements take the plain autocommit path)
+        self.transaction = None
+        self.autocommit = True
+
+        self.thread_id = sessions.registry.next_id()
+        greeting = GreetingPacket(thread_id=self.thread_id)
+        self.salt = greeting.salt
+        self.socket.send(str(greeting))
+        login = LoginRequestPacket.fromSocket(self.socket)
+        self.capabilities = login.client_capabilities
+        if not self.authenticate(login.username, login.password):
+            self.socket.send(str(self.access_denied(login, number=2)))
+            return
+        self.user = login.username
+        self.socket.send(str(OKPacket(number=2,
+                                      server_status=self.server_status)))
         
-        self.socket.send(str(GreetingPacket()))
-        # Auth isn't working for now
-        #packet = LoginRequestPacket.fromSocket(self.socket)
-        packet = MySQLPacket.fromSocket(self.socket, get_data=True)
-        self.socket.send(str(OKPacket(number=2)))
-        
-        print "Connected to %s" % (client[0])
+        log.info("%s connected from %s", self.user, client[0])
+
+        # Everything after the login is compressed, if the client wants
+        if self.capabilities & CLIENT_COMPRESS:
+            log.debug("Using compression")
+            self.socket = CompressedSocket(self.socket)
 
-        mongo = pymongo.Connection()
-        mongo_coll = mongo["pysql_test"]
-        print "Brought up MongoDB Connection"
+        self.default_backend = backend or make_backend()
+        self.backend = self.default_backend
+        # Cached metadata for SHOW TABLES, information_schema, etc.
+        self.catalog = catalog or Catalog(self.default_backend)
+        if login.schema:
+            self.backend = self.backend.use(login.schema)
+        log.info("Using the %s database", self.backend.database)
+
+        if self.capture:
+            self.capture.connect(self.thread_id, self.user,
+                                 self.backend.database)
 
         # Now just sit here relieving commands all day
-        while True:
-            command = CommandPacket.fromSocket(self.socket)
-            print "%s: %s" % (command.description, command.statement)
-            if command.statement.lower().find("select") != -1:
-                """cols = ["Name", "City"]
-                rows = [["Jon", "NYC"], ["GMP", "Worc"]]
-                rs = ResultSet(cols, rows, "test_table", "test")
-                self.socket.send(str(rs))"""
-                query_info = SelectQuery(command.statement).execute()
-                if not query_info:
-                    print "Unsupported SELECT query."
-                    self.socket.send(str(OKPacket()))
+        sessions.registry.add(self)
+        profiling.stats.adjust("Threads_connected", 1)
+        metrics.sessions_active.inc()
+        try:
+            while True:
+                try:
+                    command = CommandPacket.fromSocket(self.socket)
+                except (ConnectionClosed, socket.error):
+                    if self.killed:
+                        log.info("Killed the connection from %s", client[0])
+                    else:
+                        log.info("%s disconnected", client[0])
                     return
-                table, cond = query_info
-                if len(cond):
-                    cond = cond[0]
-                    print "Running db.%s.find(%s)" % (table, cond)
-                    results = mongo_coll[table].find(cond)
+                log.debug("%s: %s", command.description, command.statement)
+                self.current = command
+                profile = QueryProfile(command.statement)
+                # The read started once the packet header came in
+                profile.started = command.received
+                profile.add("read", time.time() - command.received)
+                try:
+                    if self.command(command, profile) is False:
+                        return
+                finally:
+                    self.current = None
+                profile.finish()
+                if self.capture:
+                    self.capture.command(self.thread_id, command, profile)
+                self.profiles.append(profile)
+                del self.profiles[:-profiling.HISTORY_SIZE]
+
+                metrics.commands.labels(command.description).inc()
+                metrics.command_latency.labels(command.description)\
+                                       .observe(profile.duration)
+                metrics.bytes_received.inc(command.length + 4)
+                metrics.bytes_sent.inc(profile.bytes_sent)
+        finally:
+            sessions.registry.remove(self)
+            self.close_statements()
+            # (An open transaction never happened)
+            self.rollback()
+            profiling.stats.adjust("Threads_connected", -1)
+            metrics.sessions_active.dec()
+            if self.capture:
+                self.capture.disconnect(self.thread_id)
+
+
+    def authenticate (self, user, response):
+        """ Checks a user's auth response against this session's salt. """
+
+        if self.credentials is None:
+            return True
+        return self.credentials.verify(user, self.salt, response)
+
+
+    def access_denied (self, login, number=1):
+        """ Makes the error for a failed login. """
+
+        return ErrorPacket(
+            number, auth.ER_ACCESS_DENIED_ERROR,
+            "Access denied for user '%s'@'%s' (using password: %s)" % (
+                login.username, self.client[0],
+                "YES" if login.password else "NO"),
+            auth.ACCESS_DENIED_STATE
+        )
+
+
+    def reset (self):
+        """ Clears the session's state, as if it had just connected. """
+
+        self.profiles = []
+        self.close_statements()
+        self.transaction = None
+        self.autocommit = True
+        self.max_execution_time = self.default_max_execution_time
+
+
+    def close_statements (self):
+        """ Closes all the prepared statements (and their cursors). """
+
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors = {}
+        self.statements = {}
+
+
+    def use (self, database, profile):
+        """ Switches the session to another database. """
+
+        database = sql_parsers.identifier(database.strip().rstrip(";"))
+        if not database:
+            self.send_packet(ErrorPacket(
+                code=1046, message="No database selected",
+                sql_state="3D000"), profile)
+            return
+        self.backend = self.default_backend.use(database)
+        log.debug("Using the %s database", database)
+        self.send_packet(OKPacket(), profile)
+
+
+    def kill (self, thread_id, query_only, profile):
+        """ Kills another session (or just its running query). """
+
+        if not sessions.registry.owns(thread_id):
+            # (With --workers, it's another process's session, which
+            # this one can't get at)
+            self.send_packet(ErrorPacket(
+                code=1235, sql_state="42000",
+                message="Thread id %d is on another pysql worker process, "
+                        "and can only be killed from a connection to that "
+                        "worker" % thread_id), profile)
+            return
+        target = sessions.registry.get(thread_id)
+        if target is not None and target.user != self.user and \
+           self.user not in sessions.ADMIN_USERS:
+            self.send_packet(ErrorPacket(
+                code=sessions.ER_KILL_DENIED,
+                message="You are not owner of thread %d" % thread_id),
+                profile)
+            return
+        if not sessions.registry.kill(thread_id, query_only):
+            self.send_packet(ErrorPacket(
+                code=sessions.ER_NO_SUCH_THREAD,
+                message="Unknown thread id: %d" % thread_id), profile)
+            return
+        log.info("Killed %s %d", "the query on" if query_only else "session",
+                 thread_id)
+        self.send_packet(OKPacket(), profile)
+
+
+    @property
+    def server_status (self):
+        """ The status flags for OK and EOF packets. """
+
+        status = SERVER_STATUS_AUTOCOMMIT if self.autocommit else 0
+        if self.transaction is not None:
+            status |= SERVER_STATUS_IN_TRANS
+        return status
+
+
+    def begin (self, read_only=False):
+        """ Starts a transaction (committing any open one, as MySQL does). """
+
+        self.commit()
+        self.transaction = Transaction(read_only)
+        log.debug("Started a transaction")
+
+
+    def commit (self):
+        """ Writes out the open transaction (if any). """
+
+        transaction, self.transaction = self.transaction, None
+        if transaction is None:
+            return
+        transaction.commit(self.default_backend)
+        for database, table in transaction.tables():
+            self.catalog.table_written(database, table)
+        log.debug("Committed %d writes", len(transaction.writes))
+
+
+    def rollback (self):
+        """ Drops the open transaction's writes. """
+
+        if self.transaction is not None:
+            log.debug("Rolled back %d writes", len(self.transaction.writes))
+        self.transaction = None
+
+
+    def command (self, command, profile):
+        """
+        Runs a command from the client, and sends back the response.
+        Returns False if the session should end.
+        """
+
+        try:
+            return self.run_command(command, profile)
+        except (ConnectionClosed, socket.error):
+            return False
+        except UnknownVariable, e:
+            self.send_packet(ErrorPacket(code=1193, message=str(e)), profile)
+        except PreparedStatementError, e:
+            self.send_packet(ErrorPacket(code=1210, message=str(e)), profile)
+        except (ReadOnlyTransaction, SchedulerBusy, WriteErrors,
+                ReadOnlyTable, NoSuchTable), e:
+            self.send_packet(ErrorPacket(code=e.code, message=str(e),
+                                         sql_state=e.sql_state), profile)
+        except (QueryInterrupted, QueryTimeout), e:
+            if isinstance(e, QueryTimeout):
+                e = QueryInterrupted(timeout=True)
+            metrics.queries_interrupted.labels(
+                "timeout" if e.code == sessions.ER_QUERY_TIMEOUT
+                else "killed").inc()
+            # (Unless it cut off a result set, which sends its own)
+            if not e.sent:
+                self.send_packet(ErrorPacket(code=e.code, message=str(e),
+                                             sql_state=e.sql_state), profile)
+        except Exception, e:
+            # Errors are sent back to the client, keeping the session open
+            log.exception("Error running %r", command.statement)
+            self.send_packet(ErrorPacket(message=str(e)), profile)
+
+
+    def run_command (self, command, profile):
+        if command.command == COM_QUERY:
+            return self.query(command.statement, profile)
+        elif command.command == COM_QUIT:
+            return False
+        elif command.command == COM_PING:
+            self.send_packet(OKPacket(), profile)
+        elif command.command == COM_INIT_DB:
+            self.use(command.statement, profile)
+        elif command.command == COM_CHANGE_USER:
+            login = ChangeUserPacket(command.statement, self.capabilities)
+            # The client scrambles the password with the original salt
+            if not self.authenticate(login.username, login.password):
+                # MySQL hangs up on failed user changes
+                self.send_packet(self.access_denied(login), profile)
+                return False
+            log.info("Changed user from %s to %s", self.user, login.username)
+            self.user = login.username
+            self.reset()
+            self.backend = self.default_backend
+            if login.schema:
+                self.backend = self.backend.use(login.schema)
+            self.send_packet(OKPacket(), profile)
+        elif command.command == COM_RESET_CONNECTION:
+            # Keeps the user and database, but nothing else
+            self.reset()
+            self.send_packet(OKPacket(), profile)
+        elif command.command == COM_STMT_PREPARE:
+            self.prepare(command.statement, profile)
+        elif command.command in (COM_STMT_EXECUTE, COM_STMT_SEND_LONG_DATA,
+                                 COM_STMT_CLOSE, COM_STMT_RESET,
+                                 COM_STMT_FETCH):
+            statement_id, = struct.unpack("< I", command.statement[:4])
+            statement = self.statements.get(statement_id)
+            if command.command == COM_STMT_CLOSE:
+                # (No response to this one)
+                self.close_cursor(statement_id)
+                self.statements.pop(statement_id, None)
+            elif statement is None:
+                self.send_packet(ErrorPacket(
+                    code=1243, message="Unknown prepared statement "
+                    "handler (%d) given to %s" % (statement_id,
+                                                  command.description)),
+                    profile)
+            elif command.command == COM_STMT_EXECUTE:
+                self.execute(statement, command.statement[4:], profile)
+            elif command.command == COM_STMT_FETCH:
+                count, = struct.unpack("< I", command.statement[4:8])
+                self.fetch(statement_id, count, profile)
+            elif command.command == COM_STMT_SEND_LONG_DATA:
+                # (No response to this one either)
+                param, = struct.unpack("< H", command.statement[4:6])
+                statement.long_data[param] = \
+                    statement.long_data.get(param, "") + command.statement[6:]
+            else:
+                statement.long_data = {}
+                self.close_cursor(statement_id)
+                self.send_packet(OKPacket(), profile)
+        else:
+            self.send_packet(ErrorPacket(
+                code=1047, message="Unknown command",
+                sql_state="08S01"), profile)
+
+
+    def prepare (self, sql, profile):
+        """ Prepares a statement, sending back its id. """
+
+        statement = PreparedStatement(next(self.statement_ids), sql)
+        self.statements[statement.id] = statement
+        packets = [StmtPrepareOKPacket(1, statement.id, 0, statement.params)]
+        if statement.params:
+            # Definitions for the parameters
+            for i in range(statement.params):
+                packets.append(FieldPacket(len(packets) + 1, name="?"))
+            packets.append(EOFPacket(len(packets) + 1,
+                                     server_status=self.server_status))
+        data = "".join(str(p) for p in packets)
+        with profile.phase("write"):
+            self.socket.sendall(data)
+        profile.bytes_sent += len(data)
+
+
+    def execute (self, statement, data, profile):
+        """
+        Runs a prepared statement, opening a cursor
+        if the client asked for one.
+        """
+
+        flags, params = statement.read_execute(data)
+        sql = statement.bind(params)
+        profile.statement = sql
+        log.debug("Executing %d: %s", statement.id, sql)
+        self.close_cursor(statement.id)
+        self.binary = True
+        try:
+            self.query(sql, profile, statement.id
+                       if flags & CURSOR_TYPE_READ_ONLY else None)
+        finally:
+            self.binary = False
+
+
+    def fetch (self, statement_id, count, profile):
+        """ Sends the next rows from a statement's cursor. """
+
+        cursor = self.cursors.get(statement_id)
+        try:
+            if cursor is None:
+                raise CursorClosed()
+            with profile.phase("backend"):
+                rows, done = cursor.fetch(count)
+        except CursorClosed:
+            self.cursors.pop(statement_id, None)
+            self.send_packet(ErrorPacket(
+                code=1421, message="The statement (%d) has no open cursor."
+                % statement_id), profile)
+            return
+        profile.rows += len(rows)
+
+        # The rows, then an EOF saying whether there's any more
+        packets = [BinaryRowDataPacket((i + 1) & 0xFF, row)
+                   for i, row in enumerate(rows)]
+        status = SERVER_STATUS_CURSOR_EXISTS | self.server_status
+        if done:
+            status |= SERVER_STATUS_LAST_ROW_SENT
+            self.close_cursor(statement_id)
+        packets.append(EOFPacket((len(packets) + 1) & 0xFF,
+                                 server_status=status))
+        with profile.phase("encode"):
+            data = "".join(str(p) for p in packets)
+        with profile.phase("write"):
+            self.socket.sendall(data)
+        profile.bytes_sent += len(data)
+
+
+    def close_cursor (self, statement_id):
+        cursor = self.cursors.pop(statement_id, None)
+        if cursor is not None:
+            cursor.close()
+
+
+    def query (self, statement, profile, cursor=None):
+        """
+        Runs a statement from the client, and sends back the response.
+        Returns False if the session should end.
+
+        If cursor is a prepared statement's id, a SELECT's rows are
+        left in a cursor for COM_STMT_FETCH, rather than sent.
+        """
+
+        # Queries about the query stats themselves
+        if self.show_profile_regex.match(statement):
+            query_id = self.show_profile_regex.match(statement).group(1)
+            past = [p for p in self.profiles
+                    if query_id is None or p.id == int(query_id)]
+            rows = profiling.profile_rows(past[-1]) if past else []
+            self.send_result(["Status", "Duration"], rows, profile)
+        elif self.show_profiles_regex.match(statement):
+            rows = [[str(p.id), "%.6f" % p.duration, p.statement]
+                    for p in self.profiles]
+            self.send_result(["Query_ID", "Duration", "Query"], rows, profile)
+        elif self.show_status_regex.match(statement):
+            rows = [[name, str(value)]
+                    for name, value in profiling.stats.snapshot()]
+            self.send_result(["Variable_name", "Value"], rows, profile)
+        elif self.query_stats_regex.match(statement):
+            rows = profiling.query_stats_rows(profiling.stats.recent())
+            self.send_result(profiling.QUERY_STATS_COLUMNS, rows, profile,
+                             "query_stats", "pysql")
+        elif self.index_advice_regex.match(statement):
+            advice = index_advisor.advisor.recommend(self.backend)
+            self.send_result(index_advisor.ADVICE_COLUMNS,
+                             index_advisor.advice_rows(advice), profile)
+        elif self.use_regex.match(statement):
+            self.use(self.use_regex.match(statement).group(1), profile)
+        elif self.kill_regex.match(statement):
+            kind, thread_id = self.kill_regex.match(statement).groups()
+            self.kill(int(thread_id), (kind or "").upper() == "QUERY", profile)
+        elif self.show_processlist_regex.match(statement):
+            self.send_result(sessions.PROCESSLIST_COLUMNS,
+                             sessions.processlist_rows(sessions.registry.all()),
+                             profile)
+        elif self.set_max_execution_time_regex.match(statement):
+            self.max_execution_time = int(
+                self.set_max_execution_time_regex.match(statement).group(1))
+            self.send_packet(OKPacket(), profile)
+        elif self.begin_regex.match(statement):
+            options = (self.begin_regex.match(statement).group(1) or "").upper()
+            self.begin("ONLY" in options)
+            self.send_packet(OKPacket(), profile)
+        elif self.commit_regex.match(statement):
+            with profile.phase("backend"):
+                self.commit()
+            self.send_packet(OKPacket(), profile)
+        elif self.rollback_regex.match(statement):
+            self.rollback()
+            self.send_packet(OKPacket(), profile)
+        elif self.set_autocommit_regex.match(statement):
+            value = self.set_autocommit_regex.match(statement).group(1)
+            autocommit = value.upper() in ("1", "ON", "TRUE")
+            if autocommit and not self.autocommit:
+                # Turning it back on commits
+                with profile.phase("backend"):
+                    self.commit()
+            self.autocommit = autocommit
+            self.send_packet(OKPacket(), profile)
+        elif self.metadata(statement, profile):
+            pass
+
+        elif statement.lower().lstrip().startswith("insert"):
+            query = InsertQuery(statement)
+            try:
+                query_info = query.execute(profile)
+            except sql_parsers.UnsupportedSQLExpression, e:
+                query_info = None
+                error = e
+            else:
+                error = None
+            if not query_info:
+                log.info("Unsupported INSERT query.")
+                self.send_packet(self.unsupported(statement, error), profile)
+                return
+            table, documents = query_info
+            log.debug("Inserting into %s: %s", table, documents)
+            if self.transaction is None and not self.autocommit:
+                # With autocommit off, there's always a transaction
+                self.begin()
+            if self.transaction is not None:
+                self.transaction.insert(self.backend.database, table,
+                                        documents)
+                self.send_packet(OKPacket(affected_rows=len(documents)),
+                                 profile)
+                return
+            with profile.phase("backend"):
+                # Single-row INSERTs get written along with other sessions'
+                # (multi-row ones are a batch already)
+                if self.coalescer is not None and len(documents) == 1:
+                    self.coalescer.insert(self.backend, table, documents)
                 else:
-                    print "Running db.%s.find()" % table
-                    results = mongo_coll[table].find()
-
-                # If we got any results, send them back
-                if results.count():
-                    # Convert everything to MySQL format
-                    # Start by getting a list of all the columns
-                    cols = results[0].keys()
-                    # Delete the _id key to avoid issues for now
-                    cols = [x for x in cols if x != "_id"]
-                    # Put togeher all the dictionaries into flat rows
-                    rows = []
-                    for res in results:
-                        data = []
-                        for c in cols:
-                            data.append(res[c])
-                        rows.append(data)
-                    print "Rows: %s" % rows
-                    print "Cols: %s" % cols
-                    # Turn it into actual packets and sent it out
-                    rs = ResultSet(cols, rows, table, "pysql_test")
-                    self.socket.send(str(rs))
+                    self.backend.insert(table, documents)
+            self.catalog.table_written(self.backend.database, table)
+            self.send_packet(OKPacket(affected_rows=len(documents)), profile)
+
+        elif statement.lower().find("select") != -1:
+            """cols = ["Name", "City"]
+            rows = [["Jon", "NYC"], ["GMP", "Worc"]]
+            rs = ResultSet(cols, rows, "test_table", "test")
+            self.socket.send(str(rs))"""
+            query = SelectQuery(statement)
+            try:
+                query_info = query.execute(profile)
+            except sql_parsers.UnsupportedSQLExpression, e:
+                query_info = None
+                error = e
+            else:
+                error = None
+            if not query_info or not query.table:
+                log.info("Unsupported SELECT query.")
+                self.send_packet(self.unsupported(statement, error), profile)
+                return
+            table, cond = query_info
+            if self.transaction is None and not self.autocommit:
+                self.begin()
+            backend = self.backend
+            if query.database:
+                if query.database.lower() == "information_schema":
+                    columns, rows = self.catalog.select(
+                        table, cond, query.columns, query.order,
+                        query.limit, query.offset)
+                    self.send_result(columns, rows, profile,
+                                     table, "information_schema")
+                    return
+                backend = self.default_backend.use(query.database)
+            log.debug("Finding in %s: %s", table, cond)
+            # Lets the query be killed, or time out (hints win over
+            # the session's max_execution_time, as in MySQL)
+            max_time = query.max_execution_time
+            if max_time is None:
+                max_time = self.max_execution_time
+            self.control = QueryControl(max_time)
+            try:
+                if self.scheduler is None:
+                    self.select(query, backend, table, cond, profile, cursor)
                 else:
-                    self.socket.send(str(OKPacket()))
+                    # Wait for a slot (which can be killed, or time out)
+                    kind = self.scheduler.classify(
+                        self.catalog, backend.database, table, cond,
+                        query.order, query.limit, query.offset)
+                    with self.scheduler.admit(self.user, kind, self.control):
+                        self.select(query, backend, table, cond, profile,
+                                    cursor)
+            finally:
+                self.control = None
+
+            # Note the query's shape for the index advisor
+            index_advisor.advisor.record(backend, table, cond,
+                                         query.order,
+                                         time.time() - profile.started)
+
+        elif self.noop_regex.match(statement):
+            self.send_packet(OKPacket(), profile)
 
+        else:
+            # (An OK would tell the client it worked, when nothing ran)
+            log.info("Unsupported statement: %s", statement)
+            self.send_packet(ErrorPacket(
+                code=1235, sql_state="42000",
+                message="pysql doesn't support '%s'" % statement.strip()[:80]
+            ), profile)
+
+
+    def select (self, query, backend, table, cond, profile, cursor=None):
+        """ Runs a (parsed) SELECT against a backend, sending the rows. """
+
+        control = self.control
+        # (Raw documents, if the backend has them, get their
+        # fields read out as they're mapped to rows)
+        options = {"parallel": query.parallel, "unwind": query.unnest,
+                   "raw": True}
+        if control.deadline is not None:
+            # So the backend stops too, rather than just the proxy
+            options["max_time_ms"] = control.remaining_ms()
+        # (A transaction adds in its own writes)
+        find = backend.find if self.transaction is None else \
+               functools.partial(self.transaction.find, backend)
+        with profile.phase("plan"):
+            results = find(
+                table, cond, query.columns, query.order,
+                query.limit, query.offset, **options
+            )
+        if cursor is None:
+            results = profile.timed_rows(results)
+
+        # If we got any results, send them back
+        try:
+            first = next(results, None)
+            control.check()
+        except (QueryInterrupted, QueryTimeout):
+            if hasattr(results, "close"):
+                results.close()
+            raise
+        # (A cursor gets its columns, and an empty cursor to fetch
+        # from, even when there aren't any rows)
+        if first is not None or cursor is not None:
+            # Convert everything to MySQL format, starting with the
+            # columns (the first document's fields, for SELECT *)
+            columns = query.columns
+            if first is None and not columns:
+                columns = [name for name, kind
+                           in self.catalog.columns(backend.database, table)]
+            mapper = row_mapping.RowMapper(columns, first)
+            cols = mapper.columns
+            log.debug("Cols: %s", cols)
+            # Put together the documents into flat rows
+            # as they come in from the cursor
+            documents = results if first is None else \
+                        itertools.chain([first], results)
+            encoded = mapper.raw and not self.binary and cursor is None
+            if encoded:
+                # Raw BSON goes straight into the packets
+                rows = row_mapping.RawRowEncoder(cols).rows(documents)
+            else:
+                rows = mapper.rows(documents)
+            if cursor is not None:
+                # Keep the rows for COM_STMT_FETCH,
+                # and just send the columns now
+                self.cursors[cursor] = Cursor(cols, rows, results)
+                rows = []
+            # Turn it into actual packets and stream it out
+            # (checking for KILL QUERY and the time limit as it goes)
+            rs = ResultSet(cols, rows, table, backend.database,
+                           self.binary, cursor is not None, encoded,
+                           self.server_status)
+            rs.send(self.socket, profile=profile, check=control.check)
+        else:
+            self.send_packet(OKPacket(), profile)
 
-                        
 
-            else:
-                self.socket.send(str(OKPacket()))
-            
+    def metadata (self, statement, profile):
+        """
+        Answers metadata queries (SHOW TABLES, SELECT @@version, etc.)
+        from the catalog. Returns False if it isn't one.
+        """
+
+        answer = self.catalog.answer(
+            statement, self.backend.database, self.user, self.thread_id,
+            {"max_execution_time": self.max_execution_time,
+             "autocommit": int(self.autocommit)})
+        if answer is None:
+            return False
+        columns, rows = answer
+        self.send_result(columns, rows, profile)
+        return True
+
+
+    def unsupported (self, statement, error=None):
+        """ Makes the error for a statement that couldn't be parsed. """
+
+        return ErrorPacket(
+            code=1064, sql_state="42000",
+            message="%s near '%s'" % (error or "Unsupported query",
+                                      statement.strip()[:80])
+        )
+
+
+    def send_packet (self, packet, profile):
+        """ Sends a single packet in response to a query. """
+
+        if isinstance(packet, (OKPacket, EOFPacket)):
+            packet.server_status |= self.server_status
+        data = str(packet)
+        with profile.phase("write"):
+            self.socket.sendall(data)
+        profile.bytes_sent += len(data)
+
+
+    def send_result (self, columns, rows, profile, table="", database=""):
+        """ Sends a result set made up in the proxy itself. """
+
+        profile.rows += len(rows)
+        ResultSet(columns, rows, table, database, self.binary,
+                  status=self.server_status).send(
+            self.socket, profile=profile)
 
     
 
@@ -595,20 +1724,182 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
     """
 
     def handle(self):
-        MySQLServerSession(self.request, self.client_address)
-        print "Done."
+        MySQLServerSession(self.request, self.client_address,
+                           getattr(self.server, "backend", None),
+                           getattr(self.server, "credentials", None),
+                           getattr(self.server, "catalog", None),
+                           getattr(self.server, "max_execution_time",
+                                   sessions.MAX_EXECUTION_TIME),
+                           getattr(self.server, "coalescer", None),
+                           getattr(self.server, "capture", None),
+                           getattr(self.server, "scheduler", None))
+        log.info("Done.")
 
 
 
-if __name__ == "__main__":
-    HOST, PORT = "0.0.0.0", 3306
+class MySQLServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Accepts MySQL connections, giving each one a session on its own thread.
 
-    # Create the server, binding to localhost on port 9999
-    server = SocketServer.TCPServer((HOST, PORT), MyTCPHandler)
+    All the sessions share the one backend (and its connection pool),
+    which is MongoDB on localhost by default.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__ (self, address, backend=None, credentials=None,
+                  max_execution_time=sessions.MAX_EXECUTION_TIME,
+                  reuse_port=False, coalescer=None, capture=None,
+                  scheduler=None):
+        # Lets several processes accept on the same port (see prefork)
+        self.reuse_port = reuse_port
+        SocketServer.TCPServer.__init__(self, address, MyTCPHandler)
+        self.backend = backend or make_backend()
+        # An auth.CredentialStore (None lets anyone in)
+        self.credentials = credentials
+        self.catalog = Catalog(self.backend)
+        # The sessions' default time limit for SELECTs (in ms)
+        self.max_execution_time = max_execution_time
+        # Gathers the sessions' single-row INSERTs into bulk writes
+        # (a coalescer.WriteCoalescer, or None)
+        self.coalescer = coalescer
+        # Records the sessions' commands for replay.py
+        # (a capture.CaptureWriter, or None)
+        self.capture = capture
+        # Decides when the sessions' SELECTs get to run
+        # (a scheduler.Scheduler, or None)
+        self.scheduler = scheduler
+
+
+    def server_bind (self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, prefork.SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
+
+
+
+def make_backend (kind="mongo", directory=None, database="pysql_test"):
+    """
+    Makes a backend by name (for the command line). The backends'
+    modules (and drivers, like pymongo) are only imported when used.
+    """
+
+    if kind == "memory":
+        from memory_backend import MemoryBackend
+        return MemoryBackend(database)
+    elif kind == "sqlite":
+        from sqlite_backend import SQLiteBackend
+        return SQLiteBackend(directory, database)
+    elif kind == "columnar":
+        from columnar_backend import ColumnarBackend
+        return ColumnarBackend(directory, database)
+    from mongo_backend import MongoBackend
+    return MongoBackend(database=database)
 
-    # Activate the server; this will keep running until you
-    # interrupt the program with Ctrl-C
-    server.serve_forever()
 
 
-  
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="PySQL server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--backend", default="mongo",
+                        choices=["mongo", "memory", "sqlite", "columnar"])
+    parser.add_argument("--data", help="Directory for file backends")
+    parser.add_argument("--database", default="pysql_test",
+                        help="Database for sessions that don't pick one")
+    parser.add_argument("--users",
+                        help="File of users and password hashes to accept")
+    parser.add_argument("--auto-index", type=int, metavar="N",
+                        help="Create advised indexes after N queries")
+    parser.add_argument("--max-execution-time", type=int, metavar="MS",
+                        default=sessions.MAX_EXECUTION_TIME,
+                        help="Stop SELECTs that run longer than this")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="Run N server processes (with SO_REUSEPORT)")
+    parser.add_argument("--coalesce-writes", action="store_true",
+                        help="Write concurrent single-row INSERTs in batches")
+    parser.add_argument("--write-window", type=float, metavar="MS",
+                        default=coalescer.WINDOW * 1000,
+                        help="How long a batch of INSERTs waits for more")
+    parser.add_argument("--write-batch", type=int, metavar="N",
+                        default=coalescer.MAX_BATCH,
+                        help="The most INSERTs to write in one batch")
+    parser.add_argument("--metrics-port", type=int, default=metrics.HTTP_PORT,
+                        help="Port to serve the metrics on")
+    parser.add_argument("--in-batch-size", type=int, metavar="N",
+                        default=backend.IN_BATCH_SIZE,
+                        help="Split IN lists longer than this into batches "
+                             "queried in parallel (0 never splits them)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Record the commands clients send (for replay.py)"
+                             "; with --workers, each writes FILE.<pid>")
+    parser.add_argument("--capture-buffer", type=int, metavar="N",
+                        default=capture.BUFFER_SIZE,
+                        help="Drop captured commands when N are waiting to "
+                             "be written")
+    parser.add_argument("--max-queries", type=int, metavar="N", default=0,
+                        help="Run at most N SELECTs at once, queueing the "
+                             "rest fairly between short and long ones")
+    parser.add_argument("--max-user-queries", type=int, metavar="N",
+                        default=scheduler.MAX_USER_QUERIES,
+                        help="Run at most N of a user's SELECTs at once")
+    parser.add_argument("--max-long-queries", type=int, metavar="N",
+                        help="Run at most N long SELECTs (table scans) at once "
+                             "(default: half of --max-queries)")
+    parser.add_argument("--max-queued", type=int, metavar="N",
+                        default=scheduler.MAX_QUEUED,
+                        help="Turn SELECTs away when N of their class are "
+                             "already waiting")
+    parser.add_argument("--parallel", type=int, metavar="N",
+                        default=parallel_scan.DEFAULT_DEGREE,
+                        help="Scan big MongoDB collections in N partitions at "
+                             "once (unless a query's PARALLEL hint says "
+                             "otherwise)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    index_advisor.advisor.auto_create_threshold = args.auto_index
+    backend.IN_BATCH_SIZE = args.in_batch_size
+    parallel_scan.DEFAULT_DEGREE = args.parallel
+    credentials = None
+    if args.users:
+        credentials = auth.CredentialStore.load(args.users)
+
+    # Create the server, binding to all interfaces on port 3306
+    def make_server ():
+        writes = None
+        if args.coalesce_writes:
+            writes = coalescer.WriteCoalescer(args.write_window / 1000.0,
+                                              args.write_batch)
+        recorder = None
+        if args.capture:
+            path = args.capture
+            if args.workers > 1:
+                path = "%s.%d" % (path, os.getpid())
+            recorder = capture.CaptureWriter(path, args.capture_buffer)
+        admission = None
+        if args.max_queries or args.max_user_queries:
+            admission = scheduler.Scheduler(
+                args.max_queries, args.max_user_queries,
+                args.max_long_queries, args.max_queued)
+        return MySQLServer(
+            (args.host, args.port),
+            make_backend(args.backend, args.data, args.database),
+            credentials, args.max_execution_time, args.workers > 1, writes,
+            recorder, admission)
+
+    if args.workers > 1:
+        # Each worker makes its own server (and backend connections),
+        # while this process restarts them and serves their metrics
+        supervisor = prefork.Supervisor(make_server, args.workers,
+                                        registry=metrics.REGISTRY)
+        metrics.start_http_server(args.metrics_port,
+                                  registry=supervisor.shared)
+        supervisor.run()
+    else:
+        metrics.start_http_server(args.metrics_port)
+        # Activate the server; this will keep running until you
+        # interrupt the program with Ctrl-C
+        make_server().serve_forever()
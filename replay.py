@@ -0,0 +1,338 @@
+"""
+Replays traffic captured with pysql.py --capture, for performance testing.
+
+Each captured session gets a connection (and thread) of its own, which
+sends the session's commands at the times they were recorded, or
+--speed times faster (--speed 0 sends them back to back), eg.
+    python pysql.py --capture prod.log ...
+    python replay.py prod.log --port 3307 --speed 4 --output new.json
+
+Then reports the latencies by normalized statement (the statement with
+its literals replaced by ?s), against the ones recorded or, with
+--compare, an earlier replay's:
+    python replay.py prod.log --output before.json
+    (make changes)
+    python replay.py prod.log --compare before.json
+
+The recorded latencies are the server's own timings, so unlike the
+replayed ones they don't include the network round trip; comparing two
+replays is the fairer test of a change.
+"""
+
+import re
+import json
+import time
+import struct
+import socket
+import logging
+import argparse
+import threading
+import collections
+
+import capture
+from benchmark import percentile, git_commit
+from pysql import CommandPacket
+from mysql_client import MySQLClient, MySQLError, COM_QUERY, \
+     COM_CHANGE_USER, COM_STMT_PREPARE, COM_STMT_EXECUTE, \
+     COM_STMT_SEND_LONG_DATA, COM_STMT_CLOSE, COM_STMT_RESET, \
+     COM_STMT_FETCH, CURSOR_TYPE_READ_ONLY
+
+
+log = logging.getLogger("pysql.replay")
+
+# What normalize() replaces, in order
+NORMALIZE_RULES = [
+    # Strings
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""), "?"),
+    # Numbers (but not the digits in names, like t1)
+    (re.compile(r"(?<![\w.])\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b"), "?"),
+    # IN lists and VALUES rows, whatever their length
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+# Commands that get no response
+NO_RESPONSE = frozenset([COM_STMT_SEND_LONG_DATA, COM_STMT_CLOSE])
+
+# Commands that start with a statement id
+STATEMENT_COMMANDS = frozenset([
+    COM_STMT_EXECUTE, COM_STMT_SEND_LONG_DATA, COM_STMT_CLOSE,
+    COM_STMT_RESET, COM_STMT_FETCH])
+
+# How many statements to print
+TOP = 20
+
+
+
+def normalize (statement):
+    """ Reduces a statement to its shape, eg. "SELECT * FROM t WHERE id = ?". """
+
+    for regex, replacement in NORMALIZE_RULES:
+        statement = regex.sub(replacement, statement)
+    return statement.strip().rstrip(";").rstrip()
+
+
+def load (path):
+    """ Reads a capture log, returning each session's records, by session. """
+
+    sessions = collections.OrderedDict()
+    for record in capture.read_log(path):
+        sessions.setdefault(record.session, []).append(record)
+    return sessions
+
+
+
+class SessionState (object):
+    """ A replayed session's connection and prepared statements. """
+
+    def __init__ (self):
+        self.client = None
+        # The replayed statement ids, and their (normalized) SQL, by
+        # the captured ids (which pysql hands out from 1, in order)
+        self.ids = {}
+        self.sql = {}
+        self.prepared = 0
+
+
+
+class Replayer (object):
+    """ Replays captured sessions against a server. """
+
+    def __init__ (self, sessions, host="127.0.0.1", port=3306, user=None,
+                  password="", speed=1.0):
+        self.sessions = sessions
+        self.host = host
+        self.port = port
+        # Who to log in as (None logs in as the captured user)
+        self.user = user
+        self.password = password
+        self.speed = speed
+        self.lock = threading.Lock()
+        # (statement, recorded seconds, replayed seconds, error code)
+        # for each command
+        self.results = []
+        # Commands sent over 10ms later than they should have been
+        self.late = 0
+        self.first = min([records[0].time for records in sessions.values()
+                          if records] or [0])
+
+
+    def run (self):
+        """ Replays all the sessions, returning the results. """
+
+        self.started = time.time()
+        threads = []
+        for records in self.sessions.values():
+            thread = threading.Thread(target=self.replay_session,
+                                      args=(records,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - self.started
+        return self.results
+
+
+    def wait (self, record):
+        """ Waits until it's time to send a record (at the replay's speed). """
+
+        if not self.speed:
+            return
+        delay = self.started + (record.time - self.first) / self.speed - \
+                time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -0.01:
+            with self.lock:
+                self.late += 1
+
+
+    def connect (self, user, database=None):
+        return MySQLClient(self.host, self.port, self.user or user,
+                           self.password, database or None)
+
+
+    def replay_session (self, records):
+        """ Replays one session's records (runs on its own thread). """
+
+        state = SessionState()
+        results = []
+        try:
+            for record in records:
+                self.wait(record)
+                if record.command == capture.CONNECT:
+                    user, database = record.payload.split("\0", 1)
+                    state.client = self.connect(user, database)
+                    continue
+                elif record.command == capture.DISCONNECT:
+                    break
+                if state.client is None:
+                    # (Captured without its CONNECT)
+                    state.client = self.connect("root")
+
+                statement = self.describe(record, state)
+                error = None
+                start = time.time()
+                try:
+                    self.send(record, state)
+                except MySQLError, e:
+                    error = e.code
+                results.append((statement, record.duration,
+                                time.time() - start, error))
+        except (socket.error, EOFError), e:
+            log.error("Session %d stopped: %s", records[0].session, e)
+        finally:
+            if state.client is not None:
+                state.client.close()
+            with self.lock:
+                self.results.extend(results)
+
+
+    def describe (self, record, state):
+        """ Gets the normalized statement a command is reported under. """
+
+        if record.command == COM_QUERY:
+            return normalize(record.payload)
+        elif record.command == COM_STMT_PREPARE:
+            return "PREPARE " + normalize(record.payload)
+        elif record.command in (COM_STMT_EXECUTE, COM_STMT_FETCH):
+            statement_id = struct.unpack("< I", record.payload[:4])[0]
+            return "%s %s" % (CommandPacket.commands[record.command].upper(),
+                              state.sql.get(statement_id, "?"))
+        return CommandPacket.commands.get(record.command, "Unknown")
+
+
+    def send (self, record, state):
+        """ Sends a command, and reads its response. """
+
+        client = state.client
+        command = record.command
+        payload = record.payload
+
+        if command in STATEMENT_COMMANDS:
+            # Swap in the replayed statement id
+            captured = struct.unpack("< I", payload[:4])[0]
+            payload = struct.pack("< I", state.ids.get(captured, captured)) \
+                      + payload[4:]
+
+        if command == COM_QUERY:
+            client.query(payload)
+        elif command == COM_STMT_PREPARE:
+            state.prepared += 1
+            state.sql[state.prepared] = normalize(payload)
+            state.ids[state.prepared] = client.prepare(payload)[0]
+        elif command == COM_STMT_EXECUTE:
+            client.send_execute(payload,
+                                ord(payload[4]) & CURSOR_TYPE_READ_ONLY)
+        elif command == COM_STMT_FETCH:
+            client.fetch(*struct.unpack("< I I", payload[:8]))
+        elif command == COM_CHANGE_USER:
+            user, rest = payload.split("\0", 1)
+            database = rest[1 + ord(rest[0]):].split("\0", 1)[0]
+            client.change_user(self.user or user, self.password, database)
+        elif command in NO_RESPONSE:
+            client.send_packet(chr(command) + payload, 0)
+        else:
+            # (COM_INIT_DB, COM_PING, COM_STMT_RESET, etc.)
+            client.command(command, payload)
+
+
+
+def summarize (results, elapsed=0.0, late=0):
+    """ Gets the latencies by statement (and overall), in milliseconds. """
+
+    by_statement = collections.defaultdict(list)
+    for statement, recorded, replayed, error in results:
+        by_statement[statement].append((recorded, replayed, error))
+
+    statements = {}
+    for statement, runs in by_statement.items():
+        recorded = sorted(r[0] * 1000 for r in runs)
+        replayed = sorted(r[1] * 1000 for r in runs)
+        statements[statement] = {
+            "count": len(runs),
+            "errors": sum(1 for r in runs if r[2] is not None),
+            "recorded_p50_ms": percentile(recorded, 50),
+            "p50_ms": percentile(replayed, 50),
+            "p99_ms": percentile(replayed, 99),
+            "total_ms": sum(replayed),
+        }
+    replayed = sorted(r[2] * 1000 for r in results)
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "statements": statements,
+        "overall": {
+            "commands": len(results),
+            "errors": sum(1 for r in results if r[3] is not None),
+            "elapsed": elapsed,
+            "late": late,
+            "p50_ms": percentile(replayed, 50),
+            "p99_ms": percentile(replayed, 99),
+        },
+    }
+
+
+def report (results, baseline=None, top=TOP):
+    """
+    Prints the statements taking the most time, with their p50 change
+    from the baseline (or from the captured latencies).
+    """
+
+    old = (baseline or {}).get("statements", {})
+    statements = sorted(results["statements"].items(),
+                        key=lambda item: -item[1]["total_ms"])
+    print "%7s %6s %10s %10s %8s  %s" % (
+        "count", "errors", "before_p50", "p50_ms", "change", "statement")
+    for statement, r in statements[:top]:
+        if baseline:
+            before = old.get(statement, {}).get("p50_ms")
+        else:
+            before = r["recorded_p50_ms"]
+        change = ""
+        if before:
+            change = "%+.1f%%" % ((r["p50_ms"] - before) * 100.0 / before)
+        print "%7d %6d %10s %10.2f %8s  %s" % (
+            r["count"], r["errors"],
+            "-" if before is None else "%.2f" % before,
+            r["p50_ms"], change, statement[:80])
+    overall = results["overall"]
+    print "%d commands in %.1fs (%d errors, %d sent late), p50 %.2fms " \
+          "p99 %.2fms" % (overall["commands"], overall["elapsed"],
+                          overall["errors"], overall["late"],
+                          overall["p50_ms"] or 0, overall["p99_ms"] or 0)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("log", help="A log from pysql.py --capture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", help="Log in as this user "
+                                       "(rather than the captured ones)")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="How much faster than captured to replay "
+                             "(0 for as fast as possible)")
+    parser.add_argument("--top", type=int, default=TOP,
+                        help="How many statements to report")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with a previous replay")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    replayer = Replayer(load(args.log), args.host, args.port, args.user,
+                        args.password, args.speed)
+    replayer.run()
+    results = summarize(replayer.results, replayer.elapsed, replayer.late)
+    report(results, baseline, args.top)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
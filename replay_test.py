@@ -0,0 +1,75 @@
+import os
+import tempfile
+import threading
+import unittest
+from capture import CaptureWriter
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+from replay import Replayer, normalize, load, summarize
+
+class ReplayTests(unittest.TestCase):
+    def start(self, backend, writer=None):
+        server = MySQLServer(("127.0.0.1", 0), backend, capture=writer)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def stop(self, server):
+        server.shutdown()
+        server.server_close()
+
+    def test_normalize(self):
+        """ Statements differing only in their literals should match. """
+        self.assertEqual("SELECT * FROM t1 WHERE id = ? AND name = ?",
+                         normalize("SELECT * FROM t1  WHERE id = 5 "
+                                   "AND name = 'it''s';"))
+        self.assertEqual("select a from t where id in (...)",
+                         normalize("select a from t where id in (1, 2,3)"))
+        self.assertEqual("insert into t (a, b) values (...)",
+                         normalize("insert into t (a, b) values (1, 'x'), "
+                                   "(2.5, \"y\")"))
+
+    def test_replay(self):
+        """ A captured session should be replayed against another server. """
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            writer = CaptureWriter(path)
+            server = self.start(MemoryBackend(), writer)
+            client = MySQLClient(port=server.server_address[1])
+            for i in range(3):
+                client.query("insert into t (a) values (%d)" % i)
+            statement_id = client.prepare("select a from t where a = ?")[0]
+            client.execute(statement_id, [1])
+            client.close_statement(statement_id)
+            self.assertRaises(MySQLError, client.query,
+                              "select a from missing where ~")
+            client.close()
+            self.stop(server)
+            writer.close()
+
+            backend = MemoryBackend()
+            target = self.start(backend)
+            try:
+                replayer = Replayer(load(path), port=target.server_address[1],
+                                    speed=0)
+                results = summarize(replayer.run())
+            finally:
+                self.stop(target)
+        finally:
+            os.remove(path)
+
+        self.assertEqual([0, 1, 2], sorted(d["a"] for d in backend.scan("t")))
+        statements = results["statements"]
+        self.assertEqual(3, statements["insert into t (a) values (...)"]
+                            ["count"])
+        self.assertEqual(1, statements["EXECUTE select a from t where a = ?"]
+                            ["count"])
+        self.assertEqual(1, results["overall"]["errors"])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""
+Maps documents onto the rows of a result set.
+
+Columns are (possibly dotted) paths into the documents, so
+SELECT address.city FROM people reads the city out of each
+address subdocument. Values without a column type of their own
+(subdocuments and arrays) are sent as JSON, and fields a document
+doesn't have come out as NULL.
+
+Documents can be dicts, or raw BSON (anything with a .raw, like
+pymongo's RawBSONDocument, or a bson_scan.RawDocument), which has
+only the fields in the columns read out of it, rather than being
+decoded in full. For text rows, RawRowEncoder goes further, and
+encodes raw documents straight into the rows' packet payloads.
+"""
+
+import json
+
+import bson_scan
+from conditions import get_path, MISSING
+
+
+
+def raw_buffer (doc):
+    """ Gets the buffer a raw document is in, and where it starts. """
+
+    if isinstance(doc, bson_scan.RawDocument):
+        return doc.data, doc.start
+    return doc.raw, 0
+
+
+def sql_value (value):
+    """ Turns a document's value into one for a row. """
+
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        # (default=str covers ObjectIds, dates, etc. inside them)
+        return json.dumps(value, default=str)
+    return value
+
+
+
+class RowMapper (object):
+    """ Turns documents into rows, for a list of columns. """
+
+    def __init__ (self, columns=None, first=None):
+        """
+        Uses the given columns, or (for SELECT *) the top level
+        fields of the first document, other than its _id.
+        """
+
+        self.raw = first is not None and hasattr(first, "raw")
+        if not columns:
+            names = bson_scan.keys(*raw_buffer(first)) if self.raw else \
+                    first.keys() if first is not None else []
+            columns = [name for name in names if name != "_id"]
+        self.columns = list(columns)
+
+
+    def row (self, doc):
+        """ Gets a document's row (a list of values, in column order). """
+
+        if self.raw:
+            data, start = raw_buffer(doc)
+            return [sql_value(bson_scan.get_path(data, column, start))
+                    for column in self.columns]
+        row = []
+        for column in self.columns:
+            # Flat documents (eg. from SQLite, or a backend's projection)
+            # can have the dotted name as a plain key
+            value = doc.get(column, MISSING)
+            if value is MISSING and "." in column:
+                value = get_path(doc, column)
+            row.append(sql_value(value))
+        return row
+
+
+    def rows (self, documents):
+        """ Maps documents to rows as they're read. """
+
+        row = self.row
+        return (row(doc) for doc in documents)
+
+
+
+class RawRowEncoder (object):
+    """
+    Encodes raw documents straight into text row payloads, without
+    making Python values out of their fields (other than the ones
+    that aren't strings).
+
+    Each document's elements are walked once, picking out the
+    columns' top level fields as they come up, rather than looking
+    up each column in turn.
+    """
+
+    def __init__ (self, columns):
+        self.columns = list(columns)
+        # Top level field -> [(column number, the rest of its path)]
+        self.fields = {}
+        for i, column in enumerate(self.columns):
+            name, dot, rest = column.partition(".")
+            self.fields.setdefault(name, []).append((i, rest or None))
+
+
+    def encode (self, doc):
+        """ Gets a raw document's text row payload. """
+
+        data, start = raw_buffer(doc)
+        fields = self.fields
+        values = [bson_scan.NULL_TEXT] * len(self.columns)
+        left = len(fields)
+        # (This is bson_scan.elements and text_value inlined,
+        # since it runs for every field of every row)
+        unpack_int = bson_scan.INT32.unpack_from
+        index = data.index
+        fixed_sizes = bson_scan.FIXED_SIZES
+        length_coded = bson_scan.length_coded
+        STRING = bson_scan.STRING
+        pos = start + 4
+        end = start + unpack_int(data, start)[0] - 1
+        while pos < end:
+            kind = data[pos]
+            name_end = index("\0", pos + 1)
+            wanted = fields.get(data[pos + 1:name_end])
+            pos = name_end + 1
+            if kind == STRING:
+                size = unpack_int(data, pos)[0]
+                if wanted is not None and wanted[0][1] is None:
+                    # Strings are UTF-8 already, so they just get copied
+                    values[wanted[0][0]] = \
+                        length_coded(size - 1) + data[pos + 4:pos + 3 + size]
+                    wanted = wanted[1:]
+                value_end = pos + 4 + size
+            elif kind in fixed_sizes:
+                value_end = pos + fixed_sizes[kind]
+            else:
+                value_end = bson_scan.value_end(data, kind, pos)
+            if wanted is not None:
+                for i, rest in wanted:
+                    if rest is None:
+                        values[i] = bson_scan.text_value(data, kind, pos)
+                    elif kind in (bson_scan.DOCUMENT, bson_scan.ARRAY):
+                        inner = bson_scan.find_path(data, rest, pos)
+                        if inner is not None:
+                            values[i] = bson_scan.text_value(data, *inner)
+                # Stop once every field has turned up
+                left -= 1
+                if not left:
+                    break
+            pos = value_end
+        return "".join(values)
+
+
+    def rows (self, documents):
+        """ Encodes raw documents as they're read. """
+
+        encode = self.encode
+        return (encode(doc) for doc in documents)
@@ -0,0 +1,100 @@
+import threading
+import unittest
+import bson
+import bson_scan
+import backend
+from backend import Documents
+from mysql_client import MySQLClient
+from pysql import MySQLServer, length_coded_string
+from row_mapping import RowMapper, RawRowEncoder
+
+class Raw(object):
+    """ Stands in for pymongo's RawBSONDocument. """
+    def __init__(self, doc):
+        self.raw = bson.BSON.encode(doc)
+
+class RawBackend(backend.Backend):
+    """ Hands out its documents as a raw batch, like MongoDB can. """
+    capabilities = frozenset([backend.FILTER, backend.PROJECTION,
+                              backend.SORT, backend.LIMIT])
+    database = "test"
+    def __init__(self, docs):
+        self.batch = "".join(bson.BSON.encode(doc) for doc in docs)
+    def use(self, database):
+        return self
+    def scan(self, table, *args, **options):
+        if not options.get("raw"):
+            return iter(bson.decode_all(self.batch))
+        return (bson_scan.RawDocument(self.batch, start)
+                for start in bson_scan.documents(self.batch))
+
+class RowMappingTests(unittest.TestCase):
+    doc = {"_id": 1, "name": "Jon", "ok": True, "missing": None,
+           "address": {"city": "NYC", "zip": 10001},
+           "tags": ["a", "b"]}
+
+    def test_rows(self):
+        """ Paths should be followed, with JSON for the rest. """
+        mapper = RowMapper(["name", "address.city", "tags", "ok", "nope",
+                            "tags.1"])
+        self.assertEqual([["Jon", "NYC", '["a", "b"]', 1, None, "b"]],
+                         list(mapper.rows([self.doc])))
+        # SELECT * gets the first document's fields, other than _id
+        self.assertEqual(["name"],
+                         RowMapper(None, {"_id": 1, "name": "x"}).columns)
+        # Flat documents can have dotted keys
+        self.assertEqual(["x"], RowMapper(["a.b"]).row({"a.b": "x"}))
+
+    def test_raw(self):
+        """ Raw BSON should map to the same rows as the dicts. """
+        columns = ["name", "address.city", "address.zip", "tags", "ok",
+                   "missing", "nope", "address.nope.deeper", "tags.1"]
+        raw = Raw(self.doc)
+        self.assertEqual(RowMapper(columns).row(self.doc),
+                         RowMapper(columns, raw).row(raw))
+        self.assertEqual(sorted(self.doc), sorted(bson_scan.keys(raw.raw)))
+
+    def test_encoder(self):
+        """ Encoded rows should match the ones made from dicts. """
+        columns = ["name", "address.city", "address.zip", "tags", "ok",
+                   "missing", "nope", "tags.0", "score"]
+        doc = dict(self.doc, score=2.5)
+        batch = bson.BSON.encode({"x": 1}) + bson.BSON.encode(doc)
+        raw = bson_scan.RawDocument(batch, list(bson_scan.documents(batch))[1])
+        self.assertEqual(
+            "".join(length_coded_string(v)
+                    for v in RowMapper(columns).row(doc)),
+            RawRowEncoder(columns).encode(raw))
+
+    def test_fast_path(self):
+        """ Raw documents should come out the same through the server. """
+        docs = [{"_id": i, "name": "n%d" % i, "a": {"b": i * 1.5}}
+                for i in range(3)]
+        server = MySQLServer(("127.0.0.1", 0), RawBackend(docs))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = MySQLClient(port=server.server_address[1])
+        try:
+            self.assertEqual(
+                (["name", "a.b"], [["n0", "0.0"], ["n1", "1.5"], ["n2", "3.0"]]),
+                client.query("select name, a.b from t"))
+            self.assertEqual(["a", "name"],
+                             sorted(client.query("select * from t")[0]))
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_unwind(self):
+        """ Arrays should unwind into a document per element. """
+        docs = Documents([{"n": 1, "a": {"b": [1, 2]}}, {"n": 2, "a": {"b": []}},
+                          {"n": 3, "a": {"b": 5}}, {"n": 4}])
+        self.assertEqual([(1, 2), (3, 5)],
+                         [(d["n"], d["a"]["b"]) for d in docs.find(
+                             "t", {"a.b": {"$gte": 2}}, unwind="a.b")])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
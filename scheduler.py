@@ -0,0 +1,293 @@
+"""
+Admission control for SELECTs.
+
+Without it every session's query runs as soon as it comes in, so a
+few clients' full table scans can take up the backend (and the
+proxy's CPU) while everyone else's point lookups wait behind them.
+
+With a Scheduler, each SELECT first gets a slot:
+    - only max_queries run at once, and only max_user_queries of any
+      one user's,
+    - queries are classed as short or long by the rows they'd have to
+      look at (estimate(), from the table's size and indexes), and
+      only max_long_queries long ones run at once, so there's always
+      room for the short ones,
+    - queries that have to wait are queued by class, and free slots are
+      shared out between the classes by weight (stride scheduling, so
+      with the default weights short queries get 4 slots for every
+      long one while both are waiting), first come first served
+      within a class,
+    - once max_queued queries of a class are waiting, more are turned
+      away with an error straight away, rather than left to stall.
+"""
+
+import time
+import logging
+import threading
+import collections
+
+import metrics
+import index_advisor
+
+
+log = logging.getLogger("pysql.scheduler")
+
+# Queries looking at more rows than this (by estimate()) are long
+SHORT_COST = 1000
+
+# How much of a table an indexed equality match, and an indexed range,
+# are guessed to look at
+EQUALITY_FRACTION = 0.001
+RANGE_FRACTION = 0.1
+
+# How the free slots get shared out between the classes
+WEIGHTS = {"short": 4, "long": 1}
+
+# The default limits (0 for none)
+MAX_QUERIES = 16
+MAX_USER_QUERIES = 0
+MAX_QUEUED = 100
+
+# Sent when a class's queue is full
+ER_USER_LIMIT_REACHED = 1226
+BUSY_STATE = "42000"
+
+
+
+class SchedulerBusy (Exception):
+    """ Too many queries were already waiting to run. """
+
+    code = ER_USER_LIMIT_REACHED
+    sql_state = BUSY_STATE
+
+    def __init__ (self, kind, limit):
+        Exception.__init__(
+            self, "Too many %s queries waiting to run (max_queued: %d), "
+                  "try again later" % (kind, limit))
+        self.kind = kind
+
+
+
+def estimate (catalog, database, table, conditions, order=None, limit=None,
+              offset=0):
+    """
+    Guesses how many rows a SELECT will look at, from the table's
+    (cached) row count and which fields have indexes.
+    """
+
+    rows = catalog.stats(database, table).get("rows") or 0
+    if not conditions:
+        if limit is not None and not order:
+            return min(rows, limit + (offset or 0))
+        return rows
+    indexed = set(fields[0][0] for fields
+                  in catalog.indexes(database, table).values() if fields)
+    # Each branch of an $or gets looked up separately
+    cost = 0
+    for shape in index_advisor.shapes(conditions, order):
+        if indexed.intersection(shape.equality):
+            fraction = EQUALITY_FRACTION
+        elif indexed.intersection(shape.range):
+            fraction = RANGE_FRACTION
+        else:
+            fraction = 1.0
+        cost += max(1, int(rows * fraction))
+    return min(cost, rows)
+
+
+def classify (cost, short_cost=SHORT_COST):
+    return "short" if cost <= short_cost else "long"
+
+
+
+class Ticket (object):
+    """ A query's place in the scheduler (released when it's done). """
+
+    __slots__ = ("scheduler", "user", "kind", "queued", "granted", "event")
+
+    def __init__ (self, scheduler, user, kind):
+        self.scheduler = scheduler
+        self.user = user
+        self.kind = kind
+        self.queued = time.time()
+        self.granted = False
+        self.event = threading.Event()
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, *exc_info):
+        self.scheduler.release(self)
+
+
+
+class Scheduler (object):
+    """ Decides when each session's SELECT gets to run. """
+
+    def __init__ (self, max_queries=MAX_QUERIES,
+                  max_user_queries=MAX_USER_QUERIES, max_long_queries=None,
+                  max_queued=MAX_QUEUED, weights=WEIGHTS,
+                  short_cost=SHORT_COST):
+        self.max_queries = max_queries
+        self.max_user_queries = max_user_queries
+        # (Half the slots, by default)
+        if max_long_queries is None:
+            max_long_queries = max(1, max_queries // 2) if max_queries else 0
+        self.max_long_queries = max_long_queries
+        self.max_queued = max_queued
+        self.weights = weights
+        self.short_cost = short_cost
+        self.lock = threading.Lock()
+        # The waiting tickets, and each class's pass (how far along it
+        # is in its share of the slots), by class
+        self.queues = dict((kind, collections.deque()) for kind in weights)
+        self.passes = dict.fromkeys(weights, 0.0)
+        # What's running, overall, by class and by user
+        self.running = 0
+        self.running_kind = collections.Counter()
+        self.running_user = collections.Counter()
+
+
+    def classify (self, catalog, database, table, conditions, order=None,
+                  limit=None, offset=0):
+        """ Classes a SELECT as short or long. """
+
+        try:
+            cost = estimate(catalog, database, table, conditions, order,
+                            limit, offset)
+        except Exception:
+            # (Not knowing, assume the worst)
+            log.debug("Couldn't estimate a query on %s.%s", database, table,
+                      exc_info=True)
+            return "long"
+        return classify(cost, self.short_cost)
+
+
+    def admit (self, user, kind, control=None):
+        """
+        Waits for a slot to run a query in, returning its Ticket (to
+        use in a with block, which gives the slot back). Raises
+        SchedulerBusy if too many are waiting already, or the
+        QueryControl's error if the query's killed (or times out)
+        while it waits.
+        """
+
+        ticket = Ticket(self, user, kind)
+        with self.lock:
+            queue = self.queues[kind]
+            if not queue and self.eligible(ticket):
+                self.start(ticket)
+                return ticket
+            if self.max_queued and len(queue) >= self.max_queued:
+                metrics.queries_rejected.labels(kind).inc()
+                raise SchedulerBusy(kind, self.max_queued)
+            if not queue:
+                # A class that's been idle doesn't get to catch up
+                # on the slots it didn't use
+                waiting = [self.passes[k] for k, q in self.queues.items() if q]
+                if waiting:
+                    self.passes[kind] = max(self.passes[kind], min(waiting))
+            queue.append(ticket)
+            metrics.queries_queued.labels(kind).inc()
+
+        # (Waiting with a timeout would poll, in Python 2, so KILL and
+        # the time limit wake the query up instead)
+        timer = None
+        if control is not None:
+            control.waiting = ticket.event
+            if control.deadline is not None:
+                timer = threading.Timer(control.deadline - time.time(),
+                                        ticket.event.set)
+                timer.daemon = True
+                timer.start()
+        try:
+            while True:
+                if control is not None:
+                    control.check()
+                ticket.event.wait()
+                with self.lock:
+                    if ticket.granted:
+                        break
+                    ticket.event.clear()
+        except BaseException:
+            with self.lock:
+                if ticket.granted:
+                    self.finish(ticket)
+                else:
+                    queue.remove(ticket)
+                    metrics.queries_queued.labels(kind).dec()
+            raise
+        finally:
+            if control is not None:
+                control.waiting = None
+            if timer is not None:
+                timer.cancel()
+        metrics.queue_wait.labels(kind).observe(time.time() - ticket.queued)
+        return ticket
+
+
+    def eligible (self, ticket):
+        """ Checks whether a query could start now (holding the lock). """
+
+        if self.max_queries and self.running >= self.max_queries:
+            return False
+        if ticket.kind == "long" and self.max_long_queries and \
+           self.running_kind["long"] >= self.max_long_queries:
+            return False
+        return not self.max_user_queries or \
+               self.running_user[ticket.user] < self.max_user_queries
+
+
+    def start (self, ticket):
+        ticket.granted = True
+        self.running += 1
+        self.running_kind[ticket.kind] += 1
+        self.running_user[ticket.user] += 1
+
+
+    def finish (self, ticket):
+        """ Gives back a ticket's slot (holding the lock). """
+
+        ticket.granted = False
+        self.running -= 1
+        self.running_kind[ticket.kind] -= 1
+        self.running_user[ticket.user] -= 1
+        if not self.running_user[ticket.user]:
+            del self.running_user[ticket.user]
+        self.dispatch()
+
+
+    def release (self, ticket):
+        with self.lock:
+            if ticket.granted:
+                self.finish(ticket)
+
+
+    def dispatch (self):
+        """
+        Starts as many waiting queries as there's room for (holding
+        the lock): the first eligible one in the class that would be
+        least far along with one more slot (the heavier one on a tie),
+        then the next, and so on.
+        """
+
+        def next_pass (kind):
+            return (self.passes[kind] + 1.0 / self.weights[kind],
+                    -self.weights[kind])
+
+        while True:
+            for kind in sorted((kind for kind, queue in self.queues.items()
+                                if queue), key=next_pass):
+                ticket = next((t for t in self.queues[kind]
+                               if self.eligible(t)), None)
+                if ticket is not None:
+                    break
+            else:
+                return
+            self.queues[kind].remove(ticket)
+            self.passes[kind] += 1.0 / self.weights[kind]
+            metrics.queries_queued.labels(kind).dec()
+            self.start(ticket)
+            ticket.event.set()
@@ -0,0 +1,127 @@
+import time
+import threading
+import unittest
+from catalog import Catalog
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+from scheduler import Scheduler, SchedulerBusy, estimate
+from sessions import QueryControl, QueryInterrupted
+
+class SchedulerTests(unittest.TestCase):
+    def wait_in(self, scheduler, user, kind, order, control=None):
+        """ Queues a query on a thread, noting when it gets to run. """
+        def run():
+            try:
+                with scheduler.admit(user, kind, control):
+                    order.append(kind)
+            except QueryInterrupted:
+                order.append("killed")
+        thread = threading.Thread(target=run)
+        thread.start()
+        # (Until it's in the queue)
+        while not any(ticket.user == user
+                      for queue in scheduler.queues.values()
+                      for ticket in queue):
+            time.sleep(0.001)
+        return thread
+
+    def test_user_limit(self):
+        """ A user's queries past their limit should wait their turn. """
+        scheduler = Scheduler(max_queries=0, max_user_queries=1)
+        first = scheduler.admit("a", "short")
+        # Other users aren't held up
+        scheduler.admit("b", "short").__exit__()
+        order = []
+        thread = self.wait_in(scheduler, "a", "short", order)
+        self.assertEqual([], order)
+        first.__exit__()
+        thread.join()
+        self.assertEqual(["short"], order)
+
+    def test_weights(self):
+        """ Short queries should get most of the slots while both wait. """
+        scheduler = Scheduler(max_queries=1, max_long_queries=1)
+        running = scheduler.admit("x", "long")
+        order = []
+        threads = [self.wait_in(scheduler, "long%d" % i, "long", order)
+                   for i in range(2)]
+        threads += [self.wait_in(scheduler, "short%d" % i, "short", order)
+                    for i in range(8)]
+        running.__exit__()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["short"] * 4 + ["long"] + ["short"] * 4 + ["long"],
+                         order)
+
+    def test_long_limit(self):
+        """ Long queries shouldn't take the slots short ones need. """
+        scheduler = Scheduler(max_queries=2)
+        running = scheduler.admit("a", "long")
+        order = []
+        thread = self.wait_in(scheduler, "b", "long", order)
+        scheduler.admit("c", "short").__exit__()
+        running.__exit__()
+        thread.join()
+        self.assertEqual(["long"], order)
+
+    def test_busy(self):
+        """ Queries past the queue's bound should be turned away. """
+        scheduler = Scheduler(max_queries=1, max_queued=1)
+        running = scheduler.admit("a", "short")
+        order = []
+        control = QueryControl()
+        thread = self.wait_in(scheduler, "b", "short", order, control)
+        self.assertRaises(SchedulerBusy, scheduler.admit, "c", "short")
+        # A queued query can still be killed
+        control.kill()
+        thread.join()
+        self.assertEqual(["killed"], order)
+        self.assertEqual(0, len(scheduler.queues["short"]))
+        running.__exit__()
+        self.assertEqual(0, scheduler.running)
+
+    def test_estimate(self):
+        """ Indexed lookups should be cheap, and scans cost the table. """
+        backend = MemoryBackend()
+        backend.insert("t", [{"a": i, "b": i} for i in range(5000)])
+        backend.create_index("t", "a")
+        catalog = Catalog(backend)
+        db = backend.database
+        self.assertTrue(estimate(catalog, db, "t", {"a": 5}) < 10)
+        self.assertEqual(5000, estimate(catalog, db, "t", {"b": 5}))
+        self.assertEqual(10, estimate(catalog, db, "t", {}, limit=10))
+        self.assertEqual(500, estimate(catalog, db, "t", {"a": {"$gt": 5}}))
+
+    def test_server(self):
+        """ The server should send an ERR when the queue is full. """
+        backend = MemoryBackend()
+        backend.insert("t", [{"a": 1}])
+        scheduler = Scheduler(max_queries=1, max_queued=0)
+        server = MySQLServer(("127.0.0.1", 0), backend, scheduler=scheduler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = MySQLClient(port=server.server_address[1])
+            self.assertEqual((["a"], [["1"]]), client.query("select a from t"))
+            ticket = scheduler.admit("other", "short")
+            scheduler.max_queued = 1
+            order = []
+            self.wait_in(scheduler, "another", "short", order)
+            try:
+                client.query("select a from t")
+                self.fail("The query wasn't turned away")
+            except MySQLError, e:
+                self.assertEqual(1226, e.code)
+            ticket.__exit__()
+            self.assertEqual((["a"], [["1"]]), client.query("select a from t"))
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import time
+import threading
+import unittest
+import sessions
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+
+class SlowBackend(MemoryBackend):
+    """ Takes its time over each row. """
+    def scan(self, *args, **options):
+        for doc in MemoryBackend.scan(self, *args, **options):
+            time.sleep(0.005)
+            yield doc
+
+class TrickleSocket(object):
+    """ Sends in small pieces, so the other side's reads come up short. """
+    def __init__(self, sock):
+        self.socket = sock
+
+    def sendall(self, data):
+        for i in range(0, len(data), 4096):
+            self.socket.sendall(data[i:i + 4096])
+            time.sleep(0.0005)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+class SessionTests(unittest.TestCase):
+    def setUp(self):
+        backend = SlowBackend()
+        backend.insert("t", [{"a": 1}])
+        backend.use("other").insert("t", [{"a": 2}])
+        self.server = MySQLServer(("127.0.0.1", 0), backend)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = MySQLClient(port=self.server.server_address[1])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepalive(self):
+        """ Pings, database switches and errors shouldn't end the session. """
+        self.assertEqual(0, self.client.ping())
+        self.client.select_db("other")
+        self.assertEqual((["a"], [["2"]]), self.client.query("select a from t"))
+        self.client.query("USE `pysql_test`;")
+        self.assertEqual((["a"], [["1"]]), self.client.query("select a from t"))
+        try:
+            self.client.query("select a from t where a ~ 1")
+            self.fail("Expected an error")
+        except MySQLError, e:
+            self.assertEqual(1064, e.code)
+        try:
+            self.client.query("select a from t where a = 1 and")
+            self.fail("Expected an error")
+        except MySQLError, e:
+            self.assertEqual(1064, e.code)
+        self.assertRaises(MySQLError, self.client.command, 0x7f)
+        self.assertEqual(0, self.client.ping())
+
+    def test_control(self):
+        """ Queries should stop when killed, or out of time. """
+        control = sessions.QueryControl()
+        control.check()
+        control.kill()
+        self.assertRaises(sessions.QueryInterrupted, control.check)
+        control = sessions.QueryControl(max_execution_time=1)
+        time.sleep(0.01)
+        try:
+            control.check()
+            self.fail("Expected a timeout")
+        except sessions.QueryInterrupted, e:
+            self.assertEqual(sessions.ER_QUERY_TIMEOUT, e.code)
+
+    def test_max_execution_time(self):
+        """ Slow SELECTs should be cut off, leaving the session usable. """
+        self.client.query("insert into t (a) values %s" %
+                          ", ".join("(%d)" % i for i in range(100)))
+        try:
+            self.client.query("select /*+ MAX_EXECUTION_TIME(50) */ a from t")
+            self.fail("Expected a timeout")
+        except MySQLError, e:
+            self.assertEqual(sessions.ER_QUERY_TIMEOUT, e.code)
+        self.client.query("SET SESSION max_execution_time = 50")
+        self.assertEqual((["@@max_execution_time"], [["50"]]),
+                         self.client.query("select @@max_execution_time"))
+        self.assertRaises(MySQLError, self.client.query, "select a from t")
+        self.client.query("SET max_execution_time = 0")
+        self.assertEqual(101, len(self.client.query("select a from t")[1]))
+
+    def test_reset_max_execution_time(self):
+        """ Resetting the session should put the server's time limit back. """
+        for reset in (self.client.reset_connection,
+                      lambda: self.client.change_user("root")):
+            self.client.query("SET max_execution_time = 50")
+            reset()
+            self.assertEqual((["@@max_execution_time"], [["0"]]),
+                             self.client.query("select @@max_execution_time"))
+
+    def test_kill_query(self):
+        """ KILL QUERY from another connection should stop a SELECT. """
+        self.client.query("insert into t (a) values %s" %
+                          ", ".join("(%d)" % i for i in range(400)))
+        thread_id = int(self.client.query("select connection_id()")[1][0][0])
+        other = MySQLClient(port=self.server.server_address[1])
+        def kill():
+            time.sleep(0.2)
+            other.query("KILL QUERY %d" % thread_id)
+        thread = threading.Thread(target=kill)
+        thread.start()
+        try:
+            self.client.query("select a from t")
+            self.fail("Expected the query to be killed")
+        except MySQLError, e:
+            self.assertEqual(sessions.ER_QUERY_INTERRUPTED, e.code)
+        finally:
+            thread.join()
+        # The connection (and the other one) should still work
+        self.assertEqual(0, self.client.ping())
+        self.assertRaises(MySQLError, other.query, "KILL 999999")
+        other.close()
+
+    def test_kill_owner(self):
+        """ Only the session's own user (or an admin) should kill it. """
+        port = self.server.server_address[1]
+        alice = MySQLClient(port=port, user="alice")
+        bob = MySQLClient(port=port, user="bob")
+        try:
+            thread_id = int(alice.query("select connection_id()")[1][0][0])
+            try:
+                bob.query("KILL QUERY %d" % thread_id)
+                self.fail("Expected KILL to be denied")
+            except MySQLError, e:
+                self.assertEqual(sessions.ER_KILL_DENIED, e.code)
+            alice.query("KILL QUERY %d" % thread_id)
+            self.client.query("KILL QUERY %d" % thread_id)
+            self.assertEqual(0, alice.ping())
+        finally:
+            alice.close()
+            bob.close()
+
+    def test_long_packets(self):
+        """ Statements should arrive whole, however they're sent. """
+        sql = "select a from t where a in (%s)" % ", ".join(
+            str(i) for i in range(10000))
+        self.client.socket = TrickleSocket(self.client.socket)
+        self.assertEqual((["a"], [["1"]]), self.client.query(sql))
+        # Payloads too long for one packet carry on in the next ones
+        self.client.socket = self.client.socket.socket
+        self.assertEqual((["a"], [["1"]]),
+                         self.client.query("select a from t" + " " * 0xFFFFFF))
+        self.assertEqual(0, self.client.ping())
+
+    def test_unsupported(self):
+        """ Statements that can't be run should get an ERR, not an OK. """
+        for statement in ("UPDATE t SET a=1", "DELETE FROM t",
+                          "DROP TABLE t", "ALTER TABLE t ADD b INT"):
+            try:
+                self.client.query(statement)
+                self.fail("%s got an OK" % statement)
+            except MySQLError, e:
+                self.assertEqual(1235, e.code)
+        # Even in a transaction
+        self.client.query("BEGIN")
+        self.assertRaises(MySQLError, self.client.query, "UPDATE t SET a=1")
+        self.client.query("ROLLBACK")
+        # Settings with nothing to do are still fine
+        for statement in ("SET NAMES utf8mb4", "SET sql_mode = 'ANSI'",
+                          "SET SESSION TRANSACTION ISOLATION LEVEL "
+                          "READ COMMITTED", ";"):
+            self.assertEqual(0, self.client.query(statement))
+        self.assertEqual((["a"], [["1"]]), self.client.query("select a from t"))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
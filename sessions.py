@@ -0,0 +1,189 @@
+"""
+Keeps track of the sessions, so queries can be found and stopped.
+
+Each session gets a unique id (the thread id in its greeting, and
+CONNECTION_ID()), which KILL [QUERY] id uses from other connections.
+Each query gets a QueryControl, which the streaming encoder checks
+as it goes, so a killed (or timed out) query stops sending rows and
+its backend cursor gets closed.
+"""
+
+import time
+import socket
+import itertools
+import threading
+
+
+# Error codes for interrupted queries
+ER_NO_SUCH_THREAD = 1094
+ER_KILL_DENIED = 1095
+ER_QUERY_INTERRUPTED = 1317
+ER_QUERY_TIMEOUT = 3024
+
+# The default max_execution_time (in ms, 0 for none)
+MAX_EXECUTION_TIME = 0
+
+# Users that can KILL anyone's sessions (as with MySQL's SUPER
+# privilege); everyone else can only kill their own
+ADMIN_USERS = frozenset(["root"])
+
+# The columns of SHOW PROCESSLIST
+PROCESSLIST_COLUMNS = ["Id", "User", "Host", "db", "Command", "Time",
+                       "State", "Info"]
+
+
+
+class QueryInterrupted (Exception):
+    """ A query was killed, or ran out of time. """
+
+    def __init__ (self, timeout=False):
+        if timeout:
+            message = "Query execution was interrupted, " \
+                      "maximum statement execution time exceeded"
+        else:
+            message = "Query execution was interrupted"
+        Exception.__init__(self, message)
+        self.code = ER_QUERY_TIMEOUT if timeout else ER_QUERY_INTERRUPTED
+        self.sql_state = "HY000" if timeout else "70100"
+        # Whether the error has already gone out to the client
+        self.sent = False
+
+
+
+class QueryControl (object):
+    """ Lets a running query be killed, or time out. """
+
+    def __init__ (self, max_execution_time=0):
+        self.started = time.time()
+        # In milliseconds (0 for no limit)
+        self.max_execution_time = max_execution_time
+        self.deadline = None
+        if max_execution_time:
+            self.deadline = self.started + max_execution_time / 1000.0
+        self.killed = False
+        # Set when the query's killed, while it's queued to run
+        # (see scheduler)
+        self.waiting = None
+
+
+    def remaining_ms (self):
+        """ How much time is left (for the backend), or None. """
+
+        if self.deadline is None:
+            return None
+        return max(int((self.deadline - time.time()) * 1000), 1)
+
+
+    def kill (self):
+        self.killed = True
+        waiting = self.waiting
+        if waiting is not None:
+            waiting.set()
+
+
+    def check (self):
+        """ Raises QueryInterrupted if the query should stop. """
+
+        if self.killed:
+            raise QueryInterrupted()
+        if self.deadline is not None and time.time() > self.deadline:
+            raise QueryInterrupted(timeout=True)
+
+
+
+class SessionRegistry (object):
+    """ The connected sessions, by id. """
+
+    def __init__ (self, first_id=1, last_id=None):
+        self.ids = itertools.count(first_id)
+        # The ids this registry hands out (other workers' sessions,
+        # with prefork, have ids outside of them)
+        self.first_id = first_id
+        self.last_id = last_id
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+
+    def next_id (self):
+        with self.lock:
+            while True:
+                thread_id = next(self.ids)
+                if self.last_id is not None and thread_id > self.last_id:
+                    # Out of ids, so start over (skipping the ones
+                    # still in use)
+                    self.ids = itertools.count(self.first_id)
+                elif thread_id not in self.sessions:
+                    return thread_id
+
+
+    def add (self, session):
+        with self.lock:
+            self.sessions[session.thread_id] = session
+
+
+    def remove (self, session):
+        with self.lock:
+            self.sessions.pop(session.thread_id, None)
+
+
+    def owns (self, thread_id):
+        """ Checks whether a session id would be one of this registry's. """
+
+        return self.first_id <= thread_id and \
+               (self.last_id is None or thread_id <= self.last_id)
+
+
+    def get (self, thread_id):
+        return self.sessions.get(thread_id)
+
+
+    def all (self):
+        with self.lock:
+            return sorted(self.sessions.values(), key=lambda s: s.thread_id)
+
+
+    def kill (self, thread_id, query_only=False):
+        """
+        Kills a session's running query (and the session itself, unless
+        query_only). Returns False if there's no such session.
+        """
+
+        session = self.get(thread_id)
+        if session is None:
+            return False
+        control = session.control
+        if control is not None:
+            control.kill()
+        if not query_only:
+            # Wakes the session up if it's waiting for a command
+            session.killed = True
+            try:
+                session.socket.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
+        return True
+
+
+
+def processlist_rows (sessions):
+    """ Makes the rows of SHOW PROCESSLIST for some sessions. """
+
+    now = time.time()
+    rows = []
+    for session in sessions:
+        command = session.current
+        if command is None:
+            state = ["Sleep", "0", "", None]
+        else:
+            state = [command.description,
+                     str(int(now - command.received)),
+                     "executing" if session.control else "",
+                     command.statement if command.statement else None]
+        rows.append([str(session.thread_id), session.user,
+                     "%s:%s" % session.client[:2],
+                     session.backend.database] + state)
+    return rows
+
+
+# All the sessions on this server
+registry = SessionRegistry()
@@ -1,9 +1,12 @@
 """
 Source: http://dev.mysql.com/doc/refman/5.5/en/operator-precedence.html
+
+The keyword and operator sets are frozen, since the scanner only ever
+looks words up in them (see pysql.SQLStatement).
 """
 
 # A list of all the MySQL operators
-SQL_OPERATORS = set([
+SQL_OPERATORS = frozenset([
     "INTERVAL",
     "BINARY", "COLLATE",
     "!",
@@ -42,11 +45,28 @@ SQL_OPERATOR_TYPES = {
     "<=": "less_than_or_equal",
     "<": "less_than",
     "!=": "not_equal",
+    "<>": "not_equal",
+    "LIKE": "like",
+    "REGEXP": "regular_expression",
+}
+
+# The MongoDB query operators for each operator type
+# (None means a plain {field: value} match)
+SQL_MONGODB_OPERATORS = {
+    "equality": None,
+    "not_equal": "$ne",
+    "greater_than_or_equal": "$gte",
+    "greater_than": "$gt",
+    "less_than_or_equal": "$lte",
+    "less_than": "$lt",
+    # (Turned into ranges and regexes by patterns.PATTERN_OPERATORS)
+    "like": "$regex",
+    "regular_expression": "$regex",
 }
 
 # All the operators which are symbols rather than words
 # (used for regex/scanning)
-SQL_ESCAPED_OPERATORS = set([
+SQL_ESCAPED_OPERATORS = frozenset([
     "INTERVAL",
     "BINARY", "COLLATE",
     "!=",  # Needs to be up here, or the scanner will match != as !, =
@@ -129,6 +149,7 @@ SQL_OPERATOR_TRANSLATION = {
     },
     "like": {
         "sql": "{0} LIKE {1}",
+        "mongodb": "{0}: {{$regex: {1}}}",
         "js": None,
         "python": None
     },
@@ -136,6 +157,7 @@ SQL_OPERATOR_TRANSLATION = {
     # TODO: Look into compatbility
     "regular_expression": {
         "sql": "{0} REGEXP {1}",
+        "mongodb": "{0}: {{$regex: {1}}}",
         "js": None,
         "python": None
     },
@@ -428,5 +450,8 @@ YEAR_MONTH
 ZEROFILL
 """
 
-SQL_KEYWORDS = [x.strip() for x in keywords.splitlines() if x.strip()]
-SQL_KEYWORDS_REGEX = "|".join(SQL_KEYWORDS)
\ No newline at end of file
+SQL_KEYWORDS = frozenset(keywords.split())
+
+# The operators which are words (eg. AND, LIKE), which get scanned
+# as words, and then looked up
+SQL_WORD_OPERATORS = frozenset(op for op in SQL_OPERATORS if op.isalpha())
\ No newline at end of file
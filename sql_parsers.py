@@ -1,48 +1,390 @@
-from sql_constants import SQL_OPERATOR_TYPES
+import re
+import json
+
+from sql_constants import SQL_OPERATOR_TYPES, SQL_MONGODB_OPERATORS
+from patterns import PATTERN_OPERATORS
 
 
 
 class UnsupportedSQLExpression (Exception): pass
 
 
+# The parts of a (dotted) identifier
+identifier_part_regex = re.compile("`([^`]+)`|([^.`]+)")
+
+# The values in an IN list token (as pysql.SQL_VALUE_REGEX)
+in_value_regex = re.compile("[0-9]+"
+                            r"|'(?:[^'\\]|\\[\s\S]|'')*'"
+                            r'|"(?:[^"\\]|\\[\s\S]|"")*"')
+
+# A string's escapes: a backslash and a character, or a doubled quote
+# (by the quote the string's in)
+escape_regexes = {
+    "'": re.compile(r"\\([\s\S])|''"),
+    '"': re.compile(r'\\([\s\S])|""'),
+}
+
+# What the backslash escapes stand for (the rest are just the character,
+# except \% and \_, which keep the backslash for LIKE, as in MySQL)
+ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t",
+           "Z": "\x1a", "%": "\\%", "_": "\\_"}
+
+
+def identifier (token_value):
+    """
+    Strips the quotes off an identifier (eg. `name`),
+    including each part of a dotted path (eg. `address`.`city`).
+    """
+
+    if "`" not in token_value:
+        return token_value
+    return ".".join(quoted or plain for quoted, plain
+                    in identifier_part_regex.findall(token_value))
+
+
+def unquote (token_value):
+    """ Strips the quotes off a string token, and undoes its escapes. """
+
+    quote = token_value[0]
+    body = token_value[1:-1]
+    if "\\" not in body and quote not in body:
+        return body
+    return escape_regexes[quote].sub(
+        lambda match: quote if match.group(1) is None else
+                      ESCAPES.get(match.group(1), match.group(1)), body)
+
+
+def value (token_value):
+    """ Turns a value token into the equivalent Python value. """
+
+    if token_value[0] in "'\"":
+        return unquote(token_value)
+    return int(token_value)
+
+
+def in_list (token_value):
+    """
+    Gets the values in an IN list token, eg. IN (1, 2, 'x'), without
+    any duplicates (keeping the first of each, in order).
+    """
+
+    body = token_value[token_value.index("(") + 1:-1]
+    if "'" not in body and '"' not in body:
+        # Just numbers (the usual case), which json reads in C
+        # (other than ones with leading zeros, which int() takes)
+        try:
+            values = json.loads("[%s]" % body)
+        except ValueError:
+            values = map(int, body.split(","))
+    else:
+        values = [value(token) for token in in_value_regex.findall(body)]
+    if len(set(values)) == len(values):
+        return values
+    unique = []
+    seen = set()
+    for v in values:
+        if v not in seen:
+            seen.add(v)
+            unique.append(v)
+    return unique
+
+
 def SELECT (args):
     # Select all columns
     if args[0][1] == "*" and len(args) == 1:
         return {}
-    else:
-        raise UnsupportedSQLExpression("Unsupported expression for SELECT")
+    # Otherwise, it should be a comma separated list of columns
+    columns = []
+    for i, (token_type, token_value) in enumerate(args):
+        if i % 2 == 0 and token_type == "identifier":
+            columns.append(identifier(token_value))
+        elif i % 2 == 1 and token_value == ",":
+            continue
+        else:
+            raise UnsupportedSQLExpression("Unsupported expression for SELECT")
+    return {"columns": columns}
 
 
 def FROM (args):
     if len(args) == 1:
-        return {"table": args[0][1]}
+        # database.table comes through as one (dotted) identifier
+        name = identifier(args[0][1])
+        if "." in name:
+            database, table = name.split(".", 1)
+            return {"database": database, "table": table}
+        return {"table": name}
+    elif len(args) == 3 and args[1] == ("operator", "."):
+        # database.table
+        return {"database": identifier(args[0][1]),
+                "table": identifier(args[2][1])}
     else:
         raise UnsupportedSQLExpression("Unsupported expression for FROM")
 
 
 def WHERE (args):
-    # Values for each side of the operation
-    # eg. a + b
-    a = []
-    b = []
-    conditions = []
-    # TODO: Figure out how to do unary operators
-    for token_type, token_value in args:
-        if token_type == "operator":
-            # See if we need to evaluate a previous operation
-            if b:
-                # TODO: Make this smarter
-                template = SQL_OPERATOR_TRANSLATION[op]["mongodb"]
-                conditions.append(template.format(a[0], b[0]))
-                a = []
-                b = []
-            op = SQL_OPERATOR_TYPES[token_value]
-
-
-        elif token_type == "value":
-            if op:
-                a.append(token_value)
+    """
+    Turns the WHERE clause into a MongoDB query document.
+
+    Handles comparisons joined by AND/OR, with parenthesis.
+    """
+
+    conditions, i = _where_or(args, 0)
+    if i != len(args):
+        raise UnsupportedSQLExpression("Unsupported expression for WHERE")
+    return {"conditions": conditions}
+
+
+def _where_or (args, i):
+    """ Parses a series of conditions joined by OR. """
+
+    terms = []
+    while True:
+        term, i = _where_and(args, i)
+        # Flatten nested ORs into a single $or,
+        # rather than {$or: [{$or: [a, b]}, c]}
+        terms += term.get("$or", [term]) if len(term) == 1 else [term]
+        if i < len(args) and _operator(args[i]) == "logical_or":
+            i += 1
+        else:
+            break
+    if len(terms) > 1:
+        terms = _or_to_in(terms)
+    if len(terms) == 1:
+        return terms[0], i
+    return {"$or": terms}, i
+
+
+def _or_to_in (terms):
+    """
+    Folds ORed equality (and IN) terms on the same field into a single
+    $in, so a = 1 OR a = 2 OR a IN (2, 3) becomes {a: {$in: [1, 2, 3]}}.
+    """
+
+    folded = []
+    # field -> (its $in list, the values in it)
+    lists = {}
+    for term in terms:
+        field, values = _in_values(term)
+        if field is None:
+            folded.append(term)
+            continue
+        if field not in lists:
+            lists[field] = ([], set())
+            folded.append({field: {"$in": lists[field][0]}})
+        in_values, seen = lists[field]
+        for v in values:
+            if v not in seen:
+                seen.add(v)
+                in_values.append(v)
+    if len(folded) == len(terms):
+        # (Nothing to fold)
+        return terms
+    return [_equality(term) for term in folded]
+
+
+def _in_values (term):
+    """ Gets (field, values) for an equality or IN term, or (None, None). """
+
+    if len(term) != 1:
+        return None, None
+    field, condition = term.items()[0]
+    if field.startswith("$"):
+        return None, None
+    if not isinstance(condition, dict):
+        return field, [condition]
+    if condition.keys() == ["$in"]:
+        return field, condition["$in"]
+    return None, None
+
+
+def _equality (term):
+    """ Turns an $in of one value back into a plain match. """
+
+    field, values = _in_values(term)
+    if field is not None and len(values) == 1:
+        return {field: values[0]}
+    return term
+
+
+def _where_and (args, i):
+    """ Parses a series of conditions joined by AND. """
+
+    terms = []
+    while True:
+        term, i = _where_term(args, i)
+        terms.append(term)
+        if i < len(args) and _operator(args[i]) == "logical_and":
+            i += 1
+        else:
+            break
+    return merge_conditions(terms), i
+
+
+def _where_term (args, i):
+    """ Parses a single comparison, or a parenthesized expression. """
+
+    # (eg. "WHERE a = 1 AND", or "WHERE (")
+    if i >= len(args):
+        raise UnsupportedSQLExpression("Incomplete expression for WHERE")
+
+    if args[i] == ("operator", "("):
+        conditions, i = _where_or(args, i + 1)
+        if i >= len(args) or args[i] != ("operator", ")"):
+            raise UnsupportedSQLExpression("Unbalanced parenthesis in WHERE")
+        return conditions, i + 1
+
+    # field [NOT] IN (...)
+    if args[i][0] == "identifier":
+        j = i + 1
+        negated = j < len(args) and _operator(args[j]) == "logical_not"
+        j += negated
+        if j < len(args) and args[j][0] == "list":
+            field = identifier(args[i][1])
+            values = in_list(args[j][1])
+            if negated:
+                return {field: {"$nin": values}}, j + 1
+            return _equality({field: {"$in": values}}), j + 1
+
+    if i + 3 > len(args):
+        raise UnsupportedSQLExpression("Unsupported expression for WHERE")
+    left, op, right = args[i:i + 3]
+    op = _operator(op)
+    if op not in SQL_MONGODB_OPERATORS:
+        raise UnsupportedSQLExpression("Unsupported operator in WHERE")
+    # Allow the value on either side of the comparison
+    # (but patterns only go on the right)
+    if left[0] == "value" and right[0] == "identifier" and \
+       op not in PATTERN_OPERATORS:
+        left, right = right, left
+        op = _FLIPPED_OPERATORS.get(op, op)
+    if left[0] != "identifier" or right[0] != "value":
+        raise UnsupportedSQLExpression("Unsupported expression for WHERE")
+
+    mongo_op = SQL_MONGODB_OPERATORS[op]
+    if op in PATTERN_OPERATORS:
+        pattern = value(right[1])
+        if not isinstance(pattern, str):
+            raise UnsupportedSQLExpression("Patterns have to be strings")
+        condition = {identifier(left[1]): PATTERN_OPERATORS[op](pattern)}
+    elif mongo_op:
+        condition = {identifier(left[1]): {mongo_op: value(right[1])}}
+    else:
+        condition = {identifier(left[1]): value(right[1])}
+    return condition, i + 3
+
+
+# What each comparison becomes when its operands are swapped
+_FLIPPED_OPERATORS = {
+    "greater_than": "less_than",
+    "greater_than_or_equal": "less_than_or_equal",
+    "less_than": "greater_than",
+    "less_than_or_equal": "greater_than_or_equal",
+}
+
+
+def _operator (token):
+    """ Gets the operator type for a token (or None). """
+
+    token_type, token_value = token
+    if token_type != "operator":
+        return None
+    return SQL_OPERATOR_TYPES.get(token_value.upper())
+
+
+def merge_conditions (terms):
+    """
+    Combines several MongoDB query documents with AND semantics.
+
+    Operators on the same field are folded together
+    (eg. {a: {$gt: 1}} and {a: {$lt: 5}}),
+    falling back to $and when they can't be.
+    """
+
+    merged = {}
+    for term in terms:
+        for field, condition in term.items():
+            if field not in merged:
+                merged[field] = condition
+            elif isinstance(merged[field], dict) and \
+                 isinstance(condition, dict) and \
+                 not field.startswith("$") and \
+                 not set(merged[field]) & set(condition):
+                merged[field] = dict(merged[field], **condition)
             else:
-                b.append(token_value)
+                return {"$and": terms}
+    return merged
+
+
+def ORDER (args):
+    # ORDER always comes with a BY
+    if not args or args[0][1].upper() != "BY":
+        raise UnsupportedSQLExpression("Unsupported expression for ORDER")
+    order = []
+    for token_type, token_value in args[1:]:
+        if token_type == "identifier":
+            order.append((identifier(token_value), 1))
+        elif token_type == "keyword" and token_value.upper() in ("ASC", "DESC") \
+             and order:
+            direction = 1 if token_value.upper() == "ASC" else -1
+            order[-1] = (order[-1][0], direction)
+        elif token_value != ",":
+            raise UnsupportedSQLExpression("Unsupported expression for ORDER")
+    return {"order": order}
+
+
+def LIMIT (args):
+    # Either LIMIT count or LIMIT offset, count
+    if len(args) == 1 and args[0][0] == "value":
+        return {"limit": value(args[0][1])}
+    elif len(args) == 3 and args[1][1] == ",":
+        return {"offset": value(args[0][1]), "limit": value(args[2][1])}
+    else:
+        raise UnsupportedSQLExpression("Unsupported expression for LIMIT")
+
+
+def INSERT (args):
+    # Nothing goes between INSERT and INTO
+    if args:
+        raise UnsupportedSQLExpression("Unsupported expression for INSERT")
+    return {}
+
+
+def INTO (args):
+    # The table, and then a parenthesized list of columns
+    if len(args) < 3 or args[0][0] != "identifier" or \
+       args[1][1] != "(" or args[-1][1] != ")":
+        raise UnsupportedSQLExpression("Unsupported expression for INTO")
+    columns = []
+    for i, (token_type, token_value) in enumerate(args[2:-1]):
+        if i % 2 == 0 and token_type == "identifier":
+            columns.append(identifier(token_value))
+        elif i % 2 == 1 and token_value == ",":
+            continue
+        else:
+            raise UnsupportedSQLExpression("Unsupported expression for INTO")
+    return {"table": identifier(args[0][1]), "columns": columns}
+
+
+def VALUES (args):
+    # One or more parenthesized lists of values, separated by commas
+    rows = []
+    row = None
+    for token_type, token_value in args:
+        if token_value == "(" and row is None:
+            row = []
+        elif token_value == ")" and row is not None:
+            rows.append(row)
+            row = None
+        elif token_value == "," and row is None and rows:
+            continue
+        elif token_value == "," and row:
+            continue
+        elif row is not None and token_type == "value":
+            row.append(value(token_value))
+        elif row is not None and token_value.upper() == "NULL":
+            row.append(None)
         else:
-            raise UnsupportedSQLExpression("Unsupported expression for WHERE")
+            raise UnsupportedSQLExpression("Unsupported expression for VALUES")
+    if row is not None:
+        raise UnsupportedSQLExpression("Unbalanced parenthesis in VALUES")
+    return {"values": rows}
@@ -16,6 +16,102 @@ class SQLParserTests(unittest.TestCase):
               ('operator', '='), ('value', '"manhattan"'), ('operator', ';')], ''),
             st.scan())
 
+    def test_lazy_imports(self):
+        """ Importing pysql shouldn't load the drivers or HTTP modules. """
+        import subprocess, sys
+        loaded = subprocess.check_output([sys.executable, "-c",
+            "import sys, pysql; print sorted(m for m in sys.modules if m in "
+            "('pymongo', 'bson', 'sqlite3', 'BaseHTTPServer'))"])
+        self.assertEqual("[]", loaded.strip())
+        # The scanner gets made once, and shared
+        SQLStatement("select 1").scan()
+        self.assertTrue(SQLStatement.get_scanner() is SQLStatement.scanner)
+
+    def test_select_clauses(self):
+        """ Checks that each clause of a SELECT ends up on the query. """
+        q = SelectQuery("select /*+ PARALLEL(3) */ name, `city` from people "
+                        "where (age >= 30 or age < 18) and city = 'NYC' "
+                        "order by name desc, city limit 5, 10;")
+        self.assertEqual(
+            ("people", {"$or": [{"age": {"$gte": 30}}, {"age": {"$lt": 18}}],
+                        "city": "NYC"}),
+            q.execute())
+        self.assertEqual(["name", "city"], q.columns)
+        self.assertEqual([("name", -1), ("city", 1)], q.order)
+        self.assertEqual((5, 10), (q.offset, q.limit))
+        self.assertEqual(3, q.parallel)
+
+    def test_paths(self):
+        """ Dotted paths should work as columns, and in the hints. """
+        q = SelectQuery("select /*+ UNNEST(`items`) */ _id, items.sku, "
+                        "`address`.`city` from shop.orders "
+                        "where items.qty > 1 order by address.city")
+        self.assertEqual(("orders", {"items.qty": {"$gt": 1}}), q.execute())
+        self.assertEqual("shop", q.database)
+        self.assertEqual(["_id", "items.sku", "address.city"], q.columns)
+        self.assertEqual([("address.city", 1)], q.order)
+        self.assertEqual("items", q.unnest)
+
+    def test_in_lists(self):
+        """ IN lists and ORed equalities should become a single $in. """
+        self.assertEqual(("t", {"id": {"$in": [1, 2, "x, y"]}}),
+                         SelectQuery("select a from t where id IN "
+                                     "(1, 2, 2, 'x, y')").execute())
+        self.assertEqual(("t", {"id": {"$nin": [1, 2]}, "b": 3}),
+                         SelectQuery("select a from t where id NOT IN (1,2) "
+                                     "and b = 3").execute())
+        self.assertEqual(("t", {"$or": [{"a": {"$in": [1, 2, 4]}}, {"b": 3}]}),
+                         SelectQuery("select a from t where a = 1 OR a = 2 OR "
+                                     "b = 3 OR a IN (2, 4)").execute())
+        self.assertEqual(("t", {"id": 7}),
+                         SelectQuery("select a from t where id in (7)").execute())
+        values = range(10000)
+        q = SelectQuery("select a from t where id in (%s)" %
+                        ", ".join(map(str, values + values)))
+        self.assertEqual(("t", {"id": {"$in": values}}), q.execute())
+
+    def test_string_escapes(self):
+        """ Strings can be empty, and have escaped (or doubled) quotes. """
+        self.assertEqual(("t", {"a": "", "b": "it's", "c": 'say "hi"',
+                                "d": "a\\b\n", "e": "100\\%"}),
+                         SelectQuery("select a from t where a = '' and "
+                                     "b = 'it\\'s' and c = \"say \"\"hi\"\"\" "
+                                     "and d = 'a\\\\b\\n' and e = '100\\%'"
+                                     ).execute())
+        self.assertEqual(("t", {"a": {"$in": ["", "it's", "x, 'y'", 1]}}),
+                         SelectQuery("select a from t where a in "
+                                     "('', 'it''s', \"x, 'y'\", 1)").execute())
+
+    def test_incomplete_where(self):
+        """ Cut off WHERE clauses should be syntax errors, not crashes. """
+        for where in ("a = 1 AND", "a = 1 OR", "(", "(a = 1", "a = 1 AND (",
+                      "NOT", "a", "a IN"):
+            q = SelectQuery("select a from t where " + where)
+            self.assertRaises(sql_parsers.UnsupportedSQLExpression, q.execute)
+
+    def test_insert(self):
+        """ Each row of values should become a document. """
+        q = InsertQuery("INSERT INTO people (name, age, city) "
+                        "VALUES ('Jon', 25, NULL), ('Ann', 31, 'NYC')")
+        self.assertEqual(
+            ("people", [{"name": "Jon", "age": 25, "city": None},
+                        {"name": "Ann", "age": 31, "city": "NYC"}]),
+            q.execute())
+
+    def test_row_encoding(self):
+        """ Rows are length coded strings, with NULL as 0xFB. """
+        packet = RowDataPacket(1, ["Jon", 25, None, "x" * 300])
+        self.assertEqual("\x03Jon\x0225\xFB\xFC\x2C\x01" + "x" * 300,
+                         str(packet)[4:])
+
+    def test_parallel_merge(self):
+        """ Sorted partitions should merge back in order. """
+        import parallel_scan
+        scan = parallel_scan.ParallelScan(
+            [iter([{"a": 4}, {"a": 1}]), iter([{"a": 9}, {"a": 3}, {"a": 2}])],
+            [("a", -1)])
+        self.assertEqual([9, 4, 3, 2, 1], [row["a"] for row in scan])
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+"""
+A backend serving read-only tables from SQLite files.
+
+Each database is a file (<directory>/<database>.db). The conditions,
+projection, sort and limit are all turned into SQL and pushed down,
+and the files are read through SQLite's memory-mapped I/O.
+"""
+
+import os
+import sqlite3
+import threading
+
+import patterns
+from backend import Backend, Documents, NoSuchTable, FILTER, PROJECTION, \
+     SORT, LIMIT
+
+
+# How much of each file SQLite may memory map (in bytes)
+MMAP_SIZE = 1 << 30
+
+# SQL for each comparison operator
+SQL_COMPARISONS = {
+    "$ne": "!=",
+    "$gt": ">",
+    "$gte": ">=",
+    "$lt": "<",
+    "$lte": "<=",
+}
+
+
+
+class UnsupportedCondition (Exception):
+    """ A condition that can't be turned into SQL. """
+
+
+
+def quote (name):
+    """ Quotes an identifier for SQLite. """
+
+    return '"%s"' % name.replace('"', '""')
+
+
+def compile_conditions (conditions):
+    """
+    Turns a MongoDB-style query document into a SQL expression,
+    returning (sql, parameters).
+    """
+
+    parts = []
+    params = []
+    for field, condition in sorted(conditions.items()):
+        if field in ("$and", "$or"):
+            compiled = [compile_conditions(c) for c in condition]
+            joiner = " AND " if field == "$and" else " OR "
+            parts.append("(%s)" % joiner.join(sql for sql, p in compiled))
+            for sql, p in compiled:
+                params += p
+        elif field.startswith("$") or "." in field:
+            raise UnsupportedCondition(field)
+        elif isinstance(condition, dict):
+            for op, value in sorted(condition.items()):
+                if op == "$options":
+                    continue
+                elif op == "$regex":
+                    value = patterns.inline(value, condition.get("$options"))
+                sql, p = compile_operator(field, op, value)
+                parts.append(sql)
+                params += p
+        elif condition is None:
+            parts.append("%s IS NULL" % quote(field))
+        else:
+            parts.append("%s = ?" % quote(field))
+            params.append(condition)
+    return " AND ".join(parts) or "1", params
+
+
+def compile_operator (field, op, value):
+    """ Turns a single field operator into SQL. """
+
+    column = quote(field)
+    if op in SQL_COMPARISONS:
+        if op == "$ne":
+            # MongoDB's $ne also matches missing (NULL) values
+            return "(%s != ? OR %s IS NULL)" % (column, column), [value]
+        return "%s %s ?" % (column, SQL_COMPARISONS[op]), [value]
+    elif op in ("$in", "$nin"):
+        values = list(value)
+        if not values:
+            return ("0" if op == "$in" else "1"), []
+        sql = "%s %sIN (%s)" % (column, "NOT " if op == "$nin" else "",
+                                ", ".join(["?"] * len(values)))
+        return sql, values
+    elif op == "$exists":
+        return "%s IS %sNULL" % (column, "NOT " if value else ""), []
+    elif op == "$regex":
+        # (See patterns.regexp, which each connection has as REGEXP)
+        return "%s REGEXP ?" % column, [value]
+    raise UnsupportedCondition(op)
+
+
+
+class SQLiteBackend (Backend):
+    """ Serves tables from SQLite database files. """
+
+    capabilities = frozenset([FILTER, PROJECTION, SORT, LIMIT])
+
+    def __init__ (self, directory, database="pysql_test", _local=None):
+        self.directory = directory
+        self.database = database
+        # Connections can't be shared between threads,
+        # so each thread gets its own (per database)
+        self._local = _local or threading.local()
+
+
+    def use (self, database):
+        return SQLiteBackend(self.directory, database, self._local)
+
+
+    @property
+    def path (self):
+        return os.path.join(self.directory, self.database + ".db")
+
+
+    @property
+    def connection (self):
+        connections = self._local.__dict__.setdefault("connections", {})
+        path = self.path
+        if path not in connections:
+            if not os.path.exists(path):
+                raise IOError("No such database: %s" % self.database)
+            connection = sqlite3.connect(path)
+            connection.text_factory = str
+            connection.create_function("regexp", 2, patterns.regexp)
+            # Read straight out of the page cache rather than copying,
+            # and make sure nothing can write to the reference data.
+            connection.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+            connection.execute("PRAGMA query_only = ON")
+            connections[path] = connection
+        return connections[path]
+
+
+    def databases (self):
+        return sorted(name[:-3] for name in os.listdir(self.directory)
+                      if name.endswith(".db"))
+
+
+    def tables (self):
+        rows = self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        return [name for name, in rows]
+
+
+    def scan (self, table, conditions=None, columns=None, order=None,
+              limit=None, offset=0, **options):
+        conditions = conditions or {}
+        # Conditions SQLite can't do get checked here instead
+        # (along with the sort and limit, since they have to come after)
+        try:
+            where, params = compile_conditions(conditions)
+            leftover = None
+        except UnsupportedCondition:
+            where, params = "1", []
+            leftover = conditions
+
+        sql = "SELECT %s FROM %s WHERE %s" % (
+            ", ".join(quote(c) for c in columns) if columns and not leftover
+            else "*",
+            quote(table), where
+        )
+        if order and not leftover:
+            sql += " ORDER BY " + ", ".join(
+                "%s %s" % (quote(field), "DESC" if direction < 0 else "ASC")
+                for field, direction in order
+            )
+        if (limit is not None or offset) and not leftover:
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else limit, offset]
+
+        cursor = self.execute(table, sql, params)
+        names = [d[0] for d in cursor.description]
+        rows = (dict(zip(names, row)) for row in cursor)
+        if leftover:
+            # Backend.find does everything itself for a backend
+            # that can't do anything
+            return Documents(rows).find(table, leftover, columns, order,
+                                    limit, offset)
+        return rows
+
+
+    def execute (self, table, sql, params=()):
+        """ Runs a query on a table, raising NoSuchTable if it's not there. """
+
+        try:
+            return self.connection.execute(sql, params)
+        except sqlite3.OperationalError, e:
+            if str(e).startswith("no such table"):
+                raise NoSuchTable(self.database, table)
+            raise
+
+
+    def stats (self, table):
+        rows = self.execute(
+            table, "SELECT COUNT(*) FROM %s" % quote(table)).fetchone()[0]
+        return {
+            "rows": rows,
+            "size": os.path.getsize(self.path),
+            "indexes": len(self.indexes(table)),
+        }
+
+
+    def indexes (self, table):
+        indexes = {}
+        for row in self.connection.execute(
+                "PRAGMA index_list(%s)" % quote(table)):
+            name = row[1]
+            info = self.connection.execute("PRAGMA index_info(%s)" % quote(name))
+            indexes[name] = [(column, 1) for seq, cid, column in info]
+        return indexes
@@ -0,0 +1,139 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from sqlite_backend import SQLiteBackend, compile_conditions
+from columnar_backend import ColumnarBackend, write_table
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+
+PEOPLE = [
+    {"name": "Jon", "age": 25, "city": "NYC"},
+    {"name": "Ann", "age": 31, "city": "Worc"},
+    {"name": "Bob", "age": 19, "city": "NYC"},
+]
+
+class FileBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db = sqlite3.connect(os.path.join(self.directory, "ref.db"))
+        db.execute("CREATE TABLE people (name TEXT, age INT, city TEXT)")
+        db.executemany("INSERT INTO people VALUES (:name, :age, :city)",
+                       PEOPLE)
+        db.commit()
+        db.close()
+        write_table(os.path.join(self.directory, "ref"), "people",
+                    [("name", "string"), ("age", "int64"),
+                     ("city", "string")], PEOPLE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compile(self):
+        """ Conditions should become parameterized SQL. """
+        self.assertEqual(
+            ('("age" > ? OR "city" IN (?, ?)) AND "name" = ?',
+             [20, "NYC", "LA", "Jon"]),
+            compile_conditions({"name": "Jon", "$or": [
+                {"age": {"$gt": 20}}, {"city": {"$in": ["NYC", "LA"]}}]}))
+
+    def test_queries(self):
+        """ Both file backends should answer queries the same way. """
+        queries = [
+            ({"city": "NYC"}, ["name"], [("age", -1)], None),
+            ({"$or": [{"age": {"$lt": 20}}, {"name": "Ann"}]}, ["name"],
+             [("name", 1)], None),
+            ({}, ["name"], [("age", 1)], 2),
+            # Dotted paths can't be pushed down to SQLite
+            ({"address.city": "NYC"}, None, None, None),
+            # LIKE and REGEXP
+            ({"name": {"$regex": "^.o.$", "$options": "s"},
+              "city": {"$regex": "Y"}}, ["name"], [("name", 1)], None),
+        ]
+        expected = [
+            [{"name": "Jon"}, {"name": "Bob"}],
+            [{"name": "Ann"}, {"name": "Bob"}],
+            [{"name": "Bob"}, {"name": "Jon"}],
+            [],
+            [{"name": "Bob"}, {"name": "Jon"}],
+        ]
+        for backend in (SQLiteBackend(self.directory, "ref"),
+                        ColumnarBackend(self.directory, "ref")):
+            self.assertEqual(["people"], backend.tables())
+            self.assertEqual(3, backend.stats("people")["rows"])
+            self.assertEqual(expected, [
+                list(backend.find("people", conditions, columns, order,
+                                  limit))
+                for conditions, columns, order, limit in queries
+            ])
+
+    def test_nulls(self):
+        """ NULLs should come back as None, not as 0 or "". """
+        rows = [{"name": None, "age": None}, {"name": "", "age": 0},
+                {"name": "Eve", "age": 7}]
+        write_table(os.path.join(self.directory, "ref"), "nulls",
+                    [("name", "string"), ("age", "int64")], rows)
+        backend = ColumnarBackend(self.directory, "ref")
+        self.assertEqual(rows, list(backend.find("nulls", {},
+                                                 ["name", "age"])))
+        self.assertEqual([{"age": None}],
+                         list(backend.find("nulls", {"age": None}, ["age"])))
+        self.assertEqual([{"age": 0}],
+                         list(backend.find("nulls", {"name": ""}, ["age"])))
+        self.assertEqual([{"age": 0}],
+                         list(backend.find("nulls", {"age": 0}, ["age"])))
+        # (Columns without NULLs don't need the file)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, "ref", "people", "age.null")))
+
+    def test_errors(self):
+        """ Writes and missing tables should get MySQL's errors. """
+        for backend in (SQLiteBackend(self.directory, "ref"),
+                        ColumnarBackend(self.directory, "ref")):
+            server = MySQLServer(("127.0.0.1", 0), backend)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            client = MySQLClient(port=server.server_address[1],
+                                 database="ref")
+            try:
+                for statement, code, message in [
+                        ("insert into people (name) values ('Eve')", 1036,
+                         "Table 'people' is read only"),
+                        ("select name from missing", 1146,
+                         "Table 'ref.missing' doesn't exist")]:
+                    try:
+                        client.query(statement)
+                        self.fail("Expected an error for %r" % statement)
+                    except MySQLError, e:
+                        self.assertEqual((code, message),
+                                         (e.code, e.message))
+                self.assertEqual(3, len(client.query(
+                    "select name from people")[1]))
+            finally:
+                client.close()
+                server.shutdown()
+                server.server_close()
+
+    def test_shared_tables(self):
+        """ Sessions should share each columnar table (mapped only once). """
+        backend = ColumnarBackend(self.directory)
+        sessions = [backend.use("ref") for i in range(8)]
+        tables = []
+        threads = [threading.Thread(
+                       target=lambda s=s: tables.append(s.table("people")))
+                   for s in sessions]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8, len(tables))
+        self.assertTrue(all(t is tables[0] for t in tables))
+        self.assertTrue(all(s._lock is backend._lock for s in sessions))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Transactions (BEGIN ... COMMIT).
+
+Writes made in a transaction are kept in the session until COMMIT,
+when they all go to the backend together (Backend.commit, which is a
+multi-document transaction on MongoDB), and ROLLBACK just drops them.
+SELECTs in the transaction still see its own writes, which get merged
+into their results by the proxy.
+
+A session only has a Transaction while one is open, so statements
+outside of one (with autocommit on) don't pay for any of this.
+"""
+
+import time
+import itertools
+
+from backend import Documents
+
+
+# Server status flags (in OK and EOF packets)
+SERVER_STATUS_IN_TRANS = 0x0001
+SERVER_STATUS_AUTOCOMMIT = 0x0002
+
+# Writing in a READ ONLY transaction
+ER_CANT_EXECUTE_IN_READ_ONLY_TRANSACTION = 1792
+READ_ONLY_STATE = "25006"
+
+
+
+class ReadOnlyTransaction (Exception):
+    """ A write in a transaction started with READ ONLY. """
+
+    code = ER_CANT_EXECUTE_IN_READ_ONLY_TRANSACTION
+    sql_state = READ_ONLY_STATE
+
+    def __init__ (self):
+        Exception.__init__(
+            self, "Cannot execute statement in a READ ONLY transaction.")
+
+
+
+class Transaction (object):
+    """ A session's open transaction, and the writes it's holding. """
+
+    def __init__ (self, read_only=False):
+        self.read_only = read_only
+        self.started = time.time()
+        # (database, table, documents) for each INSERT, in order
+        self.writes = []
+
+
+    def insert (self, database, table, documents):
+        """ Holds on to an INSERT until the transaction commits. """
+
+        if self.read_only:
+            raise ReadOnlyTransaction()
+        self.writes.append((database, table, documents))
+
+
+    def pending (self, database, table):
+        """ Gets the documents written to a table so far. """
+
+        return [doc for db, name, documents in self.writes
+                if db == database and name == table
+                for doc in documents]
+
+
+    def tables (self):
+        """ Gets the (database, table)s written to. """
+
+        return set((database, table) for database, table, documents
+                   in self.writes)
+
+
+    def find (self, backend, table, conditions=None, columns=None,
+              order=None, limit=None, offset=0, unwind=None, **options):
+        """
+        Runs a query (as Backend.find does), with the transaction's
+        writes to the table included.
+        """
+
+        pending = self.pending(backend.database, table)
+        if not pending:
+            return backend.find(table, conditions, columns, order, limit,
+                                offset, unwind=unwind, **options)
+
+        # The stored documents only get filtered by the backend (and
+        # not even that if they still need unwinding), and the rest of
+        # the query runs here, over them and the pending ones together
+        options.pop("raw", None)
+        stored = backend.find(table, None if unwind else conditions,
+                              **options)
+        return Documents(itertools.chain(stored, pending)).find(
+            table, conditions, columns, order, limit, offset, unwind=unwind)
+
+
+    def commit (self, backend):
+        """ Writes everything to the backend (one of the session's). """
+
+        if self.writes:
+            backend.commit(self.writes)
@@ -0,0 +1,75 @@
+import threading
+import unittest
+from memory_backend import MemoryBackend
+from mysql_client import MySQLClient, MySQLError
+from pysql import MySQLServer
+from transactions import SERVER_STATUS_IN_TRANS, SERVER_STATUS_AUTOCOMMIT
+
+class TransactionTests(unittest.TestCase):
+    def setUp(self):
+        backend = MemoryBackend()
+        backend.insert("t", [{"a": 1}])
+        self.server = MySQLServer(("127.0.0.1", 0), backend)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = self.server.server_address[1]
+        self.client = MySQLClient(port=port)
+        self.other = MySQLClient(port=port)
+
+    def tearDown(self):
+        self.client.close()
+        self.other.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rows(self, client):
+        return client.query("select a from t order by a")[1]
+
+    def test_commit(self):
+        """ Writes should only be seen by others once committed. """
+        self.client.query("BEGIN")
+        self.assertEqual(SERVER_STATUS_IN_TRANS | SERVER_STATUS_AUTOCOMMIT,
+                         self.client.status)
+        self.client.query("insert into t (a) values (3)")
+        self.client.query("insert into t (a) values (2)")
+        # The transaction sees its own writes (sorted in with the rest)
+        self.assertEqual([["1"], ["2"], ["3"]], self.rows(self.client))
+        self.assertTrue(self.client.status & SERVER_STATUS_IN_TRANS)
+        self.assertEqual([["1"]], self.rows(self.other))
+        self.client.query("COMMIT")
+        self.assertEqual(SERVER_STATUS_AUTOCOMMIT, self.client.status)
+        self.assertEqual([["1"], ["2"], ["3"]], self.rows(self.other))
+
+    def test_rollback(self):
+        """ Rolled back writes should never be seen. """
+        self.client.query("START TRANSACTION")
+        self.client.query("insert into t (a) values (2)")
+        self.client.query("ROLLBACK")
+        self.assertEqual([["1"]], self.rows(self.client))
+
+    def test_autocommit(self):
+        """ With autocommit off, writes wait for a COMMIT. """
+        self.client.query("SET autocommit=0")
+        self.assertEqual(0, self.client.status)
+        self.assertEqual([["0"]], self.client.query("SELECT @@autocommit")[1])
+        self.client.query("insert into t (a) values (2)")
+        self.assertEqual(SERVER_STATUS_IN_TRANS, self.client.status)
+        self.assertEqual([["1"]], self.rows(self.other))
+        # Turning it back on commits
+        self.client.query("SET autocommit=1")
+        self.assertEqual([["1"], ["2"]], self.rows(self.other))
+
+    def test_read_only(self):
+        """ Writes in a READ ONLY transaction should be refused. """
+        self.client.query("START TRANSACTION READ ONLY")
+        try:
+            self.client.query("insert into t (a) values (2)")
+            self.fail("The insert went through")
+        except MySQLError, e:
+            self.assertEqual(1792, e.code)
+
+
+
+if __name__ == '__main__':
+    unittest.main()